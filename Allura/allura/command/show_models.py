@@ -16,6 +16,7 @@
 #       under the License.
 
 import sys
+import time
 from collections import defaultdict
 from contextlib import contextmanager
 from itertools import groupby
@@ -77,12 +78,19 @@ class ReindexCommand(base.Command):
                            'which are needed for some markdown macros to run properly')
     parser.add_option('--solr-hosts', dest='solr_hosts',
                       help='Override the solr host(s) to post to.  Comma-separated list of solr server URLs')
+    parser.add_option('--force-solr', action='store_true', dest='force_solr',
+                      help='With --skip-solr-delete, resend documents to solr even if unchanged since they were '
+                           'last indexed')
     parser.add_option(
         '--max-chunk', dest='max_chunk', type=int, default=100 * 1000,
         help='Max number of artifacts to index in one Solr update command')
     parser.add_option('--ming-config', dest='ming_config', help='Path (absolute, or relative to '
                       'Allura root) to .ini file defining ming configuration.')
 
+    # throughput report, when not using --tasks
+    artifacts_indexed = 0
+    artifacts_skipped = 0
+
     def command(self):
         from allura import model as M
         self.basic_setup()
@@ -102,6 +110,7 @@ def command(self):
         if not self.options.solr and not self.options.refs:
             self.options.solr = self.options.refs = True
 
+        start = time.time()
         for projects in utils.chunked_find(M.Project, q_project):
             for p in projects:
                 c.project = p
@@ -109,6 +118,7 @@ def command(self):
                 # Clear index for this project
                 if self.options.solr and not self.options.skip_solr_delete:
                     g.solr.delete(q='project_id_s:%s' % p._id)
+                    M.ArtifactReference.clear_solr_hashes(p._id)
                 if self.options.refs:
                     M.ArtifactReference.query.remove(
                         {'artifact_reference.project_id': p._id})
@@ -143,12 +153,21 @@ def command(self):
                     M.main_orm_session.flush()
                     M.main_orm_session.clear()
         base.log.info('Reindex %s', 'queued' if self.options.tasks else 'done')
+        if not self.options.tasks:
+            elapsed = time.time() - start
+            base.log.info('Reindexed %d artifacts in %.1fs (%.1f artifacts/sec), %d skipped as unchanged',
+                          self.artifacts_indexed, elapsed,
+                          self.artifacts_indexed / elapsed if elapsed else 0,
+                          self.artifacts_skipped)
 
     @property
     def add_artifact_kwargs(self):
+        kwargs = {}
         if self.options.solr_hosts:
-            return {'solr_hosts': self.options.solr_hosts.split(',')}
-        return {}
+            kwargs['solr_hosts'] = self.options.solr_hosts.split(',')
+        if self.options.force_solr:
+            kwargs['skip_unchanged'] = False
+        return kwargs
 
     def _chunked_add_artifacts(self, ref_ids):
         # ref_ids contains solr index ids which can easily be over
@@ -158,10 +177,12 @@ def _chunked_add_artifacts(self, ref_ids):
             if self.options.tasks:
                 self._post_add_artifacts(chunk)
             else:
-                add_artifacts(chunk,
-                              update_solr=self.options.solr,
-                              update_refs=self.options.refs,
-                              **self.add_artifact_kwargs)
+                result = add_artifacts(chunk,
+                                       update_solr=self.options.solr,
+                                       update_refs=self.options.refs,
+                                       **self.add_artifact_kwargs)
+                self.artifacts_indexed += result['indexed']
+                self.artifacts_skipped += result['skipped']
 
     def _post_add_artifacts(self, chunk):
         """
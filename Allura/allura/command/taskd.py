@@ -15,6 +15,7 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
+import errno
 import logging
 import os
 import time
@@ -61,12 +62,23 @@ class TaskdCommand(base.Command):
                       help='only handle tasks of the given name(s) (can be comma-separated list)')
     parser.add_option('--nocapture', dest='nocapture', action="store_true", default=False,
                       help='Do not capture stdout and redirect it to logging.  Useful for development with pdb.set_trace()')
+    parser.add_option('--batch-size', dest='batch_size', type='int', default=1,
+                      help='claim up to this many ready tasks of the same name at once and run them in a single '
+                           'request.  Useful for high-volume small tasks, e.g. with --only')
+    parser.add_option('--pool', dest='pools', action='append', default=None,
+                      help='run as a supervisor that loads the app once and forks a pool of workers.  Format is '
+                           'NAME=SIZE or NAME=SIZE:task_name,task_name (can be given multiple times).  A pool '
+                           'without task names handles all tasks (or --only) that no other pool names')
+    parser.add_option('--max-tasks', dest='max_tasks', type='int', default=0,
+                      help='restart a worker after it has handled this many tasks, to bound memory growth')
 
     def command(self):
         setproctitle('taskd')
         self.basic_setup()
         self.keep_running = True
         self.restart_when_done = False
+        self.is_child = False
+        self.children = {}
         base.log.info('Starting taskd, pid %s' % os.getpid())
         signal.signal(signal.SIGHUP, self.graceful_restart)
         signal.signal(signal.SIGTERM, self.graceful_stop)
@@ -77,7 +89,10 @@ def command(self):
         signal.siginterrupt(signal.SIGHUP, False)
         signal.siginterrupt(signal.SIGTERM, False)
         signal.siginterrupt(signal.SIGUSR1, False)
-        self.worker()
+        if self.options.pools:
+            self.supervisor()
+        else:
+            self.worker()
 
     def graceful_restart(self, signum, frame):
         base.log.info(
@@ -85,28 +100,138 @@ def graceful_restart(self, signum, frame):
             (os.getpid(), signum))
         self.keep_running = False
         self.restart_when_done = True
+        self._stop_children()
 
     def graceful_stop(self, signum, frame):
         base.log.info(
             'taskd pid %s recieved signal %s preparing to do a graceful stop' %
             (os.getpid(), signum))
         self.keep_running = False
+        self._stop_children()
+
+    def _stop_children(self):
+        # supervisor workers always stop; the supervisor restarts as a whole
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def _parse_only(self, only):
+        if only:
+            return only.split(',')
+        return None
+
+    def _parse_pools(self, pools):
+        '''
+        Return a list of (name, size, only, exclude) for the --pool options.
+        Pools without task names take the tasks no other pool names, so
+        slow tasks in those can't hold up the dedicated pools' tasks.
+        '''
+        parsed = []
+        for pool in pools:
+            name, spec = pool.split('=', 1)
+            size, _, only = spec.partition(':')
+            parsed.append((name, int(size), self._parse_only(only)))
+        owned = [task_name for _, _, only in parsed for task_name in only or []]
+        default_only = self._parse_only(self.options.only)
+        result = []
+        for name, size, only in parsed:
+            exclude = None
+            if only is None:
+                if default_only:
+                    only = [t for t in default_only if t not in owned]
+                    if not only:
+                        base.log.warn('taskd pool %s has no tasks left to handle', name)
+                        continue
+                else:
+                    exclude = owned or None
+            result.append((name, size, only, exclude))
+        return result
+
+    def _spawn_worker(self, wsgi_app, pool):
+        '''Fork a worker for pool, a (name, only, exclude) tuple'''
+        pool_name, only, exclude = pool
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                setproctitle('taskd')
+                signal.siginterrupt(signal.SIGHUP, False)
+                signal.siginterrupt(signal.SIGTERM, False)
+                self.is_child = True
+                self.children = {}
+                self.worker(wsgi_app=wsgi_app, only=only, exclude=exclude)
+            except:
+                base.log.exception('taskd worker in pool %s died', pool_name)
+                status = 1
+            finally:
+                os._exit(status)
+        base.log.info('taskd supervisor started worker pid %s for pool %s', pid, pool_name)
+        self.children[pid] = pool
+
+    def supervisor(self):
+        '''Load the WSGI app once, then fork and babysit the worker pools.
+
+        Workers share the preloaded code copy-on-write.  Workers that crash, or
+        exit after --max-tasks, are respawned.  On SIGTERM/SIGHUP workers are
+        stopped gracefully, and on SIGHUP the supervisor then restarts itself.
+        '''
+        setproctitle('taskd-supervisor')
+        pools = self._parse_pools(self.options.pools)
+        wsgi_app = loadapp('config:%s#task' %
+                           self.args[0], relative_to=os.getcwd())
+        # we must be woken up from os.wait() to forward signals to workers
+        signal.siginterrupt(signal.SIGHUP, True)
+        signal.siginterrupt(signal.SIGTERM, True)
+
+        for pool_name, size, only, exclude in pools:
+            for i in range(size):
+                self._spawn_worker(wsgi_app, (pool_name, only, exclude))
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            pool = self.children.pop(pid, None)
+            if pool is None:
+                continue
+            if status:
+                base.log.error('taskd worker pid %s for pool %s exited with status %s',
+                               pid, pool[0], status)
+            if self.keep_running:
+                if status:
+                    time.sleep(1)  # don't spin on a worker that crashes at startup
+                self._spawn_worker(wsgi_app, pool)
+        base.log.info('taskd supervisor pid %s stopping gracefully.' % os.getpid())
+
+        if self.restart_when_done:
+            base.log.info('taskd supervisor pid %s restarting itself' % os.getpid())
+            os.execv(sys.argv[0], sys.argv)
 
     def log_current_task(self, signum, frame):
         entry = 'taskd pid %s is currently handling task %s' % (
             os.getpid(), getattr(self, 'task', None))
+        batch = getattr(self, 'tasks', None) or []
+        if len(batch) > 1:
+            entry += ' (batch of %s)' % len(batch)
         status_log.info(entry)
         base.log.info(entry)
 
-    def worker(self):
+    def worker(self, wsgi_app=None, only=None, exclude=None):
         from allura import model as M
         name = '%s pid %s' % (os.uname()[1], os.getpid())
-        wsgi_app = loadapp('config:%s#task' %
-                           self.args[0], relative_to=os.getcwd())
+        if wsgi_app is None:
+            wsgi_app = loadapp('config:%s#task' %
+                               self.args[0], relative_to=os.getcwd())
         poll_interval = asint(pylons.config.get('monq.poll_interval', 10))
-        only = self.options.only
-        if only:
-            only = only.split(',')
+        if only is None:
+            only = self._parse_only(self.options.only)
+        max_tasks = self.options.max_tasks
+        tasks_done = 0
+        batch_size = max(1, self.options.batch_size)
 
         def start_response(status, headers, exc_info=None):
             if status != '200 OK':
@@ -117,6 +242,9 @@ def start_response(status, headers, exc_info=None):
         def waitfunc_noq():
             time.sleep(poll_interval)
 
+        def waitfunc_wakeup():
+            wakeup.wait(poll_interval)
+
         def check_running(func):
             def waitfunc_checks_running():
                 if self.keep_running:
@@ -125,16 +253,24 @@ def waitfunc_checks_running():
                     raise StopIteration
             return waitfunc_checks_running
 
-        waitfunc = waitfunc_noq
+        if M.MonQWakeup.enabled():
+            wakeup = M.MonQWakeup(only=only, exclude=exclude)
+            waitfunc = waitfunc_wakeup
+        else:
+            waitfunc = waitfunc_noq
         waitfunc = check_running(waitfunc)
         while self.keep_running:
             try:
                 while self.keep_running:
-                    self.task = M.MonQTask.get(
+                    self.tasks = M.MonQTask.get_batch(
                         process=name,
+                        batch_size=batch_size,
                         waitfunc=waitfunc,
-                        only=only)
+                        only=only,
+                        exclude=exclude)
+                    self.task = self.tasks[0] if self.tasks else None
                     if self.task:
+                        start = time.time()
                         with(proctitle("taskd:{0}:{1}".format(
                                 self.task.task_name, self.task._id))):
                             # Build the (fake) request
@@ -144,10 +280,24 @@ def waitfunc_checks_running():
                                               base_url=tg.config['base_url'].rstrip(
                                                   '/') + request_path,
                                               environ={'task': self.task,
+                                                       'tasks': self.tasks,
                                                        'nocapture': self.options.nocapture,
                                                        })
                             list(wsgi_app(r.environ, start_response))
-                            self.task = None
+                        if batch_size > 1:
+                            elapsed = time.time() - start
+                            status_log.info(
+                                'taskd pid %s ran batch of %s %s tasks in %.3fs (%.3fs/task)',
+                                os.getpid(), len(self.tasks), self.task.task_name,
+                                elapsed, elapsed / len(self.tasks))
+                        tasks_done += len(self.tasks)
+                        self.task = None
+                        self.tasks = None
+                        if max_tasks and tasks_done >= max_tasks:
+                            base.log.info('taskd pid %s handled %s tasks, restarting' %
+                                          (os.getpid(), tasks_done))
+                            self.keep_running = False
+                            self.restart_when_done = True
             except Exception as e:
                 if self.keep_running:
                     base.log.exception(
@@ -157,7 +307,8 @@ def waitfunc_checks_running():
                     base.log.exception('taskd error %s' % e)
         base.log.info('taskd pid %s stopping gracefully.' % os.getpid())
 
-        if self.restart_when_done:
+        # supervisor workers just exit, and get respawned by the supervisor
+        if self.restart_when_done and not self.is_child:
             base.log.info('taskd pid %s restarting itself' % os.getpid())
             os.execv(sys.argv[0], sys.argv)
 
@@ -169,9 +320,11 @@ class TaskCommand(base.Command):
                       help='state of processes to examine')
     parser.add_option('-t', '--timeout', dest='timeout', type=int, default=60,
                       help='timeout (in seconds) for busy tasks')
+    parser.add_option('-w', '--window', dest='window', default='5,60',
+                      help='comma separated windows (in minutes) to compute task stats over')
     min_args = 2
     max_args = None
-    usage = '<ini file> [list|retry|purge|timeout|commit]'
+    usage = '<ini file> [list|retry|purge|timeout|commit|stats]'
 
     def command(self):
         self.basic_setup()
@@ -181,7 +334,8 @@ def command(self):
             retry=self._retry,
             purge=self._purge,
             timeout=self._timeout,
-            commit=self._commit)
+            commit=self._commit,
+            stats=self._stats)
         tab[cmd]()
 
     def _list(self):
@@ -224,3 +378,23 @@ def _commit(self):
         from allura.tasks import index_tasks
         base.log.info('Commit to solr')
         index_tasks.commit.post()
+
+    def _stats(self):
+        '''Show queue depth, throughput, error rate and wait/run time percentiles'''
+        from allura import model as M
+        windows = [int(m) for m in self.options.window.split(',')]
+        base.log.info('Task stats for the last %s minutes', self.options.window)
+
+        def fmt(v):
+            return '-' if v is None else '%.2f' % v
+        print '%-60s %6s %6s %6s %8s %7s %7s %8s %8s %8s %8s %8s %8s' % (
+            'task_name', 'ready', 'busy', 'window', 'done/min', 'errors', 'err%',
+            'wait p50', 'wait p95', 'wait p99', 'run p50', 'run p95', 'run p99')
+        stats = M.MonQTask.stats(windows=[timedelta(minutes=m) for m in windows])
+        for s in stats:
+            for w in s['windows']:
+                print '%-60s %6d %6d %6g %8.2f %7d %7.1f %8s %8s %8s %8s %8s %8s' % (
+                    s['task_name'], s['ready'], s['busy'], w['minutes'],
+                    w['throughput'], w['errors'], w['error_rate'] * 100,
+                    fmt(w['wait_p50']), fmt(w['wait_p95']), fmt(w['wait_p99']),
+                    fmt(w['run_p50']), fmt(w['run_p95']), fmt(w['run_p99']))
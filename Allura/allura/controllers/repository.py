@@ -297,6 +297,32 @@ def index(self, **kw):
         all_commits = c.app.repo._impl.new_commits(all_commits=True)
         return dict(commit_count=len(all_commits))
 
+    @expose('json:')
+    def branches(self, prefix=None, limit=None, page=0, **kw):
+        return self._refs('branch', prefix, limit, page)
+
+    @expose('json:')
+    def tags(self, prefix=None, limit=None, page=0, **kw):
+        return self._refs('tag', prefix, limit, page)
+
+    def _refs(self, kind, prefix, limit, page):
+        '''
+        A page of branches or tags, whose names optionally start with prefix:
+        /rest/p/code/branches/?prefix=release-&limit=50&page=2
+        '''
+        limit, page, start = g.handle_paging(limit, page, default=100)
+        refs, count = c.app.repo.find_refs(kind, prefix, page, limit)
+        key = 'branches' if kind == 'branch' else 'tags'
+        return {
+            key: [dict(name=r.name,
+                       object_id=r.object_id,
+                       url=c.app.repo.url_for_commit(r.name))
+                  for r in refs],
+            'count': count,
+            'page': page,
+            'limit': limit,
+        }
+
     @expose('json:')
     def commits(self, rev=None, limit=25, **kw):
         '''
@@ -524,6 +550,8 @@ def _lookup(self, ci, *remainder):
 
 class BranchBrowser(BaseController):
     CommitBrowserClass = None
+    page_list = ffw.PageList()
+    DEFAULT_PAGE_LIMIT = 100
 
     def __init__(self, branch):
         self._branch = branch
@@ -533,13 +561,21 @@ def _check_security(self):
 
     @expose('jinja:allura:templates/repo/tags.html')
     @with_trailing_slash
-    def tags(self, **kw):
-        return dict(tags=c.app.repo.get_tags())
+    def tags(self, prefix=None, limit=None, page=0, **kw):
+        return self._refs('tag', 'Tags', prefix, limit, page)
 
     @expose('jinja:allura:templates/repo/tags.html')
     @with_trailing_slash
-    def branches(self, **kw):
-        return dict(title='Branches', tags=c.app.repo.get_branches())
+    def branches(self, prefix=None, limit=None, page=0, **kw):
+        return self._refs('branch', 'Branches', prefix, limit, page)
+
+    def _refs(self, kind, title, prefix, limit, page):
+        limit, page, start = g.handle_paging(limit, page,
+                                             default=self.DEFAULT_PAGE_LIMIT)
+        refs, count = c.app.repo.find_refs(kind, prefix, page, limit)
+        c.page_list = self.page_list
+        return dict(title=title, tags=refs, prefix=prefix,
+                    count=count, page=page, limit=limit)
 
     @expose()
     @with_trailing_slash
@@ -617,7 +653,38 @@ def tarball(self, **kw):
         if not status and request.method == 'POST':
             allura.tasks.repo_tasks.tarball.post(rev, path)
             redirect('tarball' + '?path={0}'.format(path) if path else '')
-        return dict(commit=self._commit, revision=rev, status=status)
+        return dict(commit=self._commit, revision=rev, status=status,
+                    action=tarball_action())
+
+    @expose()
+    @require_post()
+    def tarball_download(self, path=None, **kw):
+        '''Send a snapshot as it is being built, rather than waiting for the
+        tarball task.  POST only, since it's expensive, and crawlers don't
+        follow forms.'''
+        if not asbool(tg.config.get('scm.repos.tarball.enable', False)):
+            raise exc.HTTPNotFound()
+        if not asbool(tg.config.get('scm.repos.tarball.stream', False)):
+            raise exc.HTTPNotFound()
+        rev = self._commit.url().split('/')[-2]
+        status = c.app.repo.get_tarball_status(rev, path)
+        if status == 'complete':
+            redirect(c.app.repo.tarball_url(rev, path))
+        chunks = None if status else c.app.repo.tarball_stream(rev, path)
+        if chunks is None:
+            # can't stream it right now, so build it the usual way
+            if not status:
+                allura.tasks.repo_tasks.tarball.post(rev, path)
+            redirect('tarball' +
+                     ('?path={0}'.format(quote(h.really_unicode(path).encode('utf-8')))
+                      if path else ''))
+        filename = c.app.repo.tarball_filename(rev, path) + '.zip'
+        response.headers['Content-Type'] = ''
+        response.content_type = 'application/zip'
+        response.headers.add(
+            'Content-Disposition',
+            'attachment;filename="%s"' % h.really_unicode(filename).encode('utf-8'))
+        return chunks
 
     @expose('json:')
     def tarball_status(self, path=None, **kw):
@@ -677,7 +744,7 @@ def index(self, **kw):
             cutout = len('tree' + self._path)
             if request.path.endswith('/') and not self._path.endswith('/'):
                 cutout += 1
-            tarball_url = quote('%starball' % unquote(request.path)[:-cutout])
+            tarball_url = quote('%s%s' % (unquote(request.path)[:-cutout], tarball_action()))
         return dict(
             repo=c.app.repo,
             commit=self._commit,
@@ -815,6 +882,13 @@ def diff(self, prev_commit, fmt=None, prev_file=None, **kw):
         return dict(a=a, b=b, diff=diff)
 
 
+def tarball_action():
+    '''The commit action that snapshot request forms post to'''
+    if asbool(tg.config.get('scm.repos.tarball.stream', False)):
+        return 'tarball_download'
+    return 'tarball'
+
+
 def topo_sort(children, parents, dates, head_ids):
     to_visit = sorted(list(set(head_ids)), key=lambda x: dates[x])
     visited = set()
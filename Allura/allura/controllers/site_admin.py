@@ -566,6 +566,18 @@ def index(self, page_num=1, minutes=10, state=None, task_name=None, host=None):
             window_end=end_dt,
         )
 
+    @expose('jinja:allura:templates/site_admin_task_stats.html')
+    @without_trailing_slash
+    def stats(self, minutes='5,60'):
+        try:
+            windows = sorted(set(int(m) for m in minutes.split(',')))
+        except ValueError:
+            windows = []
+        windows = [m for m in windows if m > 0] or [5, 60]
+        stats = M.monq_model.MonQTask.stats(
+            windows=[timedelta(minutes=m) for m in windows])
+        return dict(stats=stats, minutes=','.join(str(m) for m in windows))
+
     @expose('jinja:allura:templates/site_admin_task_view.html')
     @without_trailing_slash
     def view(self, task_id):
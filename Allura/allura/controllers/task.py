@@ -26,8 +26,10 @@ class TaskController(object):
     '''
 
     def __call__(self, environ, start_response):
-        task = environ['task']
+        # taskd may hand over a batch of same-named tasks to run in one request
+        tasks = environ.get('tasks') or [environ['task']]
         nocapture = environ['nocapture']
-        result = task(restore_context=False, nocapture=nocapture)
+        results = [task(restore_context=False, nocapture=nocapture)
+                   for task in tasks]
         start_response('200 OK', [])
-        return [result]
+        return results
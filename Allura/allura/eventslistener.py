@@ -41,6 +41,10 @@ def addUserLogin(self, user):
     def newCommit(self, newcommit, project, user):
         pass
 
+    def newCommits(self, newcommits, project, user):
+        for newcommit in newcommits:
+            self.newCommit(newcommit, project, user)
+
     def ticketEvent(self, event_type, ticket, project, user):
         pass
 
@@ -79,6 +83,9 @@ def addUserLogin(self, user):
     def newCommit(self, newcommit, project, user):
         self.__iterate('newCommit', newcommit, project, user)
 
+    def newCommits(self, newcommits, project, user):
+        self.__iterate('newCommits', newcommits, project, user)
+
     def ticketEvent(self, event_type, ticket, project, user):
         self.__iterate('ticketEvent', event_type, ticket, project, user)
 
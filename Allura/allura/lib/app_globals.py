@@ -29,7 +29,9 @@
 from subprocess import Popen, PIPE
 import os
 import time
+import threading
 import traceback
+from collections import OrderedDict
 
 import activitystream
 import pkg_resources
@@ -40,7 +42,7 @@
 import pygments.util
 from tg import config, session
 from pylons import request
-from pylons import tmpl_context as c
+from pylons import tmpl_context as c, app_globals as g
 from paste.deploy.converters import asbool, asint, aslist
 from pypeline.markup import markup as pypeline_markup
 
@@ -62,6 +64,7 @@
 from allura.lib.widgets import analytics
 from allura.lib.security import Credentials
 from allura.lib.solr import MockSOLR, make_solr_from_config
+from allura.lib.search import SearchCache
 from allura.model.session import artifact_orm_session
 
 __all__ = ['Globals']
@@ -69,17 +72,85 @@
 log = logging.getLogger(__name__)
 
 
+class RenderCache(object):
+
+    """Bounded LRU cache of rendered html, shared by all requests in a
+    process.  Entries expire after ``ttl`` seconds, which bounds how stale
+    things like links to since closed tickets can get.
+
+    A ``size`` of 0 disables the cache.
+    """
+
+    def __init__(self, size=0, ttl=300):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.size > 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is not None and time.time() - entry[0] < self.ttl:
+                self._data[key] = entry
+                self.hit()
+                return entry[1]
+        self.miss()
+        return None
+
+    def set(self, key, html):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time(), html)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    # hit() and miss() are instrumented by AlluraTimerMiddleware
+    def hit(self):
+        self.hits += 1
+
+    def miss(self):
+        self.misses += 1
+
+
 class ForgeMarkdown(markdown.Markdown):
 
+    bugfix_rev = 3  # increment this if we need all caches to invalidated (e.g. xss in markdown rendering fixed)
+
+    def __init__(self, *args, **kwargs):
+        # identifies the extensions and their options in the keys of
+        # g.markdown_render_cache; instances without one aren't cached
+        self.cache_variant = kwargs.pop('cache_variant', None)
+        # number of convert() calls in progress, see MarkdownPool
+        self.converting = 0
+        markdown.Markdown.__init__(self, *args, **kwargs)
+
     def convert(self, source, render_limit=True):
+        self.converting += 1
+        try:
+            return self._convert(source, render_limit)
+        finally:
+            self.converting -= 1
+
+    def _convert(self, source, render_limit):
         if render_limit and len(source) > asint(config.get('markdown_render_max_length', 40000)):
             # if text is too big, markdown can take a long time to process it,
             # so we return it as a plain text
             log.info('Text is too big. Skipping markdown processing')
             escaped = cgi.escape(h.really_unicode(source))
             return h.html.literal(u'<pre>%s</pre>' % escaped)
+        key = self.render_cache_key(source)
+        if key is not None:
+            html = g.markdown_render_cache.get(key)
+            if html is not None:
+                return h.html.literal(html)
         try:
-            return markdown.Markdown.convert(self, source)
+            html = markdown.Markdown.convert(self, source)
         except Exception:
             log.info('Invalid markdown: %s  Upwards trace is %s', source,
                      ''.join(traceback.format_stack()), exc_info=True)
@@ -87,6 +158,32 @@ def convert(self, source, render_limit=True):
             escaped = cgi.escape(escaped)
             return h.html.literal(u"""<p><strong>ERROR!</strong> The markdown supplied could not be parsed correctly.
             Did you forget to surround a code snippet with "~~~~"?</p><pre>%s</pre>""" % escaped)
+        if key is not None:
+            g.markdown_render_cache.set(key, html)
+        return html
+
+    def render_cache_key(self, source):
+        """Return the key for ``source`` in ``g.markdown_render_cache``, or
+        None if it can't be cached.
+
+        Links are resolved relative to the current project and tool, so those
+        are part of the key along with the renderer and the source's hash.
+
+        """
+        if self.cache_variant is None or not g.markdown_render_cache.enabled:
+            return None
+        if '[[' in source:
+            # macros can depend on the user and change any time; cacheable
+            # ones have their own cache, see allura.lib.macro
+            return None
+        project = getattr(c, 'project', None)
+        app_config = getattr(getattr(c, 'app', None), 'config', None)
+        return (
+            self.cache_variant,
+            hashlib.md5(h.really_unicode(source).encode('utf-8')).hexdigest(),
+            self.bugfix_rev,
+            getattr(project, '_id', None),
+            getattr(app_config, '_id', None))
 
     def cached_convert(self, artifact, field_name):
         """Convert ``artifact.field_name`` markdown source to html, caching
@@ -105,12 +202,11 @@ def cached_convert(self, artifact, field_name):
                 field_name, artifact.__class__.__name__)
             return self.convert(source_text)
 
-        bugfix_rev = 3  # increment this if we need all caches to invalidated (e.g. xss in markdown rendering fixed)
         md5 = None
         # If a cached version exists and it is valid, return it.
         if cache.md5 is not None:
             md5 = hashlib.md5(source_text.encode('utf-8')).hexdigest()
-            if cache.md5 == md5 and getattr(cache, 'fix7528', False) == bugfix_rev:
+            if cache.md5 == md5 and getattr(cache, 'fix7528', False) == self.bugfix_rev:
                 return h.html.literal(cache.html)
 
         # Convert the markdown and time the result.
@@ -131,7 +227,8 @@ def cached_convert(self, artifact, field_name):
             if md5 is None:
                 md5 = hashlib.md5(source_text.encode('utf-8')).hexdigest()
             cache.md5, cache.html, cache.render_time = md5, html, render_time
-            cache.fix7528 = bugfix_rev  # flag to indicate good caches created after [#7528] and other critical bugs were fixed.
+            # flag to indicate good caches created after [#7528] and other critical bugs were fixed.
+            cache.fix7528 = self.bugfix_rev
 
             # Prevent cache creation from updating the mod_date timestamp.
             _session = artifact_orm_session._get()
@@ -139,6 +236,31 @@ def cached_convert(self, artifact, field_name):
         return html
 
 
+class MarkdownPool(object):
+
+    """Per-thread :class:`ForgeMarkdown` instances, built once for each set
+    of options and reset between uses, since building one with all its
+    extensions takes longer than rendering most texts.
+
+    An instance in the middle of a convert (e.g. while a macro renders an
+    included page) is never handed out again; a new one is built instead.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def get(self, key, factory):
+        instances = self._local.__dict__.setdefault('instances', {})
+        md = instances.get(key)
+        if md is not None and not md.converting:
+            md.reset()
+            return md
+        new_md = factory()
+        if md is None:
+            instances[key] = new_md
+        return new_md
+
+
 class NeighborhoodCache(object):
     """Cached Neighborhood objects by url_prefix.
     For faster RootController.__init__ lookup
@@ -315,6 +437,20 @@ def __missing__(self, key):
         duration = asint(config.get('neighborhood.cache.duration', 0))
         self.neighborhood_cache = NeighborhoodCache(duration)
 
+        # Search results cache
+        self.search_cache = SearchCache(
+            size=asint(config.get('search.cache.size', 0)),
+            ttl=asint(config.get('search.cache.ttl', 60)))
+
+        # Rendered markdown, by content, and cacheable macro output
+        self.markdown_render_cache = RenderCache(
+            size=asint(config.get('markdown_render_cache.size', 0)),
+            ttl=asint(config.get('markdown_render_cache.ttl', 300)))
+        self.macro_cache = RenderCache(
+            size=asint(config.get('macro_cache.size', 0)),
+            ttl=asint(config.get('macro_cache.ttl', 60)))
+        self.markdown_pool = MarkdownPool()
+
         # Set listeners to update stats
         statslisteners = []
         for name, ep in self.entry_points['stats'].iteritems():
@@ -356,6 +492,9 @@ def is_connected(self, *a, **kw):
                 def create_activity(self, *a, **kw):
                     pass
 
+                def create_activities(self, *a, **kw):
+                    pass
+
                 def create_timeline(self, *a, **kw):
                     pass
 
@@ -445,20 +584,29 @@ def forge_markdown(self, **kwargs):
             extensions=['fenced_code', 'codehilite',
                         ForgeExtension(
                             **kwargs), 'tables', 'toc', 'nl2br'],
-            output_format='html4')
+            output_format='html4',
+            cache_variant=('forge',) + tuple(sorted(kwargs.items())))
+
+    def pooled_markdown(self, **kwargs):
+        '''Like :meth:`forge_markdown`, but reuses this thread's instance for
+        the same options, reset and ready to convert.  Don't keep it around:
+        the next call with the same options gets it again.'''
+        return self.markdown_pool.get(
+            ('forge',) + tuple(sorted(kwargs.items())),
+            lambda: self.forge_markdown(**kwargs))
 
     @property
     def markdown(self):
-        return self.forge_markdown()
+        return self.pooled_markdown()
 
     @property
     def markdown_wiki(self):
         if c.project.is_nbhd_project:
-            return self.forge_markdown(wiki=True, macro_context='neighborhood-wiki')
+            return self.pooled_markdown(wiki=True, macro_context='neighborhood-wiki')
         elif c.project.is_user_project:
-            return self.forge_markdown(wiki=True, macro_context='userproject-wiki')
+            return self.pooled_markdown(wiki=True, macro_context='userproject-wiki')
         else:
-            return self.forge_markdown(wiki=True)
+            return self.pooled_markdown(wiki=True)
 
     @property
     def markdown_commit(self):
@@ -467,7 +615,8 @@ def markdown_commit(self):
         """
         app = getattr(c, 'app', None)
         return ForgeMarkdown(extensions=[CommitMessageExtension(app), 'nl2br'],
-                             output_format='html4')
+                             output_format='html4',
+                             cache_variant=('commit',))
 
     @property
     def production_mode(self):
@@ -31,6 +31,8 @@
 
 from allura.lib import helpers as h
 import allura.model.repository
+import allura.lib.search
+import allura.lib.app_globals
 
 log = logging.getLogger(__name__)
 
@@ -278,7 +280,7 @@ def timers(self):
         timers = self.entry_point_timers() + [
             Timer(
                 'activitystream.director.{method_name}', allura.model.timeline.Director,
-                'create_activity', 'create_timeline', 'get_timeline'),
+                'create_activity', 'create_activities', 'create_timeline', 'get_timeline'),
             Timer('activitystream.aggregator.{method_name}',
                   allura.model.timeline.Aggregator, '*'),
             Timer('activitystream.node_manager.{method_name}',
@@ -312,11 +314,15 @@ def timers(self):
             Timer('repo.LastCommit.{method_name}',
                   allura.model.repository.LastCommit, '*'),
             Timer('repo.Tree.{method_name}', allura.model.repository.Tree, '*'),
+            Timer('repo_object_cache.{method_name}',
+                  allura.model.repository.RepoObjectCache, 'hit', 'miss'),
             Timer('socket_read', socket._fileobject, 'read', 'readline',
                   'readlines', debug_each_call=False),
             Timer('socket_write', socket._fileobject, 'write', 'writelines',
                   'flush', debug_each_call=False),
             Timer('solr', pysolr.Solr, 'add', 'delete', 'search', 'commit'),
+            Timer('search_cache.{method_name}', allura.lib.search.SearchCache, 'hit', 'miss'),
+            Timer('render_cache.{method_name}', allura.lib.app_globals.RenderCache, 'hit', 'miss'),
             Timer('template', genshi.template.Template, '_prepare', '_parse',
                   'generate'),
             Timer('urlopen', urllib2, 'urlopen'),
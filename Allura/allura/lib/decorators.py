@@ -58,6 +58,12 @@ def myotherfunc():
             # No email notifications will be sent for c.project during this task
             pass
 
+        @task(coalesce='union')
+        def index_things(thing_ids):
+            # Posts made while a previous one is still queued are merged into it
+            pass
+
+    See :meth:`allura.model.monq_model.MonQTask.post` for ``coalesce`` values.
     """
     def task_(func):
         def post(*args, **kwargs):
@@ -67,7 +73,8 @@ def post(*args, **kwargs):
                   kw.get('notifications_disabled') else h.null_contextmanager)
             with cm(project):
                 from allura import model as M
-                return M.MonQTask.post(func, args, kwargs, delay=delay)
+                return M.MonQTask.post(func, args, kwargs, delay=delay,
+                                       coalesce=kw.get('coalesce'))
         # if decorating a class, have to make it a staticmethod
         # or it gets a spurious cls argument
         func.post = staticmethod(post) if inspect.isclass(func) else post
@@ -41,10 +41,18 @@
 
 class macro(object):
 
-    def __init__(self, context=None):
+    """Registers a macro.  ``cache=True`` marks macros whose output only
+    depends on their arguments, project and user, and has no side effects
+    (like registering resources), so it can be kept in ``g.macro_cache``.
+
+    """
+
+    def __init__(self, context=None, cache=False):
         self._context = context
+        self._cache = cache
 
     def __call__(self, func):
+        func.cacheable = self._cache
         _macros[func.__name__] = (func, self._context)
         return func
 
@@ -70,6 +78,8 @@ def __call__(self, s):
                     if '=' not in t:
                         return '[-%s: missing =-]' % ' '.join(parts)
                 args = dict(t.split('=', 1) for t in parts[1:])
+                if getattr(macro, 'cacheable', False) and g.macro_cache.enabled:
+                    return self._cached_call(s, macro, args)
                 response = macro(**h.encode_keys(args))
                 return response
             except (ValueError, TypeError) as ex:
@@ -82,6 +92,16 @@ def __call__(self, s):
             raise
             return '[[Error parsing %s: %s]]' % (s, ex)
 
+    def _cached_call(self, s, macro, args):
+        key = (s, self._context,
+               getattr(getattr(c, 'project', None), '_id', None),
+               getattr(getattr(c, 'user', None), '_id', None))
+        response = g.macro_cache.get(key)
+        if response is None:
+            response = macro(**h.encode_keys(args))
+            g.macro_cache.set(key, response)
+        return response
+
     def _lookup_macro(self, s):
         macro, context = _macros.get(s, (None, None))
         if context is None or context == self._context:
@@ -383,7 +403,7 @@ def include(ref=None, repo=None, **kw):
     link = M.Shortlink.lookup(ref)
     if not link:
         return '[[include %s (not found)]]' % ref
-    artifact = link.ref.artifact
+    artifact = link.cached_ref.artifact
     if artifact is None:
         return '[[include (artifact not found)]]' % ref
     if not h.has_access(artifact, 'read')():
@@ -444,7 +464,7 @@ def members(limit=20):
     return response
 
 
-@macro()
+@macro(cache=True)
 def embed(url=None):
     consumer = oembed.OEmbedConsumer()
     endpoint = oembed.OEmbedEndpoint(
@@ -74,6 +74,7 @@ def extendMarkdown(self, md, md_globals):
         md.registerExtension(self)
         # remove default preprocessors and add our own
         md.preprocessors.clear()
+        md.preprocessors['prefetch_links'] = ShortlinkPrefetchPreprocessor(md, TracRef1(), TracRef2())
         md.preprocessors['trac_refs'] = PatternReplacingProcessor(TracRef1(), TracRef2(), TracRef3(self.app))
         # remove all inlinepattern processors except short refs and links
         md.inlinePatterns.clear()
@@ -108,6 +109,13 @@ class Pattern(object):
     def sub(self, line):
         return self.pattern.sub(self.repl, line)
 
+    def links(self, line):
+        """Return the shortlinks that :meth:`repl` may look up for matches in
+        ``line``, so they can be fetched all at once beforehand.
+
+        """
+        return []
+
     def repl(self, match):
         """Return a string to replace ``match`` in the source string (the
         string in which the match was found).
@@ -126,9 +134,12 @@ class TracRef1(Pattern):
     """
     pattern = re.compile(r'(?<!\[|\w)([#r]\d+)(?!\]|\w)')
 
+    def links(self, line):
+        return [match.group(1) for match in self.pattern.finditer(line)]
+
     def repl(self, match):
         shortlink = M.Shortlink.lookup(match.group(1))
-        if shortlink and not getattr(shortlink.ref.artifact, 'deleted', False):
+        if shortlink and not getattr(shortlink.cached_ref.artifact, 'deleted', False):
             return '[{ref}]({url})'.format(
                 ref=match.group(1),
                 url=shortlink.url)
@@ -146,13 +157,16 @@ class TracRef2(Pattern):
     pattern = re.compile(
         Pattern.BEGIN + r'((comment:(\d+):)?(ticket:)(\d+))' + Pattern.END)
 
+    def links(self, line):
+        return ['#' + match.group(6) for match in self.pattern.finditer(line)]
+
     def repl(self, match):
         shortlink = M.Shortlink.lookup('#' + match.group(6))
-        if shortlink and not getattr(shortlink.ref.artifact, 'deleted', False):
+        if shortlink and not getattr(shortlink.cached_ref.artifact, 'deleted', False):
             url = shortlink.url
             if match.group(4):
                 slug = self.get_comment_slug(
-                    shortlink.ref.artifact, match.group(4))
+                    shortlink.cached_ref.artifact, match.group(4))
                 slug = '#' + slug if slug else ''
                 url = url + slug
 
@@ -250,6 +264,7 @@ def extendMarkdown(self, md, md_globals):
         md.preprocessors['html_block'].markdown_in_raw = True
         md.preprocessors.add('plain_text_block', PlainTextPreprocessor(md), "_begin")
         md.preprocessors.add('macro_include', ForgeMacroIncludePreprocessor(md), '_end')
+        md.preprocessors.add('prefetch_links', ShortlinkPrefetchPreprocessor(md), '_end')
         # this has to be before the 'escape' processor, otherwise weird
         # placeholders are inserted for escaped chars within urls, and then the
         # autolink can't match the whole url
@@ -323,9 +338,9 @@ def _expand_alink(self, link, is_link_with_brackets):
             classes = 'alink'
         href = link
         shortlink = M.Shortlink.lookup(link)
-        if shortlink and shortlink.ref and not getattr(shortlink.ref.artifact, 'deleted', False):
+        if shortlink and shortlink.cached_ref and not getattr(shortlink.cached_ref.artifact, 'deleted', False):
             href = shortlink.url
-            if getattr(shortlink.ref.artifact, 'is_closed', False):
+            if getattr(shortlink.cached_ref.artifact, 'is_closed', False):
                 classes += ' strikethrough'
             self.ext.forge_link_tree_processor.alinks.append(shortlink)
         elif is_link_with_brackets:
@@ -336,13 +351,43 @@ def _expand_alink(self, link, is_link_with_brackets):
             shortlink = M.Shortlink.lookup(attach_link[0])
             if shortlink:
                 attach_status = ' notfound'
-                for attach in shortlink.ref.artifact.attachments:
+                for attach in shortlink.cached_ref.artifact.attachments:
                     if attach.filename == attach_link[1]:
                         attach_status = ''
                 classes += attach_status
         return href, classes
 
 
+class ShortlinkPrefetchPreprocessor(markdown.preprocessors.Preprocessor):
+
+    """Looks up all the shortlinks the text may contain in one go, so that
+    link patterns find them in the request's shortlink cache instead of
+    querying for each one.  Candidates that turn out not to be links do no
+    harm.
+
+    """
+    link_re = re.compile(r'\[([^\[\]\n]+)\](?:\(\s*<?([^\s()<>]+))?')
+
+    def __init__(self, md, *patterns):
+        markdown.preprocessors.Preprocessor.__init__(self, md)
+        self.patterns = patterns
+
+    def run(self, lines):
+        links = set()
+        for line in lines:
+            for match in self.link_re.finditer(line):
+                links.update(link for link in match.groups() if link)
+            for pattern in self.patterns:
+                links.update(pattern.links(line))
+        for link in list(links):
+            attach_link = link.split('/attachment/')
+            if len(attach_link) == 2:
+                links.add(attach_link[0])
+        if links:
+            M.Shortlink.prefetch(links)
+        return lines
+
+
 class PlainTextPreprocessor(markdown.preprocessors.Preprocessor):
 
     '''
@@ -165,34 +165,37 @@ def sidebar_menu(self):
                     small=pending_upstream_merges))
         ref_url = self.repo.url_for_commit(
             self.default_branch_name, url_type='ref')
-        branches = self.repo.get_branches()
+        max_branches = 10
+        branches, branch_count = self.repo.find_refs('branch', limit=max_branches)
         if branches:
             links.append(SitemapEntry('Branches'))
-            for branch in branches:
-                if branch.name == self.default_branch_name:
-                    branches.remove(branch)
-                    branches.insert(0, branch)
-                    break
-            max_branches = 10
+            default = [b for b in branches if b.name == self.default_branch_name]
+            if not default and self.default_branch_name and branch_count > max_branches:
+                # it sorts before any other branch it's a prefix of
+                default = [b for b in self.repo.find_refs(
+                    'branch', prefix=self.default_branch_name, limit=1)[0]
+                    if b.name == self.default_branch_name]
+            if default:
+                branches = default + [b for b in branches if b.name != default[0].name]
             for branch in branches[:max_branches]:
                 links.append(SitemapEntry(
                     branch.name,
                     quote(self.repo.url_for_commit(branch.name) + 'tree/')))
-            if len(branches) > max_branches:
+            if branch_count > max_branches:
                 links.append(
                     SitemapEntry(
                         'More Branches',
                         ref_url + 'branches/',
                     ))
-        tags = self.repo.get_tags()
+        max_tags = 10
+        tags, tag_count = self.repo.find_refs('tag', limit=max_tags)
         if tags:
             links.append(SitemapEntry('Tags'))
-            max_tags = 10
-            for b in tags[:max_tags]:
+            for b in tags:
                 links.append(SitemapEntry(
                     b.name,
                     quote(self.repo.url_for_commit(b.name) + 'tree/')))
-            if len(tags) > max_tags:
+            if tag_count > max_tags:
                 links.append(
                     SitemapEntry(
                         'More Tags',
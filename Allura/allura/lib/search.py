@@ -16,12 +16,15 @@
 #       under the License.
 
 import re
+import copy
+import time
 import socket
+import threading
 from logging import getLogger
 from urllib import urlencode
 from itertools import imap
+from collections import OrderedDict
 
-import markdown
 import jinja2
 from tg import redirect, url
 from pylons import tmpl_context as c, app_globals as g
@@ -86,9 +89,17 @@ def should_update_index(self, old_doc, new_doc):
         return old_doc != new_doc
 
     def solarize(self):
+        return self.solarize_with_shortlinks()[0]
+
+    def solarize_with_shortlinks(self):
+        """Return the solr document, as :meth:`solarize` does, along with the
+        shortlinks found in the raw text, both from a single markdown render.
+        Returns ``(None, [])`` if there is nothing to index.
+
+        """
         doc = self.index()
         if doc is None:
-            return None
+            return None, []
         # if index() returned doc without text, assume empty text
         text = doc.get('text')
         if text is None:
@@ -96,9 +107,8 @@ def solarize(self):
 
         # Convert text to plain text (It usually contains markdown markup).
         # To do so, we convert markdown into html, and then strip all html tags.
-        text = g.markdown.convert(text)
-        doc['text'] = jinja2.Markup.escape(text).striptags()
-        return doc
+        doc['text'], shortlinks = index_render(text)
+        return doc, shortlinks
 
     @classmethod
     def translate_query(cls, q, fields):
@@ -123,6 +133,93 @@ class SearchError(SolrError):
     pass
 
 
+class SearchCache(object):
+
+    """Bounded LRU cache of solr search results, shared by all requests in a
+    process.
+
+    Keys are made of the normalized query and params, the user's roles in the
+    project, and the :class:`~allura.model.index.SearchGeneration` of each
+    project/app_config the search is scoped to.  The index tasks bump those
+    once the artifacts they add or delete are visible in solr, which
+    invalidates cached results in all processes at once.  ``ttl`` (seconds)
+    bounds staleness otherwise.
+
+    A ``size`` of 0 disables the cache.
+    """
+
+    def __init__(self, size=0, ttl=60):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.size > 0
+
+    def key(self, scope_ids, q, kw):
+        from allura import model as M
+        from allura.lib.security import Credentials
+        roles = Credentials.get().user_roles(
+            user_id=c.user._id, project_id=c.project.root_project._id).reaching_ids
+        params = dict(kw)
+        if params.get('fq'):
+            params['fq'] = sorted(params['fq'])
+        return repr((
+            inject_user(q),
+            sorted(params.items()),
+            sorted(roles),
+            scope_ids,
+            M.SearchGeneration.get(scope_ids),
+        ))
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is not None and time.time() - entry[0] < self.ttl:
+                self._data[key] = entry
+                self.hit()
+                # callers may modify the results
+                return copy.deepcopy(entry[1])
+        self.miss()
+        return None
+
+    def set(self, key, results):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time(), copy.deepcopy(results))
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    # hit() and miss() are instrumented by AlluraTimerMiddleware
+    def hit(self):
+        self.hits += 1
+
+    def miss(self):
+        self.misses += 1
+
+
+def cached_search(scope_ids, q, **kw):
+    """Like :func:`search`, but served from ``g.search_cache`` if enabled.
+
+    :param scope_ids: ids of the project and/or app_config the search is
+        limited to (by ``fq``), whose index changes invalidate the results
+    """
+    cache = g.search_cache
+    if not cache.enabled:
+        return search(q, **kw)
+    key = cache.key(scope_ids, q, kw)
+    results = cache.get(key)
+    if results is None:
+        results = search(q, **kw)
+        if results is not None:
+            cache.set(key, results)
+    return results
+
+
 def inject_user(q, user=None):
     '''Replace $USER with current user's name.'''
     if user is None:
@@ -145,10 +242,13 @@ def search(q, short_timeout=False, ignore_errors=True, **kw):
                               (match.group(1) if match else e))
 
 
-def search_artifact(atype, q, history=False, rows=10, short_timeout=False, filter=None, **kw):
+def search_artifact(atype, q, history=False, rows=10, short_timeout=False, filter=None,
+                    use_cache=True, **kw):
     """Performs SOLR search.
 
     Raises SearchError if SOLR returns an error.
+
+    :param use_cache: whether results may come from (and go to) ``g.search_cache``
     """
     # first, grab an artifact and get the fields that it indexes
     a = atype.query.find().first()
@@ -174,7 +274,10 @@ def search_artifact(atype, q, history=False, rows=10, short_timeout=False, filte
         fq.append(' OR '.join(parts))
     if not history:
         fq.append('is_history_b:False')
-    return search(q, fq=fq, rows=rows, short_timeout=short_timeout, ignore_errors=False, **kw)
+    if not use_cache:
+        return search(q, fq=fq, rows=rows, short_timeout=short_timeout, ignore_errors=False, **kw)
+    return cached_search((c.project._id, c.app.config._id),
+                         q, fq=fq, rows=rows, short_timeout=short_timeout, ignore_errors=False, **kw)
 
 
 def site_admin_search(model, q, field, **kw):
@@ -254,9 +357,15 @@ def search_app(q='', fq=None, app=True, **kw):
             search_params.pop('qf', None)
             search_params.pop('pf', None)
         try:
-            results = search(
-                q, short_timeout=True, ignore_errors=False,
-                rows=limit, start=start, **search_params)
+            if app:
+                results = cached_search(
+                    (c.project._id, c.app.config._id),
+                    q, short_timeout=True, ignore_errors=False,
+                    rows=limit, start=start, **search_params)
+            else:
+                results = search(
+                    q, short_timeout=True, ignore_errors=False,
+                    rows=limit, start=start, **search_params)
         except SearchError as e:
             search_error = e
         if results:
@@ -321,12 +430,31 @@ def paginate_comment_urls(doc):
                 sort_field=field)
 
 
-def find_shortlinks(text):
+def _new_index_markdown():
+    from .app_globals import ForgeMarkdown
     from .markdown_extensions import ForgeExtension
-
-    md = markdown.Markdown(
-        extensions=['codehilite', ForgeExtension(), 'tables'],
+    return ForgeMarkdown(
+        extensions=['fenced_code', ForgeExtension(), 'tables', 'toc', 'nl2br'],
         output_format='html4')
-    md.convert(text)
-    link_index = md.treeprocessors['links'].alinks
-    return [link for link in link_index if link is not None]
+
+
+def index_markdown():
+    '''Return this thread's markdown instance for indexing, from
+    ``g.markdown_pool``, reset and ready for a new document.  It has the
+    usual forge extensions, so artifact links are found, but no code
+    highlighting, which makes no difference to the plain text.'''
+    return g.markdown_pool.get(('index',), _new_index_markdown)
+
+
+def index_render(text):
+    '''Render markdown text once for indexing.  Returns a tuple of the plain
+    text, with all markup stripped, and the shortlinks the text refers to.'''
+    md = index_markdown()
+    html = md.convert(text, render_limit=False)
+    shortlinks = [link for link in md.treeprocessors['links'].alinks
+                  if link is not None]
+    return jinja2.Markup.escape(html).striptags(), shortlinks
+
+
+def find_shortlinks(text):
+    return index_render(text)[1]
@@ -15,11 +15,20 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
+import sys
+import json
+import hashlib
+import time
 import shlex
+import logging
+import threading
 
 from tg import config
 from paste.deploy.converters import asbool
 import pysolr
+import requests
+
+log = logging.getLogger(__name__)
 
 escape_rules = {'+': r'\+',
                 '-': r'\-',
@@ -51,6 +60,12 @@ def escape_solr_arg(term):
     return term
 
 
+def solr_doc_hash(doc):
+    """Compact, stable hash of a solr document, used to skip resending
+    documents that haven't changed since they were last indexed."""
+    return hashlib.md5(json.dumps(doc, sort_keys=True, default=unicode)).hexdigest()
+
+
 def make_solr_from_config(push_servers, query_server=None, **kwargs):
     """
     Make a :class:`Solr <Solr>` instance from config defaults.  Use
@@ -60,6 +75,8 @@ def make_solr_from_config(push_servers, query_server=None, **kwargs):
         commit=asbool(config.get('solr.commit', True)),
         commitWithin=config.get('solr.commitWithin'),
         timeout=int(config.get('solr.long_timeout', 60)),
+        bulk_chunk_bytes=int(config.get('solr.bulk_chunk_bytes', 1024 * 1024)),
+        bulk_retries=int(config.get('solr.bulk_retries', 3)),
     )
     solr_kwargs.update(kwargs)
     return Solr(push_servers, query_server, **solr_kwargs)
@@ -75,10 +92,22 @@ class Solr(object):
     Also, accepts default values for `commit` and `commitWithin`
     and passes those values through to each `add` and `delete` call,
     unless explicitly overridden.
+
+    Updates are pushed to all `push_servers` in parallel.  Use `bulk_add`
+    for large batches of documents, e.g. when reindexing.
     """
 
+    # bounds for the adaptive chunk size of bulk_add
+    bulk_min_chunk_bytes = 64 * 1024
+    bulk_max_chunk_bytes = 16 * 1024 * 1024
+    # bulk_add shrinks chunks when a push takes longer than this, and grows
+    # them when it takes less than a quarter of it
+    bulk_target_seconds = 5.0
+    bulk_commit_within = 10000
+
     def __init__(self, push_servers, query_server=None,
-                 commit=True, commitWithin=None, **kw):
+                 commit=True, commitWithin=None,
+                 bulk_chunk_bytes=1024 * 1024, bulk_retries=3, **kw):
         self.push_pool = [pysolr.Solr(s, **kw) for s in push_servers]
         if query_server:
             self.query_server = pysolr.Solr(query_server, **kw)
@@ -86,35 +115,152 @@ def __init__(self, push_servers, query_server=None,
             self.query_server = self.push_pool[0]
         self._commit = commit
         self.commitWithin = commitWithin
+        self.bulk_chunk_bytes = bulk_chunk_bytes
+        self.bulk_retries = bulk_retries
+
+    def _push(self, method, args, kw, retries=0, stats=None):
+        """Call `method` on every push server, in parallel if there are
+        several, retrying each server up to `retries` times with exponential
+        backoff (counted in `stats`, if given).  Returns the responses in
+        `push_pool` order, or raises the first error.
+        """
+        responses = [None] * len(self.push_pool)
+        errors = [None] * len(self.push_pool)
+        attempts = [0] * len(self.push_pool)
+
+        def push(i, solr):
+            while True:
+                try:
+                    responses[i] = getattr(solr, method)(*args, **kw)
+                    return
+                except (pysolr.SolrError, requests.RequestException):
+                    if attempts[i] >= retries:
+                        errors[i] = sys.exc_info()
+                        return
+                    log.warning('Solr %s to %s failed, retrying', method, solr.url, exc_info=True)
+                    time.sleep(2 ** attempts[i])
+                    attempts[i] += 1
+                except Exception:
+                    errors[i] = sys.exc_info()
+                    return
+
+        if len(self.push_pool) == 1:
+            push(0, self.push_pool[0])
+        else:
+            threads = [threading.Thread(target=push, args=(i, solr))
+                       for i, solr in enumerate(self.push_pool)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        if stats is not None:
+            stats.retries += sum(attempts)
+        for error in errors:
+            if error:
+                raise error[0], error[1], error[2]
+        return responses
 
     def add(self, *args, **kw):
         if 'commit' not in kw:
             kw['commit'] = self._commit
         if self.commitWithin and 'commitWithin' not in kw:
             kw['commitWithin'] = self.commitWithin
-        responses = []
-        for solr in self.push_pool:
-            responses.append(solr.add(*args, **kw))
-        return responses
+        return self._push('add', args, kw)
+
+    def bulk_add(self, docs, **kw):
+        """Stream `docs` (any iterable) to the push servers in chunks of
+        roughly `bulk_chunk_bytes`, and return a :class:`BulkIndexStats`.
+
+        Documents are made visible with `commitWithin` rather than explicit
+        commits.  Each chunk is retried on failing servers, and the chunk
+        size adapts to how fast the slowest server accepts it.  Chunks are
+        pushed synchronously, so `docs` is only consumed as fast as Solr
+        keeps up.
+        """
+        kw.setdefault('commit', False)
+        kw.setdefault('commitWithin', self.commitWithin or self.bulk_commit_within)
+        stats = BulkIndexStats()
+        chunk_bytes = self.bulk_chunk_bytes
+        chunk, size = [], 0
+        for doc in docs:
+            chunk.append(doc)
+            size += len(json.dumps(doc, default=unicode))
+            if size >= chunk_bytes:
+                chunk_bytes = self._bulk_push(chunk, size, chunk_bytes, stats, kw)
+                chunk, size = [], 0
+        if chunk:
+            self._bulk_push(chunk, size, chunk_bytes, stats, kw)
+        stats.stop()
+        return stats
+
+    def _bulk_push(self, chunk, size, chunk_bytes, stats, kw):
+        """Push one bulk_add chunk and return the next chunk size."""
+        start = time.time()
+        retries = stats.retries
+        self._push('add', (chunk,), kw, retries=self.bulk_retries, stats=stats)
+        elapsed = time.time() - start
+        stats.add(len(chunk), size)
+        if stats.retries > retries or elapsed > self.bulk_target_seconds:
+            chunk_bytes = max(self.bulk_min_chunk_bytes, chunk_bytes // 2)
+        elif elapsed < self.bulk_target_seconds / 4:
+            chunk_bytes = min(self.bulk_max_chunk_bytes, chunk_bytes * 2)
+        return chunk_bytes
+
+    def visible_after(self):
+        """Seconds until documents pushed by :meth:`bulk_add` are searchable"""
+        return int(self.commitWithin or self.bulk_commit_within) / 1000.0
 
     def delete(self, *args, **kw):
         if 'commit' not in kw:
             kw['commit'] = self._commit
-        responses = []
-        for solr in self.push_pool:
-            responses.append(solr.delete(*args, **kw))
-        return responses
+        return self._push('delete', args, kw)
 
     def commit(self, *args, **kw):
-        responses = []
-        for solr in self.push_pool:
-            responses.append(solr.commit(*args, **kw))
-        return responses
+        return self._push('commit', args, kw)
 
     def search(self, *args, **kw):
         return self.query_server.search(*args, **kw)
 
 
+class BulkIndexStats(object):
+
+    """Throughput report for :meth:`Solr.bulk_add`."""
+
+    def __init__(self):
+        self.docs = 0
+        self.bytes = 0
+        self.chunks = 0
+        self.retries = 0
+        self.start = time.time()
+        self.elapsed = 0.0
+
+    def add(self, docs, size):
+        self.docs += docs
+        self.bytes += size
+        self.chunks += 1
+
+    def stop(self):
+        self.elapsed = time.time() - self.start
+
+    def __iadd__(self, other):
+        self.docs += other.docs
+        self.bytes += other.bytes
+        self.chunks += other.chunks
+        self.retries += other.retries
+        self.elapsed += other.elapsed
+        return self
+
+    @property
+    def docs_per_sec(self):
+        if not self.elapsed:
+            return 0.0
+        return self.docs / self.elapsed
+
+    def __str__(self):
+        return '%d docs (%d bytes) in %d chunks, %.1fs, %.1f docs/sec, %d retries' % (
+            self.docs, self.bytes, self.chunks, self.elapsed, self.docs_per_sec, self.retries)
+
+
 class MockSOLR(object):
 
     class MockHits(list):
@@ -139,6 +285,17 @@ def add(self, objects):
             o['text'] = ''.join(o['text'])
             self.db[o['id']] = o
 
+    def bulk_add(self, docs, **kw):
+        docs = list(docs)
+        self.add(docs)
+        stats = BulkIndexStats()
+        stats.add(len(docs), 0)
+        stats.stop()
+        return stats
+
+    def visible_after(self):
+        return 0
+
     def commit(self):
         pass
 
@@ -664,6 +664,34 @@ def by_email_address(cls, addr):
                      'Using first one', [u.username for u in users], addr)
         return users[0] if len(users) > 0 else None
 
+    @classmethod
+    def by_email_addresses(cls, addrs):
+        '''Like by_email_address, for many addresses at once.  Returns a dict
+        of {address: user} for the addresses that have one.'''
+        canonical = {}
+        for addr in addrs:
+            email = addr and EmailAddress.canonical(addr)
+            if email:
+                canonical.setdefault(email, []).append(addr)
+        if not canonical:
+            return {}
+        addrs = EmailAddress.query.find(dict(
+            email={'$in': canonical.keys()}, confirmed=True)).all()
+        user_ids = list(set(ea.claimed_by_user_id for ea in addrs))
+        users = dict((u._id, u) for u in cls.query.find(dict(
+            _id={'$in': user_ids}, disabled=False, pending=False)))
+        result = {}
+        for ea in addrs:
+            user = users.get(ea.claimed_by_user_id)
+            if user is None:
+                continue
+            for addr in canonical[ea.email]:
+                if addr in result and result[addr] is not user:
+                    log.warn('Multiple active users matching confirmed email %s %s. '
+                             'Using first one', [result[addr].username, user.username], addr)
+                result.setdefault(addr, user)
+        return result
+
     @classmethod
     def by_username(cls, name):
         if not name:
@@ -673,6 +701,23 @@ def by_username(cls, name):
             return user
         return plugin.AuthenticationProvider.get(request).by_username(name)
 
+    @classmethod
+    def by_usernames(cls, names):
+        '''Like by_username, for many names at once.  Returns a dict of
+        {name: user} for the names that have one.'''
+        names = set(names)
+        result = dict((u.username, u) for u in cls.query.find(dict(
+            username={'$in': [n for n in names if n]})))
+        for name in names - set(result):
+            if not name:
+                user = cls.anonymous()
+            else:
+                # the auth provider may know users that aren't local yet
+                user = plugin.AuthenticationProvider.get(request).by_username(name)
+            if user is not None:
+                result[name] = user
+        return result
+
     def get_tool_data(self, tool, key, default=None):
         return self.tool_data.get(tool, {}).get(key, None)
 
@@ -0,0 +1,493 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+"""
+A compact on-disk index of a repository's commit graph, similar to git's
+commit-graph file with changed-path bloom filters.
+
+For every commit it stores the generation number, the parents and a bloom
+filter of the paths changed relative to the first parent, which is enough to
+answer most "last commits to change this path" queries without asking the
+SCM.  The index is kept outside the repo, under scm.commit_graph.root, and
+read through mmap.
+
+Like git's split commit-graph, the index is a chain of files.  Each refresh
+writes its new commits to a new file, merging it with the newest files of
+the chain when those aren't more than twice its size, so a push costs about
+the size of the push, and no file gets rewritten more than a logarithmic
+number of times.
+
+Layout of each file (all integers big endian)::
+
+    header   magic, number of commits, number of extra parent edges
+    ids      sorted commit ids, NUL padded to ID_SIZE bytes
+    records  generation, first parent, extra parents offset and count,
+             bloom offset and length -- one per commit, in id order
+    extra    positions of second and later parents
+    blooms   concatenated bloom filters
+"""
+
+import os
+import mmap
+import bisect
+import shutil
+import struct
+import hashlib
+import logging
+import tempfile
+from itertools import chain
+
+import tg
+
+from allura.lib import helpers as h
+from allura.lib import utils
+
+log = logging.getLogger(__name__)
+
+CHAIN = 'chain'
+MAGIC = 'ACG1'
+HEADER = struct.Struct('>4sII')
+RECORD = struct.Struct('>IiIHIH')
+EDGE = struct.Struct('>i')
+ID_SIZE = 40
+NO_PARENT = -1
+UNKNOWN_PARENT = -2
+
+BLOOM_BITS_PER_PATH = 10
+BLOOM_HASHES = 7
+BLOOM_MIN_BYTES = 8
+# commits changing more paths than this get an empty filter, which
+# matches every path
+BLOOM_MAX_PATHS = 512
+
+QSIZE = 100
+# a new file is merged into the newest file of the chain while that isn't
+# bigger than this many times the new one
+MERGE_FACTOR = 2
+
+
+def _path_key(path):
+    return h.really_unicode(path).strip('/').encode('utf-8')
+
+
+def path_hashes(path):
+    '''Return the pair of hashes used to place path in a bloom filter'''
+    return struct.unpack('>II', hashlib.md5(_path_key(path)).digest()[:8])
+
+
+def bloom_filter(paths):
+    '''Build a bloom filter containing each of paths'''
+    paths = set(_path_key(p) for p in paths)
+    if len(paths) > BLOOM_MAX_PATHS:
+        return ''
+    size = max(BLOOM_MIN_BYTES, (len(paths) * BLOOM_BITS_PER_PATH + 7) // 8)
+    bits = bytearray(size)
+    for path in paths:
+        h1, h2 = path_hashes(path)
+        for i in range(BLOOM_HASHES):
+            b = (h1 + i * h2) % (size * 8)
+            bits[b // 8] |= 1 << (b % 8)
+    return str(bits)
+
+
+def bloom_contains(bloom, hashes):
+    '''False if the path with the given hashes is definitely not in bloom'''
+    if not bloom:
+        return True
+    nbits = len(bloom) * 8
+    h1, h2 = hashes
+    for i in range(BLOOM_HASHES):
+        b = (h1 + i * h2) % nbits
+        if not ord(bloom[b // 8]) & (1 << (b % 8)):
+            return False
+    return True
+
+
+class _Layer(object):
+
+    '''One file of a commit graph chain'''
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as fp:
+            self._map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.num_commits, num_extra = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            self._map.close()
+            raise ValueError('%s is not a commit graph file' % filename)
+        self._ids_offset = HEADER.size
+        self._records_offset = self._ids_offset + self.num_commits * ID_SIZE
+        self._extra_offset = self._records_offset + self.num_commits * RECORD.size
+        self._bloom_offset = self._extra_offset + num_extra * EDGE.size
+
+    def close(self):
+        self._map.close()
+
+    def commit_id(self, pos):
+        start = self._ids_offset + pos * ID_SIZE
+        return self._map[start:start + ID_SIZE].rstrip('\0')
+
+    def position(self, key):
+        '''Binary search the sorted ids for key'''
+        lo, hi = 0, self.num_commits
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_id = self.commit_id(mid)
+            if mid_id < key:
+                lo = mid + 1
+            elif mid_id > key:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def record(self, pos):
+        return RECORD.unpack_from(self._map, self._records_offset + pos * RECORD.size)
+
+    def extra_parent(self, index):
+        return EDGE.unpack_from(self._map, self._extra_offset + index * EDGE.size)[0]
+
+    def bloom(self, offset, length):
+        start = self._bloom_offset + offset
+        return self._map[start:start + length]
+
+
+class CommitGraph(object):
+
+    '''
+    Read-only view of a commit graph index: a chain of files, oldest first,
+    listed in the CHAIN file of its directory.  Positions are numbered
+    across the whole chain, and each file only refers to commits in itself
+    or in the files before it, so new commits can be added as a new file
+    without touching the existing ones.
+    '''
+
+    def __init__(self, filenames):
+        self.filenames = list(filenames)
+        self._layers = []
+        self._bases = []
+        self.num_commits = 0
+        try:
+            for filename in self.filenames:
+                layer = _Layer(filename)
+                self._layers.append(layer)
+                self._bases.append(self.num_commits)
+                self.num_commits += layer.num_commits
+        except Exception:
+            self.close()
+            raise
+
+    @classmethod
+    def load(cls, path):
+        '''Return the CommitGraph in directory path, or None if there isn't a
+        usable one'''
+        chain = os.path.join(path, CHAIN)
+        if not os.path.exists(chain):
+            return None
+        try:
+            with open(chain) as fp:
+                names = [line.strip() for line in fp if line.strip()]
+            return cls([os.path.join(path, name) for name in names])
+        except Exception:
+            log.warn('Ignoring unreadable commit graph %s', path, exc_info=True)
+            return None
+
+    @classmethod
+    def write(cls, path, filenames):
+        '''Make the chain in directory path consist of filenames, and remove
+        any other files there'''
+        names = [os.path.basename(f) for f in filenames]
+        tmp_chain = os.path.join(path, CHAIN + '.tmp')
+        with open(tmp_chain, 'w') as fp:
+            fp.write(''.join(name + '\n' for name in names))
+        os.rename(tmp_chain, os.path.join(path, CHAIN))
+        for name in os.listdir(path):
+            if name != CHAIN and name not in names:
+                os.remove(os.path.join(path, name))
+
+    @classmethod
+    def write_layer(cls, path, commits, base=None):
+        '''
+        Write a file in directory path for commits, a dict of
+        {commit_id: (parent_ids, bloom)}, to go on the end of base's chain,
+        and return its name.  Parents in neither commits nor base (or None)
+        are recorded as unknown, and queries reaching them fall back to the
+        SCM.
+        '''
+        ids = sorted(commits)
+        first = base.num_commits if base else 0
+        positions = dict((cid, first + i) for i, cid in enumerate(ids))
+
+        def parent_position(parent_id):
+            if parent_id is None:
+                return UNKNOWN_PARENT
+            if parent_id in positions:
+                return positions[parent_id]
+            pos = base.position(parent_id) if base else None
+            return UNKNOWN_PARENT if pos is None else pos
+
+        generations = {}
+        for cid in ids:
+            # iterative, so long histories don't hit the recursion limit
+            stack = [cid]
+            while stack:
+                top = stack[-1]
+                if top in generations:
+                    stack.pop()
+                    continue
+                parents = [p for p in commits[top][0] if p in commits]
+                pending = [p for p in parents if p not in generations]
+                if pending:
+                    stack.extend(pending)
+                    continue
+                parent_gens = [generations[p] for p in parents]
+                if base:
+                    parent_gens.extend(
+                        base.generation(p) or 0
+                        for p in commits[top][0] if p is not None and p not in commits)
+                generations[top] = 1 + max(parent_gens or [0])
+                stack.pop()
+        filename = os.path.join(path, 'graph-%s' % hashlib.sha1(''.join(ids)).hexdigest())
+        tmp_filename = filename + '.tmp'
+        num_extra = sum(max(len(commits[cid][0]) - 1, 0) for cid in ids)
+        with open(tmp_filename, 'wb') as fp:
+            fp.write(HEADER.pack(MAGIC, len(ids), num_extra))
+            for cid in ids:
+                fp.write(str(cid).ljust(ID_SIZE, '\0'))
+            extra = []
+            bloom_offset = 0
+            for cid in ids:
+                parent_ids, bloom = commits[cid]
+                parents = [parent_position(p) for p in parent_ids]
+                fp.write(RECORD.pack(
+                    generations[cid],
+                    parents[0] if parents else NO_PARENT,
+                    len(extra),
+                    len(parents[1:]),
+                    bloom_offset,
+                    len(bloom)))
+                extra.extend(parents[1:])
+                bloom_offset += len(bloom)
+            for p in extra:
+                fp.write(EDGE.pack(p))
+            for cid in ids:
+                fp.write(commits[cid][1])
+        os.rename(tmp_filename, filename)
+        return filename
+
+    def close(self):
+        for layer in self._layers:
+            layer.close()
+
+    def layer_sizes(self):
+        return [layer.num_commits for layer in self._layers]
+
+    def _locate(self, pos):
+        i = bisect.bisect_right(self._bases, pos) - 1
+        return self._layers[i], pos - self._bases[i]
+
+    def commit_id(self, pos):
+        layer, local = self._locate(pos)
+        return layer.commit_id(local)
+
+    def position(self, commit_id):
+        key = str(commit_id)
+        # newest first, since that's what gets asked about most
+        for base, layer in reversed(zip(self._bases, self._layers)):
+            pos = layer.position(key)
+            if pos is not None:
+                return base + pos
+        return None
+
+    def generation(self, commit_id):
+        pos = self.position(commit_id)
+        if pos is None:
+            return None
+        layer, local = self._locate(pos)
+        return layer.record(local)[0]
+
+    def parents(self, pos):
+        layer, local = self._locate(pos)
+        gen, first, extra_offset, extra_count, bloom_offset, bloom_len = layer.record(local)
+        if first == NO_PARENT:
+            return []
+        return [first] + [layer.extra_parent(extra_offset + i) for i in range(extra_count)]
+
+    def bloom(self, pos):
+        layer, local = self._locate(pos)
+        return layer.bloom(*layer.record(local)[4:])
+
+    def iter_commits(self, start=0):
+        '''Yield (commit_id, parent_ids, bloom) for every indexed commit from
+        position start on; unknown parents are None'''
+        for pos in xrange(start, self.num_commits):
+            parent_ids = [self.commit_id(p) if p >= 0 else None
+                          for p in self.parents(pos)]
+            yield self.commit_id(pos), parent_ids, self.bloom(pos)
+
+    def path_log(self, commit_id, path, limit, entry_id):
+        '''
+        Return the ids of up to limit commits that changed path, newest
+        first, starting at commit_id, like `git log -- path`.
+
+        entry_id(commit_id, path) must return the id of the object at path
+        in a commit (None if there isn't one) and is used to weed out bloom
+        filter false positives.  Returns None if the index can't answer
+        exactly: when a merge commit may have touched the path, since the
+        SCM's history simplification depends on all of its parents, or when
+        more history is needed past the commit that added the path, since
+        it may have been renamed from elsewhere.
+        '''
+        pos = self.position(commit_id)
+        if pos is None:
+            return None
+        hashes = path_hashes(path)
+        result = []
+        entries = {}
+
+        def entry(cid):
+            # a commit's parent is looked at again on the next step
+            if cid not in entries:
+                entries[cid] = entry_id(cid, path)
+            return entries[cid]
+        try:
+            while len(result) < limit:
+                cid = self.commit_id(pos)
+                parents = self.parents(pos)
+                if UNKNOWN_PARENT in parents[:1]:
+                    return None
+                if bloom_contains(self.bloom(pos), hashes):
+                    if len(parents) > 1:
+                        return None
+                    parent_entry = entry(self.commit_id(parents[0])) if parents else None
+                    if entry(cid) != parent_entry:
+                        result.append(cid)
+                        if parents and parent_entry is None and len(result) < limit:
+                            # added here, maybe by a rename that the SCM
+                            # would follow back to the old name
+                            return None
+                if not parents:
+                    break
+                # a merge that didn't change path is treesame to its first
+                # parent, so that's the only history to follow
+                pos = parents[0]
+        except KeyError:
+            return None
+        return result
+
+
+def graph_path(repo):
+    '''The directory holding repo's commit graph'''
+    root = tg.config.get('scm.commit_graph.root') or os.path.join(
+        tg.config.get('cache_dir') or tempfile.gettempdir(), 'commit-graph')
+    return os.path.join(root, str(repo._id))
+
+
+def remove_commit_graph(repo):
+    shutil.rmtree(graph_path(repo), ignore_errors=True)
+
+
+def tree_entry_id(commit_id, path):
+    '''
+    Return the id of the object at path in the given commit, using the trees
+    stored during refresh, or None if the path doesn't exist.  Raises
+    KeyError if the trees aren't available.
+    '''
+    from allura.model.repository import CommitDoc, TreeDoc
+    ci = CommitDoc.m.get(_id=commit_id)
+    if ci is None or ci.tree_id is None:
+        raise KeyError(commit_id)
+    obj_id = ci.tree_id
+    for name in h.really_unicode(path).strip('/').split('/'):
+        tree = TreeDoc.m.get(_id=obj_id)
+        if tree is None:
+            raise KeyError(obj_id)
+        for entry in chain(tree.tree_ids, tree.blob_ids, tree.other_ids):
+            if entry.name == name:
+                obj_id = entry.id
+                break
+        else:
+            return None
+    return obj_id
+
+
+def update_commit_graph(repo, commit_ids):
+    '''
+    Add commit_ids to the repo's commit graph.  If there isn't one yet, the
+    whole history is indexed.  The commits must already have been refreshed
+    into mongo.
+    '''
+    from allura.model.repository import CommitDoc
+    path = graph_path(repo)
+    graph = CommitGraph.load(path)
+    if graph is None:
+        log.info('Building commit graph for %s', repo.full_fs_path)
+        remove_commit_graph(repo)
+        os.makedirs(path)
+        commit_ids = repo.all_commit_ids()
+        sizes = []
+    else:
+        sizes = graph.layer_sizes()
+    new_ids = []
+    seen = set()
+    for cid in commit_ids:
+        cid = str(cid)
+        if cid not in seen and (graph is None or graph.position(cid) is None):
+            new_ids.append(cid)
+        seen.add(cid)
+    if not new_ids:
+        if graph is not None:
+            graph.close()
+        return
+    # merge the newest files into the new one while they're not much bigger
+    keep = len(sizes)
+    merged = len(new_ids)
+    while keep and sizes[keep - 1] <= merged * MERGE_FACTOR:
+        keep -= 1
+        merged += sizes[keep]
+    commits = {}
+    relink = []
+    if graph is not None:
+        for cid, parent_ids, bloom in graph.iter_commits(sum(sizes[:keep])):
+            commits[cid] = (parent_ids, bloom)
+            if None in parent_ids:
+                relink.append(cid)
+        filenames = graph.filenames
+        graph.close()
+    else:
+        filenames = []
+    parents = {}
+    for chunk in utils.chunked_iter(new_ids + relink, QSIZE):
+        for ci in CommitDoc.m.find(dict(_id={'$in': list(chunk)}), validate=False):
+            parents[ci._id] = [str(p) for p in ci.parent_ids]
+    for cid in relink:
+        if cid in parents:
+            commits[cid] = (parents[cid], commits[cid][1])
+    # commits missing from mongo are left out; their children will just
+    # have an unknown parent
+    first_parents = [(cid, parents[cid][0] if parents[cid] else None)
+                     for cid in new_ids if cid in parents]
+    for cid, changed_paths in repo._impl.iter_changed_paths(first_parents):
+        commits[str(cid)] = (parents[cid], bloom_filter(changed_paths))
+    base = CommitGraph(filenames[:keep]) if keep else None
+    try:
+        filename = CommitGraph.write_layer(path, commits, base)
+    finally:
+        if base is not None:
+            base.close()
+    CommitGraph.write(path, filenames[:keep] + [filename])
+    log.info('Commit graph for %s has %d commits (%d new) in %d files',
+             repo.full_fs_path, sum(sizes[:keep]) + len(commits), len(new_ids), keep + 1)
@@ -17,14 +17,14 @@
 
 import re
 import logging
-from itertools import groupby
+from itertools import chain
 from cPickle import dumps, loads
 from collections import defaultdict
 from urllib import unquote
 
 import bson
 import pymongo
-from pylons import tmpl_context as c
+from pylons import tmpl_context as c, request
 
 from ming import collection, Field, Index
 from ming import schema as S
@@ -35,7 +35,7 @@
 from allura.lib import helpers as h
 
 from .session import main_doc_session, main_orm_session
-from .project import Project
+from .project import Project, AppConfig
 
 log = logging.getLogger(__name__)
 
@@ -49,6 +49,8 @@
         app_config_id=S.ObjectId(),
         artifact_id=S.Anything(if_missing=None))),
     Field('references', [str], index=True),
+    # hash of the document last sent to solr, see solr_doc_hash()
+    Field('solr_hash', str, if_missing=None),
     Index('artifact_reference.project_id'),  # used in ReindexCommand
 )
 
@@ -66,6 +68,13 @@
     Index('project_id', 'link'),
 )
 
+# bumped whenever the search index changes for a project or app_config
+SearchGenerationDoc = collection(
+    'search_generation', main_doc_session,
+    Field('_id', S.ObjectId()),
+    Field('generation', int, if_missing=0),
+)
+
 # Class definitions
 
 
@@ -91,6 +100,15 @@ def from_artifact(cls, artifact):
             session(obj).expunge(obj)
             return cls.query.get(_id=artifact.index_id())
 
+    @classmethod
+    def clear_solr_hashes(cls, project_id):
+        '''Forget what was indexed for a project, e.g. after deleting its docs
+        from solr, so the next add_artifacts doesn't skip them as unchanged.'''
+        cls.query.update(
+            {'artifact_reference.project_id': project_id},
+            {'$unset': {'solr_hash': 1}},
+            multi=True)
+
     @LazyProperty
     def artifact(self):
         '''Look up the artifact referenced'''
@@ -104,6 +122,25 @@ def artifact(self):
                           self._id, aref)
 
 
+class SearchGeneration(object):
+
+    '''Per project/app_config counter of search index changes, used to
+    invalidate :class:`allura.lib.search.SearchCache` entries in every
+    process at once.'''
+
+    @classmethod
+    def bump(cls, scope_ids):
+        for _id in set(scope_ids):
+            cls.query.update({'_id': _id}, {'$inc': {'generation': 1}}, upsert=True)
+
+    @classmethod
+    def get(cls, scope_ids):
+        '''Current generations, in ``scope_ids`` order.'''
+        gens = dict((g._id, g.generation) for g in cls.query.find(
+            {'_id': {'$in': list(scope_ids)}}, refresh=True))
+        return tuple(gens.get(_id, 0) for _id in scope_ids)
+
+
 class Shortlink(object):
 
     '''Collection mapping shorthand_ids for artifacts to ArtifactReferences'''
@@ -128,6 +165,66 @@ def __repr__(self):
     def lookup(cls, link):
         return cls.from_links(link)[link]
 
+    @LazyProperty
+    def cached_ref(self):
+        '''The :attr:`ref`, queried only once, or filled in for many
+        shortlinks at a time by :meth:`prefetch`'''
+        return self.ref
+
+    @classmethod
+    def prefetch(cls, links):
+        '''Look up many links at once, along with the references and
+        artifacts they point to, so that rendering can use :meth:`lookup` and
+        ``cached_ref.artifact`` without querying for each one.'''
+        shortlinks = [s for s in cls.from_links(*links).itervalues()
+                      if s is not None and 'cached_ref' not in s.__dict__]
+        if not shortlinks:
+            return
+        refs = dict((r._id, r) for r in ArtifactReference.query.find(dict(
+            _id={'$in': list(set(s.ref_id for s in shortlinks))})))
+        refs_by_cls = defaultdict(list)
+        for ref in refs.itervalues():
+            if 'artifact' not in ref.__dict__:
+                aref = ref.artifact_reference
+                refs_by_cls[aref.cls, aref.project_id].append(ref)
+        for (artifact_cls, project_id), cls_refs in refs_by_cls.iteritems():
+            artifact_ids = [r.artifact_reference.artifact_id for r in cls_refs]
+            try:
+                artifact_cls = loads(str(artifact_cls))
+                with h.push_context(project_id):
+                    artifacts = dict((a._id, a) for a in artifact_cls.query.find(
+                        dict(_id={'$in': artifact_ids})))
+            except Exception:
+                # leave them to ArtifactReference.artifact, which logs errors
+                continue
+            for ref in cls_refs:
+                ref.artifact = artifacts.get(ref.artifact_reference.artifact_id)
+        for s in shortlinks:
+            s.cached_ref = refs.get(s.ref_id)
+
+    @classmethod
+    def _request_cache(cls):
+        '''Shortlinks looked up so far in the current request'''
+        try:
+            return request.environ.setdefault('allura.shortlinks', {})
+        except TypeError:
+            # not in a request, e.g. a script; don't cache
+            return {}
+
+    @classmethod
+    def clear_request_cache(cls):
+        '''Forget the shortlinks looked up so far in the request, after
+        artifacts or tools that links may point to have changed'''
+        cls._request_cache().clear()
+
+    @classmethod
+    def _cache_key(cls, link):
+        # links are resolved relative to the current project and tool
+        project = getattr(c, 'project', None)
+        app_config = getattr(getattr(c, 'app', None), 'config', None)
+        return (link, getattr(project, '_id', None),
+                getattr(app_config, '_id', None))
+
     @classmethod
     def from_artifact(cls, a):
         result = cls.query.get(ref_id=a.index_id())
@@ -150,7 +247,26 @@ def from_artifact(cls, a):
 
     @classmethod
     def from_links(cls, *links):
-        '''Convert a sequence of shortlinks to the matching Shortlink objects'''
+        '''Convert a sequence of shortlinks to the matching Shortlink objects.
+        Results are remembered for the rest of the request.'''
+        cache = cls._request_cache()
+        result = {}
+        missing = []
+        for link in links:
+            key = cls._cache_key(link)
+            if key in cache:
+                result[link] = cache[key]
+            else:
+                missing.append(link)
+        if missing:
+            found = cls._from_links(*missing)
+            for link in missing:
+                cache[cls._cache_key(link)] = found[link]
+            result.update(found)
+        return result
+
+    @classmethod
+    def _from_links(cls, *links):
         if len(links):
             result = {}
             # Parse all the links
@@ -168,21 +284,36 @@ def from_links(cls, *links):
                 link={'$in': links_by_artifact.keys()},
                 project_id={'$in': list(project_ids)}
             ), validate=False)
-            matches_by_artifact = dict(
-                (link, list(matches))
-                for link, matches in groupby(q, key=lambda s: unquote(s.link)))
+            matches_by_artifact = defaultdict(list)
+            for m in q:
+                matches_by_artifact[unquote(m.link)].append(m)
+            # load each project and tool once, rather than once per match
+            matches = list(chain(*matches_by_artifact.values()))
+            projects = dict((p._id, p) for p in Project.query.find(dict(
+                _id={'$in': list(set(m.project_id for m in matches))})))
+            app_configs = dict((ac._id, ac) for ac in AppConfig.query.find(dict(
+                _id={'$in': list(set(m.app_config_id for m in matches))})))
+            installed = {}
+
+            def is_installed(m):
+                if m.app_config_id not in installed:
+                    app_config = app_configs.get(m.app_config_id)
+                    installed[m.app_config_id] = bool(
+                        app_config is not None and
+                        projects[m.project_id].app_instance(app_config))
+                return installed[m.app_config_id]
             for link, d in parsed_links.iteritems():
                 matches = matches_by_artifact.get(unquote(d['artifact']), [])
                 matches = (
                     m for m in matches
-                    if m.project.shortname == d['project'] and
-                    m.project.neighborhood_id == d['nbhd'] and
-                    m.app_config is not None and
-                    m.project.app_instance(m.app_config.options.mount_point))
+                    if m.project_id in projects and
+                    projects[m.project_id].shortname == d['project'] and
+                    projects[m.project_id].neighborhood_id == d['nbhd'] and
+                    is_installed(m))
                 if d['app']:
                     matches = (
                         m for m in matches
-                        if m.app_config.options.mount_point == d['app'])
+                        if app_configs[m.app_config_id].options.mount_point == d['app'])
                 result[link] = cls._get_correct_match(link, list(matches))
             return result
         else:
@@ -258,6 +389,7 @@ def _parse_link(cls, s):
 
 # Mapper definitions
 mapper(ArtifactReference, ArtifactReferenceDoc, main_orm_session)
+mapper(SearchGeneration, SearchGenerationDoc, main_orm_session)
 mapper(Shortlink, ShortlinkDoc, main_orm_session, properties=dict(
     ref_id=ForeignIdProperty(ArtifactReference),
     project_id=ForeignIdProperty('Project'),
@@ -16,7 +16,9 @@
 #       under the License.
 
 import sys
+import math
 import time
+import hashlib
 import traceback
 import logging
 from datetime import datetime, timedelta
@@ -24,7 +26,7 @@
 import pymongo
 from pylons import tmpl_context as c, app_globals as g
 from tg import config
-from paste.deploy.converters import asbool
+from paste.deploy.converters import asbool, asint
 
 import ming
 from ming.utils import LazyProperty
@@ -33,7 +35,7 @@
 from ming.orm.declarative import MappedClass
 
 from allura.lib.helpers import log_output, null_contextmanager
-from .session import task_orm_session
+from .session import task_orm_session, task_doc_session
 
 log = logging.getLogger(__name__)
 
@@ -58,6 +60,9 @@ class MonQTask(MappedClass):
         - args - ``*args`` to be sent to the task function
         - kwargs - ``**kwargs`` to be sent to the task function
         - result - if the task is complete, the return value. If in error, the traceback.
+        - coalesce_key - identifies equivalent posts that may be merged into this
+          task while it is still ready
+        - coalesced - number of posts merged into this task
     '''
     states = ('ready', 'busy', 'error', 'complete', 'skipped')
     result_types = ('keep', 'forget')
@@ -77,6 +82,14 @@ class __mongometa__:
                 # used by repo tarball status check, etc
                 'state', 'task_name', 'time_queue'
             ],
+            [
+                # used by MonQTask.post() to coalesce duplicate tasks
+                'coalesce_key', 'state'
+            ],
+            [
+                # used by MonQTask.stats()
+                'state', 'time_stop'
+            ],
         ]
 
     _id = FieldProperty(S.ObjectId)
@@ -97,6 +110,11 @@ class __mongometa__:
     args = FieldProperty([])
     kwargs = FieldProperty({None: None})
     result = FieldProperty(None, if_missing=None)
+    coalesce_key = FieldProperty(str, if_missing=None)
+    coalesced = FieldProperty(int, if_missing=0)
+
+    # max size of the merged list in a 'union' coalesced task
+    coalesce_max = 1000
 
     def __repr__(self):
         from allura import model as M
@@ -135,8 +153,23 @@ def post(cls,
              kwargs=None,
              result_type='forget',
              priority=10,
-             delay=0):
-        '''Create a new task object based on the current context.'''
+             delay=0,
+             coalesce=None):
+        '''Create a new task object based on the current context.
+
+        If ``coalesce`` is set and an equivalent task is still waiting in the
+        'ready' state, that task is returned instead of inserting a new one:
+
+            - ``coalesce=True`` merges posts with identical args and kwargs
+            - ``coalesce='union'`` merges posts with identical kwargs, adding
+              the items of the first positional arg (a list, e.g. ``ref_ids``)
+              to the existing task's list
+
+        Tasks are only merged when they share project, app and notification
+        context, so coalesced task functions must not depend on ``c.user``.
+        They must also have the same priority, and the waiting task must be
+        due to run no later than the new one would be (given ``delay``).
+        '''
         if args is None:
             args = ()
         if kwargs is None:
@@ -157,6 +190,16 @@ def post(cls,
             context['app_config_id'] = c.app.config._id
         if getattr(c, 'user', None):
             context['user_id'] = c.user._id
+        time_queue = datetime.utcnow() + timedelta(seconds=delay)
+        coalesce_key = None
+        if coalesce == 'union' and not (args and isinstance(args[0], (list, tuple))):
+            coalesce = None
+        if coalesce:
+            coalesce_key = cls._coalesce_key(
+                task_name, context, args, kwargs, priority, union=coalesce == 'union')
+            obj = cls._coalesce(coalesce_key, args, time_queue, union=coalesce == 'union')
+            if obj is not None:
+                return obj
         obj = cls(
             state='ready',
             priority=priority,
@@ -167,17 +210,61 @@ def post(cls,
             process=None,
             result=None,
             context=context,
-            time_queue=datetime.utcnow() + timedelta(seconds=delay))
+            coalesce_key=coalesce_key,
+            time_queue=time_queue)
         session(obj).flush(obj)
+        if not delay:
+            MonQWakeup.notify(task_name)
         return obj
 
     @classmethod
-    def get(cls, process='worker', state='ready', waitfunc=None, only=None):
+    def _coalesce_key(cls, task_name, context, args, kwargs, priority, union=False):
+        parts = [
+            task_name,
+            context['project_id'],
+            context['app_config_id'],
+            context['notifications_disabled'],
+            priority,
+            sorted(kwargs.items()),
+        ]
+        if not union:
+            parts.append(list(args))
+        return hashlib.md5(repr(parts)).hexdigest()
+
+    @classmethod
+    def _coalesce(cls, coalesce_key, args, time_queue, union=False):
+        '''Merge into a ready task with the same ``coalesce_key`` that is due
+        by ``time_queue``, if any, so merging never postpones work.  Matching
+        on state='ready' makes this atomic with respect to workers claiming
+        the task.'''
+        query = dict(
+            state='ready',
+            coalesce_key=coalesce_key,
+            time_queue={'$lte': time_queue})
+        update = {'$inc': dict(coalesced=1)}
+        if union:
+            # don't let a single task grow without bounds
+            query['args.0.%d' % cls.coalesce_max] = {'$exists': False}
+            update['$addToSet'] = {'args.0': {'$each': list(args[0])}}
+        try:
+            return cls.query.find_and_modify(
+                query=query,
+                update=update,
+                new=True)
+        except pymongo.errors.OperationFailure, exc:
+            if 'No matching object found' not in exc.args[0]:
+                raise
+
+    @classmethod
+    def get(cls, process='worker', state='ready', waitfunc=None, only=None, exclude=None):
         '''Get the highest-priority, oldest, ready task and lock it to the
         current process.  If no task is available and waitfunc is supplied, call
         the waitfunc before trying to get the task again.  If waitfunc is None
         and no tasks are available, return None.  If waitfunc raises a
-        StopIteration, stop waiting for a task
+        StopIteration, stop waiting for a task.
+
+        ``only`` limits the task names to get, and ``exclude`` leaves out
+        tasks names (e.g. the ones other taskd pools handle).
         '''
         sort = [
             ('priority', ming.DESCENDING),
@@ -188,6 +275,8 @@ def get(cls, process='worker', state='ready', waitfunc=None, only=None):
                 query['time_queue'] = {'$lte': datetime.utcnow()}
                 if only:
                     query['task_name'] = {'$in': only}
+                elif exclude:
+                    query['task_name'] = {'$nin': exclude}
                 obj = cls.query.find_and_modify(
                     query=query,
                     update={
@@ -209,6 +298,168 @@ def get(cls, process='worker', state='ready', waitfunc=None, only=None):
             except StopIteration:
                 return None
 
+    @classmethod
+    def get_batch(cls, process='worker', batch_size=1, waitfunc=None, only=None, exclude=None):
+        '''Get the highest-priority, oldest, ready task like :meth:`get`, plus
+        up to ``batch_size - 1`` more ready tasks with the same ``task_name``,
+        all locked to the current process.  Returns a list of tasks, empty if
+        :meth:`get` returned None.
+        '''
+        first = cls.get(process=process, waitfunc=waitfunc, only=only, exclude=exclude)
+        if first is None:
+            return []
+        tasks = [first]
+        if batch_size <= 1:
+            return tasks
+        query = dict(
+            state='ready',
+            task_name=first.task_name,
+            time_queue={'$lte': datetime.utcnow()})
+        sort = [
+            ('priority', ming.DESCENDING),
+            ('time_queue', ming.ASCENDING)]
+        candidates = cls.query.find(query).sort(sort).limit(batch_size - 1)
+        ids = [t._id for t in candidates]
+        if ids:
+            # state='ready' in the spec makes each claim atomic, so tasks
+            # grabbed by another worker in the meantime are skipped
+            cls.query.update(
+                dict(_id={'$in': ids}, state='ready'),
+                {'$set': dict(state='busy', process=process)},
+                multi=True)
+            claimed = cls.query.find(dict(
+                _id={'$in': ids}, state='busy', process=process),
+                refresh=True).sort(sort).all()
+            tasks.extend(claimed)
+        return tasks
+
+    # upper bounds (milliseconds) of the histogram buckets that wait and run
+    # times are counted in by stats(); the last bucket has no upper bound
+    stats_buckets = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000,
+                     30000, 60000, 300000, 900000, 3600000)
+
+    @classmethod
+    def stats(cls, windows=(timedelta(hours=1),), now=None):
+        '''Per task_name queue statistics, as a list of dicts sorted by name.
+
+        Queue depth (ready & busy counts, oldest ready task) is current.
+        ``windows`` holds, for each of the given (sliding) windows ending
+        ``now``, throughput (tasks/minute), error rate and p50/p95/p99 wait
+        and run times (seconds) of tasks that finished within it.  Note that
+        completed 'forget' tasks that were already purged can't be counted.
+
+        Mongo only returns counts per :attr:`stats_buckets` histogram bucket
+        (and the longest time in each), so the percentiles are the longest
+        time in the bucket the percentile falls into: an upper bound that is
+        never off by more than the bucket's width.
+        '''
+        if now is None:
+            now = datetime.utcnow()
+        windows = sorted(windows)
+        stats = {}
+
+        def entry(task_name):
+            return stats.setdefault(task_name, dict(
+                task_name=task_name, ready=0, busy=0, oldest_ready=None,
+                windows=[dict(
+                    minutes=w.total_seconds() / 60.0,
+                    count=0, errors=0, error_rate=0.0, throughput=0.0,
+                    wait_p50=None, wait_p95=None, wait_p99=None,
+                    run_p50=None, run_p95=None, run_p99=None)
+                    for w in windows]))
+
+        depth = cls.query.aggregate([
+            {'$match': {
+                'state': {'$in': ['ready', 'busy']},
+                'time_queue': {'$lte': now},
+            }},
+            {'$group': {
+                '_id': '$task_name',
+                'ready': {'$sum': {'$cond': [{'$eq': ['$state', 'ready']}, 1, 0]}},
+                'busy': {'$sum': {'$cond': [{'$eq': ['$state', 'busy']}, 1, 0]}},
+                'oldest_ready': {'$min': {'$cond': [
+                    {'$eq': ['$state', 'ready']}, '$time_queue', None]}},
+            }},
+        ], cursor={})
+        for d in depth:
+            e = entry(d['_id'])
+            e.update(ready=d['ready'], busy=d['busy'], oldest_ready=d['oldest_ready'])
+
+        # index of the shortest window each finished task falls in
+        window_expr = len(windows) - 1
+        for i in reversed(range(len(windows) - 1)):
+            window_expr = {'$cond': [
+                {'$gte': ['$time_stop', now - windows[i]]}, i, window_expr]}
+        finished = cls.query.aggregate([
+            {'$match': {
+                'state': {'$in': ['complete', 'error']},
+                'time_stop': {'$gte': now - windows[-1]},
+            }},
+            {'$project': {
+                'task_name': 1,
+                'state': 1,
+                'window': window_expr,
+                # date subtraction yields milliseconds
+                'wait': {'$subtract': ['$time_start', '$time_queue']},
+                'run': {'$subtract': ['$time_stop', '$time_start']},
+            }},
+            {'$project': {
+                'task_name': 1,
+                'state': 1,
+                'window': 1,
+                'wait': 1,
+                'run': 1,
+                'wait_bucket': cls._stats_bucket_expr('$wait'),
+                'run_bucket': cls._stats_bucket_expr('$run'),
+            }},
+            {'$group': {
+                '_id': {
+                    'task_name': '$task_name',
+                    'window': '$window',
+                    'wait': '$wait_bucket',
+                    'run': '$run_bucket',
+                },
+                'count': {'$sum': 1},
+                'errors': {'$sum': {'$cond': [{'$eq': ['$state', 'error']}, 1, 0]}},
+                'wait_max': {'$max': '$wait'},
+                'run_max': {'$max': '$run'},
+            }},
+        ], cursor={}, allowDiskUse=True)
+        # a task that finished in a window also finished in all longer ones
+        hists = {}
+        for d in finished:
+            for i in range(d['_id']['window'], len(windows)):
+                e = entry(d['_id']['task_name'])['windows'][i]
+                e['count'] += d['count']
+                e['errors'] += d['errors']
+                for key in ('wait', 'run'):
+                    bucket = d['_id'][key]
+                    if bucket is None:
+                        continue
+                    hist = hists.setdefault((d['_id']['task_name'], i, key), {})
+                    count, longest = hist.get(bucket, (0, 0))
+                    hist[bucket] = (count + d['count'], max(longest, d[key + '_max']))
+        for s in stats.itervalues():
+            for i, e in enumerate(s['windows']):
+                if not e['count']:
+                    continue
+                e.update(error_rate=float(e['errors']) / e['count'],
+                         throughput=e['count'] / e['minutes'])
+                for key in ('wait', 'run'):
+                    hist = hists.get((s['task_name'], i, key), {})
+                    for pct in (50, 95, 99):
+                        e['%s_p%d' % (key, pct)] = _histogram_percentile(hist, pct)
+        return [stats[k] for k in sorted(stats)]
+
+    @classmethod
+    def _stats_bucket_expr(cls, field):
+        '''Aggregation expression for the index of the stats_buckets bucket
+        that field falls in, or null if field is null'''
+        expr = len(cls.stats_buckets)
+        for i in reversed(range(len(cls.stats_buckets))):
+            expr = {'$cond': [{'$lt': [field, cls.stats_buckets[i]]}, i, expr]}
+        return {'$cond': [{'$eq': [field, None]}, None, expr]}
+
     @classmethod
     def timeout_tasks(cls, older_than):
         '''Mark all busy tasks older than a certain datetime as 'ready' again.
@@ -291,3 +542,123 @@ def list(cls, state='ready'):
         '''Print all tasks of a certain status to sys.stdout.  Used for debugging.'''
         for t in cls.query.find(dict(state=state)):
             sys.stdout.write('%r\n' % t)
+
+
+def _histogram_percentile(hist, pct):
+    '''
+    Nearest-rank percentile (in seconds) of a histogram of millisecond times,
+    given as {bucket index: (count, longest time)}, or None if it is empty.
+    '''
+    total = sum(count for count, longest in hist.itervalues())
+    if not total:
+        return None
+    rank = max(int(math.ceil(pct / 100.0 * total)), 1)
+    seen = 0
+    for bucket in sorted(hist):
+        count, longest = hist[bucket]
+        seen += count
+        if seen >= rank:
+            return longest / 1000.0
+
+
+class MonQWakeup(object):
+
+    '''Push-based wakeup channel for idle taskd workers.
+
+    :meth:`MonQTask.post` appends a tiny document to a capped collection in
+    the task database, and idle workers wait on a tailable cursor over that
+    collection instead of sleeping for ``monq.poll_interval`` seconds.  The
+    poll interval is kept as an upper bound on the wait, so a lost signal (or
+    a delayed task becoming ready) is still picked up by regular polling.
+
+    Enabled with ``monq.wakeup = true``.
+    '''
+    collection_name = 'monq_signal'
+    # names of the databases the collection is known to exist in
+    _created = set()
+
+    def __init__(self, only=None, exclude=None):
+        self.only = only
+        self.exclude = exclude
+        self._cursor = None
+        self._last_id = None
+        coll = self.collection()
+        if coll is not None:
+            last = list(coll.find().sort('$natural', pymongo.DESCENDING).limit(1))
+            if last:
+                self._last_id = last[0]['_id']
+
+    @classmethod
+    def enabled(cls):
+        return asbool(config.get('monq.wakeup', False))
+
+    @classmethod
+    def collection(cls):
+        '''The capped signal collection, created on first use in each
+        process (so posting a task doesn't cost an extra round trip).'''
+        if not cls.enabled():
+            return None
+        db = task_doc_session.db
+        if db.name not in cls._created:
+            try:
+                db.create_collection(
+                    cls.collection_name, capped=True,
+                    size=asint(config.get('monq.wakeup.size', 1024 * 1024)))
+                # a tailable cursor on an empty capped collection dies
+                # immediately, so always keep one document in it
+                db[cls.collection_name].insert(dict(task_name=None))
+            except pymongo.errors.CollectionInvalid:
+                pass  # already created, maybe by another process just now
+            cls._created.add(db.name)
+        return db[cls.collection_name]
+
+    @classmethod
+    def notify(cls, task_name):
+        '''Wake up workers waiting for ``task_name``.  Never fails the post.'''
+        try:
+            coll = cls.collection()
+            if coll is not None:
+                coll.insert(dict(task_name=task_name), w=0)
+        except Exception:
+            log.exception('Could not signal taskd workers for %s', task_name)
+
+    def wait(self, timeout):
+        '''Block until a relevant task is posted or ``timeout`` seconds pass.
+
+        Returns True if woken up by a signal, False on timeout.
+        '''
+        coll = self.collection()
+        if coll is None:
+            time.sleep(timeout)
+            return False
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self._cursor is None or not self._cursor.alive:
+                spec = {}
+                if self._last_id is not None:
+                    spec['_id'] = {'$gt': self._last_id}
+                self._cursor = coll.find(spec, tailable=True, await_data=True)
+            try:
+                doc = self._cursor.next()
+            except StopIteration:
+                if not self._cursor.alive:
+                    self._cursor = None
+                    time.sleep(min(1, max(0, deadline - time.time())))
+                continue
+            except pymongo.errors.PyMongoError:
+                log.exception('Error waiting on %s, falling back to polling',
+                              self.collection_name)
+                self._cursor = None
+                time.sleep(max(0, deadline - time.time()))
+                return False
+            self._last_id = doc['_id']
+            if self._wanted(doc.get('task_name')):
+                return True
+        return False
+
+    def _wanted(self, task_name):
+        if not task_name:
+            return False
+        if self.only:
+            return task_name in self.only
+        return not self.exclude or task_name not in self.exclude
@@ -844,6 +844,9 @@ def uninstall_app(self, mount_point):
             self.support_page = ''
         with h.push_config(c, project=self, app=app):
             app.uninstall(self)
+        # links to the tool's artifacts no longer resolve
+        from .index import Shortlink
+        Shortlink.clear_request_cache()
 
     def app_instance(self, mount_point_or_config):
         if isinstance(mount_point_or_config, AppConfig):
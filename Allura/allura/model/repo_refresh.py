@@ -24,6 +24,7 @@
 
 import tg
 import jinja2
+from paste.deploy.converters import asbool
 from pylons import tmpl_context as c, app_globals as g
 
 from ming.base import Object
@@ -34,6 +35,8 @@
 from allura.model.repository import CommitDoc, TreeDoc, TreesDoc
 from allura.model.repository import CommitRunDoc
 from allura.model.repository import Commit, Tree, LastCommit, ModelCache
+from allura.model.repository import discard_shared_commits
+from allura.model.commit_graph import update_commit_graph, remove_commit_graph
 from allura.model.index import ArtifactReferenceDoc, ShortlinkDoc
 from allura.model.auth import User
 from allura.model.timeline import TransientActor
@@ -44,10 +47,24 @@
 
 
 def refresh_repo(repo, all_commits=False, notify=True, new_clone=False):
-    all_commit_ids = commit_ids = list(repo.all_commit_ids())
-    if not commit_ids:
+    ref_heads = repo.ref_heads()
+    if not ref_heads:
         # the repo is empty, no need to continue
         return
+    all_commit_ids = None
+    commit_ids = None
+    if not all_commits and repo.refreshed_heads:
+        # Only walk the commits reachable from the new heads; a None result
+        # means history was rewritten and we need the full scan below
+        commit_ids = repo.commit_ids_since(repo.refreshed_heads, ref_heads)
+    if commit_ids is None:
+        all_commit_ids = commit_ids = list(repo.all_commit_ids())
+        if not commit_ids:
+            return
+    else:
+        log.info('Found %d commits since last refresh of %s',
+                 len(commit_ids), repo.full_fs_path)
+    repo_commit_ids = commit_ids
     new_commit_ids = unknown_commit_ids(commit_ids)
     stats_log = h.log_action(log, 'commit')
     for ci in new_commit_ids:
@@ -63,12 +80,9 @@ def refresh_repo(repo, all_commits=False, notify=True, new_clone=False):
 
     # Refresh commits
     seen = set()
-    for i, oid in enumerate(commit_ids):
-        repo.refresh_commit_info(oid, seen, not all_commits)
-        if (i + 1) % 100 == 0:
-            log.info('Refresh commit info %d: %s', (i + 1), oid)
+    repo.refresh_commit_info_batch(commit_ids, seen, not all_commits)
 
-    refresh_commit_repos(all_commit_ids, repo)
+    refresh_commit_repos(repo_commit_ids, repo)
 
     # Refresh child references
     for i, oid in enumerate(commit_ids):
@@ -85,7 +99,12 @@ def refresh_repo(repo, all_commits=False, notify=True, new_clone=False):
         # a CommitRunDoc that contains the last known commit. If there isn't one,
         # the CommitRuns for this repo are in a bad state - rebuild them
         # entirely.
-        if commit_run_ids != all_commit_ids:
+        if all_commit_ids is None:
+            known_ids = [hd.object_id for hd in repo.refreshed_heads]
+            if not CommitRunDoc.m.find(dict(commit_ids={'$in': known_ids})).count():
+                log.info('CommitRun incomplete, rebuilding with all commits')
+                all_commit_ids = commit_run_ids = list(repo.all_commit_ids())
+        elif commit_run_ids != all_commit_ids:
             last_commit = last_known_commit_id(all_commit_ids, new_commit_ids)
             log.info('Last known commit id: %s', last_commit)
             if not CommitRunDoc.m.find(dict(commit_ids=last_commit)).count():
@@ -132,24 +151,32 @@ def refresh_repo(repo, all_commits=False, notify=True, new_clone=False):
     if repo.cached_tags:
         repo.cached_tags = []
         session(repo).flush()
-    # The first view can be expensive to cache,
-    # so we want to do it here instead of on the first view.
-    repo.get_branches()
-    repo.get_tags()
+    # Must happen before refreshed_heads is updated below, since the refs
+    # that changed are worked out from it
+    repo.update_ref_index(ref_heads)
+    session(repo).flush(repo)
+    if not repo.refs_indexed:
+        # The first view can be expensive to cache,
+        # so we want to do it here instead of on the first view.
+        repo.get_branches()
+        repo.get_tags()
+
+    if repo._commit_graph and asbool(tg.config.get('scm.commit_graph', True)):
+        try:
+            update_commit_graph(repo, repo_commit_ids)
+        except Exception:
+            # a stale graph could give wrong answers; remove it, and it'll be
+            # rebuilt from scratch next time
+            log.exception('Error updating commit graph for %s', repo.full_fs_path)
+            remove_commit_graph(repo)
+
+    # Remember the heads we've seen, so the next refresh only has to look at
+    # commits that were pushed since
+    repo.refreshed_heads = ref_heads
+    session(repo).flush(repo)
 
     if not all_commits and not new_clone:
-        for commit in commit_ids:
-            new = repo.commit(commit)
-            user = User.by_email_address(new.committed.email)
-            if user is None:
-                user = User.by_username(new.committed.name)
-            if user is not None:
-                g.statsUpdater.newCommit(new, repo.app_config.project, user)
-            actor = user or TransientActor(
-                    activity_name=new.committed.name or new.committed.email)
-            g.director.create_activity(actor, 'committed', new,
-                                       related_nodes=[repo.app_config.project],
-                                       tags=['commit', repo.tool.lower()])
+        send_commit_activities(repo, commit_ids)
 
         from allura.webhooks import RepoPushWebhookSender
         by_branches, by_tags = _group_commits(repo, commit_ids)
@@ -171,6 +198,46 @@ def refresh_repo(repo, all_commits=False, notify=True, new_clone=False):
         send_notifications(repo, commit_ids)
 
 
+def send_commit_activities(repo, commit_ids):
+    '''Update user stats and create 'committed' activities for new commits.
+    Committers are looked up once per distinct email and name, rather than
+    once per commit.'''
+    commits = []
+    for chunk in utils.chunked_iter(commit_ids, QSIZE):
+        chunk = list(chunk)
+        found = dict((ci._id, ci) for ci in Commit.query.find(
+            dict(_id={'$in': chunk})))
+        for oid in chunk:
+            ci = found.get(oid)
+            if ci is not None:
+                ci.set_context(repo)
+                commits.append(ci)
+    if not commits:
+        return
+    users_by_email = User.by_email_addresses(
+        set(ci.committed.email for ci in commits))
+    users_by_name = User.by_usernames(
+        set(ci.committed.name for ci in commits
+            if ci.committed.email not in users_by_email))
+    project = repo.app_config.project
+    by_user = OrderedDict()
+    activities = []
+    for ci in commits:
+        user = users_by_email.get(ci.committed.email)
+        if user is None:
+            user = users_by_name.get(ci.committed.name)
+        if user is not None:
+            by_user.setdefault(user._id, (user, []))[1].append(ci)
+        actor = user or TransientActor(
+            activity_name=ci.committed.name or ci.committed.email)
+        activities.append(dict(actor=actor, verb='committed', obj=ci,
+                               related_nodes=[project],
+                               tags=['commit', repo.tool.lower()]))
+    for user, user_commits in by_user.itervalues():
+        g.statsUpdater.newCommits(user_commits, project, user)
+    g.director.create_activities(activities)
+
+
 def refresh_commit_trees(ci, cache):
     '''Refresh the list of trees included withn a commit'''
     if ci.tree_id is None:
@@ -189,8 +256,9 @@ def refresh_commit_repos(all_commit_ids, repo):
     '''Refresh the list of repositories within which a set of commits are
     contained'''
     for oids in utils.chunked_iter(all_commit_ids, QSIZE):
+        oids = list(oids)
         for ci in CommitDoc.m.find(dict(
-                _id={'$in': list(oids)},
+                _id={'$in': oids},
                 repo_ids={'$ne': repo._id})):
             oid = ci._id
             ci.repo_ids.append(repo._id)
@@ -222,6 +290,7 @@ def refresh_commit_repos(all_commit_ids, repo):
             ref.m.save(safe=False, validate=False)
             link0.m.save(safe=False, validate=False)
             link1.m.save(safe=False, validate=False)
+        discard_shared_commits(oids)
 
 
 def refresh_children(ci):
@@ -230,6 +299,7 @@ def refresh_children(ci):
         dict(_id={'$in': ci.parent_ids}),
         {'$addToSet': dict(child_ids=ci._id)},
         multi=True)
+    discard_shared_commits(ci.parent_ids)
 
 
 class CommitRunBuilder(object):
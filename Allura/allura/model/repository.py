@@ -21,13 +21,15 @@
 import logging
 import string
 import re
+import errno
+import fcntl
 from subprocess import Popen, PIPE
 from hashlib import sha1
 from datetime import datetime, timedelta
-from time import time
+from time import time, sleep
 from collections import defaultdict, OrderedDict
 from urlparse import urljoin
-from threading import Thread
+from threading import Thread, Lock
 from Queue import Queue
 from itertools import chain, islice
 from difflib import SequenceMatcher
@@ -43,7 +45,7 @@
 from ming import schema as S
 from ming import Field, collection, Index
 from ming.utils import LazyProperty
-from ming.orm import FieldProperty, session, Mapper, mapper
+from ming.orm import FieldProperty, session, state, Mapper, mapper
 from ming.base import Object
 
 from allura.lib import helpers as h
@@ -98,6 +100,10 @@
 
 DIFF_SIMILARITY_THRESHOLD = .5  # used for determining file renames
 
+# reading archives that are being built by another request
+TARBALL_CHUNK_SIZE = 64 * 1024
+TARBALL_POLL_INTERVAL = .2
+
 
 class RepositoryImplementation(object):
 
@@ -122,6 +128,38 @@ def new_commits(self, all_commits=False):  # pragma no cover
         '''
         raise NotImplementedError('new_commits')
 
+    def ref_heads(self):  # pragma no cover
+        '''Return a list of dict(name=, object_id=) for every ref (branch or
+        tag) in the repo, read directly from the repo on disk rather than
+        through any cached branch/tag lists.'''
+        raise NotImplementedError('ref_heads')
+
+    def commit_ids_since(self, old_heads, new_heads):
+        '''Return the ids of commits reachable from new_heads but not from
+        old_heads, heads first, without walking the rest of the history.
+
+        Both arguments are lists as returned by ref_heads().  Returns None if
+        the new commits can't be found incrementally (e.g., history was
+        rewritten), in which case the caller should fall back to
+        all_commit_ids().
+        '''
+        return None
+
+    def ref_kind(self, refname):
+        '''Return ('branch', name) or ('tag', name) for a ref name from
+        ref_heads(), or None if it's neither.  Only repos whose refs can be
+        told apart like this get a ref index (see :class:`RepoRefDoc`); the
+        default is None, for SCMs without real branches or tags.'''
+        return None
+
+    def iter_changed_paths(self, commits):  # pragma no cover
+        '''Given a list of (commit_id, first_parent_id) pairs, yield
+        (commit_id, changed_paths) for each, where changed_paths includes
+        the directories containing changes and is relative to the first
+        parent (or everything, for a root commit).  Used to build the
+        commit graph index, see :mod:`allura.model.commit_graph`.'''
+        raise NotImplementedError('iter_changed_paths')
+
     def commit_parents(self, commit):  # pragma no cover
         '''Return a list of native commits for the parents of the given (native)
         commit'''
@@ -131,6 +169,14 @@ def refresh_commit_info(self, oid, lazy=True):  # pragma no cover
         '''Refresh the data in the commit with id oid'''
         raise NotImplementedError('refresh_commit_info')
 
+    def refresh_commit_info_batch(self, oids, seen, lazy=True):
+        '''Refresh the data for many commits at once.  Implementations can
+        override this to read and store the commits in bulk.'''
+        for i, oid in enumerate(oids):
+            self.refresh_commit_info(oid, seen, lazy)
+            if (i + 1) % 100 == 0:
+                log.info('Refresh commit info %d: %s', (i + 1), oid)
+
     def _setup_hooks(self, source_path=None):  # pragma no cover
         '''Install a hook in the repository that will ping the refresh url for
         the repo.  Optionally provide a path from which to copy existing hooks.'''
@@ -175,6 +221,15 @@ def tarball(self, revision, path=None):
         '''Create a tarball for the revision'''
         raise NotImplementedError('tarball')
 
+    def tarball_stream(self, revision, path=None):
+        '''
+        Return an iterator over the chunks of a zip archive for the revision,
+        which is built as it is read, or None if the implementation can only
+        build archives with :meth:`tarball`.  Closing the iterator stops the
+        archiving.
+        '''
+        return None
+
     def is_empty(self):
         '''Determine if the repository is empty by checking the filesystem'''
         raise NotImplementedError('is_empty')
@@ -256,12 +311,21 @@ def last_commit_ids(self, commit, paths):
         Each thread will call :meth:`_get_last_commit` to get the
         commit ID and list of changed files for the last commit
         to touch any file in a given chunk.
+
+        If ``lcd_single_pass`` is enabled (the default) and the
+        implementation supports :meth:`_iter_path_changes`, all paths
+        are instead resolved by a single walk of the history.
         '''
         if not paths:
             return {}
         timeout = float(tg.config.get('lcd_timeout', 60))
         start_time = time()
         paths = list(set(paths))  # remove dupes
+        if asbool(tg.config.get('lcd_single_pass', True)):
+            changes = self._iter_path_changes(commit._id, paths, timeout=timeout)
+            if changes is not None:
+                return self._last_commit_ids_single_pass(
+                    commit, paths, changes, start_time, timeout)
         result = {}  # will be appended to from each thread
         chunks = Queue()
         lcd_chunk_size = asint(tg.config.get('lcd_thread_chunk_size', 10))
@@ -309,6 +373,38 @@ def get_ids():
                 chunks.all_tasks_done.release()
         return result
 
+    def _last_commit_ids_single_pass(self, commit, paths, changes, start_time, timeout):
+        result = {}
+        paths = set(paths)
+        try:
+            for commit_id, changed_files in changes:
+                if time() - start_time >= timeout:
+                    log.error('last_commit_ids timeout for %s on %s',
+                              commit._id, ', '.join(paths))
+                    break
+                changed = prefix_paths_union(paths, changed_files)
+                for path in changed:
+                    result[path] = commit_id
+                paths -= changed
+                if not paths:
+                    break
+        except Exception as e:
+            log.exception('Error in SCM history walk: %s', e)
+        finally:
+            # stop the walk as soon as every path is resolved
+            changes.close()
+        return result
+
+    def _iter_path_changes(self, commit_id, paths, timeout=None):
+        '''
+        Return a generator of (commit_id, changed_files) for each commit
+        touching any of the given paths, newest first, starting from
+        commit_id, or None if the implementation can't stream path history.
+        The generator stops after timeout seconds, even while it's waiting
+        on the SCM for the next commit.
+        '''
+        return None
+
     def _get_last_commit(self, commit_id, paths):
         """
         For a given commit ID and set of paths / files,
@@ -334,6 +430,37 @@ def paged_diffs(self, commit_id, start=0, end=None, onlyChangedFiles=False):
         """
         raise NotImplementedError('paged_diffs')
 
+    def changed_files(self, commit_id, onlyChangedFiles=False):
+        """
+        Returns the files touched by the commit, in the order the SCM lists
+        them, as (status, path) pairs, where path is a dict of 'old', 'new'
+        and 'ratio' for copies and renames.
+
+        The list is kept in :data:`repo_object_cache`, so that paging through
+        a commit which touches many files asks the SCM only once.
+        """
+        key = self._changed_files_key(commit_id, onlyChangedFiles)
+        if repo_object_cache.enabled:
+            doc = repo_object_cache.get(key)
+            if doc is not None:
+                return [tuple(f) for f in doc['files']]
+        files = self._changed_files(commit_id, onlyChangedFiles)
+        if files is None:
+            # couldn't be found out this time, so don't cache that
+            return []
+        files = list(files)
+        if repo_object_cache.enabled:
+            repo_object_cache.set(key, dict(files=files))
+        return files
+
+    def _changed_files_key(self, commit_id, onlyChangedFiles):
+        return ('changed_files', commit_id, onlyChangedFiles)
+
+    def _changed_files(self, commit_id, onlyChangedFiles):
+        """Returns or generates the (status, path) pairs for
+        :meth:`changed_files`, or None if they can't be found out"""
+        raise NotImplementedError('_changed_files')
+
     def merge_request_commits(self, mr):
         """Given MergeRequest :param mr: return list of commits to be merged"""
         raise NotImplementedError('merge_request_commits')
@@ -349,6 +476,9 @@ class __mongometa__:
     repo_id = 'repo'
     type_s = 'Repository'
     _refresh_precompute = True
+    # whether refresh maintains a commit graph index, see
+    # allura.model.commit_graph
+    _commit_graph = False
 
     name = FieldProperty(str)
     tool = FieldProperty(str)
@@ -364,6 +494,8 @@ class __mongometa__:
     default_branch_name = FieldProperty(str)
     cached_branches = FieldProperty([dict(name=str, object_id=str)])
     cached_tags = FieldProperty([dict(name=str, object_id=str)])
+    refreshed_heads = FieldProperty([dict(name=str, object_id=str)])
+    refs_indexed = FieldProperty(bool, if_missing=False)
 
     def __init__(self, **kw):
         if 'name' in kw and 'tool' in kw:
@@ -445,6 +577,15 @@ def all_commit_ids(self):
     def refresh_commit_info(self, oid, seen, lazy=True):
         return self._impl.refresh_commit_info(oid, seen, lazy)
 
+    def refresh_commit_info_batch(self, oids, seen, lazy=True):
+        return self._impl.refresh_commit_info_batch(oids, seen, lazy)
+
+    def ref_heads(self):
+        return self._impl.ref_heads()
+
+    def commit_ids_since(self, old_heads, new_heads):
+        return self._impl.commit_ids_since(old_heads, new_heads)
+
     def open_blob(self, blob):
         return self._impl.open_blob(blob)
 
@@ -505,6 +646,83 @@ def get_tags(self):
         """
         return self._impl.tags
 
+    def update_ref_index(self, new_heads):
+        '''
+        Bring the ref index up to date with new_heads, as returned by
+        ref_heads().  Only the refs that changed since the last refresh
+        (refreshed_heads) are written, unless the index hasn't been built yet.
+        '''
+        new = dict((hd['name'], hd['object_id']) for hd in new_heads)
+        if not self.refs_indexed:
+            docs = []
+            for name, object_id in new.iteritems():
+                kind = self._impl.ref_kind(name)
+                if kind is not None:
+                    docs.append(dict(repo_id=self._id, kind=kind[0],
+                                     name=kind[1], object_id=object_id))
+            if not docs:
+                return
+            # clear out anything left from an earlier, unfinished build
+            RepoRefDoc.m.remove(dict(repo_id=self._id))
+            for chunk in utils.chunked_iter(docs, 1000):
+                RepoRefDoc.m.collection.insert(list(chunk))
+            self.refs_indexed = True
+            return
+        old = dict((hd['name'], hd['object_id'])
+                   for hd in self.refreshed_heads or [])
+        for name, object_id in new.iteritems():
+            kind = self._impl.ref_kind(name)
+            if kind is None or old.get(name) == object_id:
+                continue
+            RepoRefDoc.m.update_partial(
+                dict(repo_id=self._id, kind=kind[0], name=kind[1]),
+                {'$set': dict(object_id=object_id)},
+                upsert=True)
+        for name in set(old) - set(new):
+            kind = self._impl.ref_kind(name)
+            if kind is not None:
+                RepoRefDoc.m.remove(
+                    dict(repo_id=self._id, kind=kind[0], name=kind[1]))
+
+    def find_refs(self, kind, prefix=None, page=0, limit=None):
+        '''
+        Return a page of the repo's branches (kind='branch') or tags
+        (kind='tag') whose names start with prefix, ordered by name, and how
+        many of them there are in all.  With no limit, every match is
+        returned.
+
+        Served from the ref index when the repo has one, so that huge
+        numbers of refs never have to be loaded at once.
+        '''
+        prefix = h.really_unicode(prefix or '')
+        if self.refs_indexed:
+            q = dict(repo_id=self._id, kind=kind)
+            if prefix:
+                q['name'] = re.compile('^' + re.escape(prefix))
+            cursor = RepoRefDoc.m.find(q).sort('name', pymongo.ASCENDING)
+            count = cursor.count()
+            if limit:
+                cursor = cursor.skip(page * limit).limit(limit)
+            refs = [Object(name=r.name, object_id=r.object_id) for r in cursor]
+            return refs, count
+        refs = self.get_branches() if kind == 'branch' else self.get_tags()
+        refs = [r for r in refs if h.really_unicode(r.name).startswith(prefix)]
+        count = len(refs)
+        if limit:
+            refs = refs[page * limit:(page + 1) * limit]
+        return refs, count
+
+    def refs_for_commit(self, commit_id):
+        '''Return the names of the branches and of the tags pointing at
+        commit_id, from the ref index, or None if there isn't one.'''
+        if not self.refs_indexed:
+            return None
+        branches, tags = [], []
+        q = dict(repo_id=self._id, object_id=commit_id)
+        for r in RepoRefDoc.m.find(q).sort('name', pymongo.ASCENDING):
+            (branches if r.kind == 'branch' else tags).append(r.name)
+        return branches, tags
+
     @property
     def head(self):
         return self._impl.head
@@ -558,9 +776,27 @@ def log(self, revs=None, path=None, exclude=None, id_only=True, limit=None, **kw
             revs = [revs]
         if exclude is not None and not isinstance(exclude, (list, tuple)):
             exclude = [exclude]
+        if path and id_only and limit and not exclude and not kw and revs and len(revs) == 1:
+            commit_ids = self._commit_graph_log(revs[0], path, limit)
+            if commit_ids is not None:
+                return iter(commit_ids)
         log_iter = self._impl.log(revs, path, exclude=exclude, id_only=id_only, limit=limit, **kw)
         return islice(log_iter, limit)
 
+    @LazyProperty
+    def commit_graph(self):
+        '''The commit graph index built during refresh, if there is one'''
+        from allura.model.commit_graph import CommitGraph, graph_path
+        if not self._commit_graph or not asbool(tg.config.get('scm.commit_graph', True)):
+            return None
+        return CommitGraph.load(graph_path(self))
+
+    def _commit_graph_log(self, rev, path, limit):
+        from allura.model.commit_graph import tree_entry_id
+        if self.commit_graph is None:
+            return None
+        return self.commit_graph.path_log(rev, path, limit, tree_entry_id)
+
     def latest(self, branch=None):
         if self._impl is None:
             return None
@@ -661,7 +897,12 @@ def guess_type(self, name):
 
     def unknown_commit_ids(self):
         from allura.model.repo_refresh import unknown_commit_ids as unknown_commit_ids_repo
-        return unknown_commit_ids_repo(self.all_commit_ids())
+        commit_ids = None
+        if self.refreshed_heads:
+            commit_ids = self.commit_ids_since(self.refreshed_heads, self.ref_heads())
+        if commit_ids is None:
+            commit_ids = self.all_commit_ids()
+        return unknown_commit_ids_repo(commit_ids)
 
     def refresh(self, all_commits=False, notify=True, new_clone=False):
         '''Find any new commits in the repository and update'''
@@ -699,6 +940,99 @@ def tarball(self, revision, path=None):
         if path:
             path = path.strip('/')
         self._impl.tarball(revision, path)
+        self.prune_tarballs()
+
+    def tarball_stream(self, revision, path=None):
+        '''
+        Return an iterator over a zip archive of the revision, built while it
+        is being read, or None if it has to be built by the tarball task
+        instead: because this kind of repo can't stream archives, or because
+        scm.repos.tarball.stream.max_builds archives are being built already.
+
+        The archive is written to :attr:`tarball_path` as it's built, and
+        moved into place once complete, where :meth:`get_tarball_status` and
+        :meth:`tarball_url` find it for later downloads.  Requests for an
+        archive that's already being built read it from there as it grows,
+        rather than building another copy.
+        '''
+        if path:
+            path = path.strip('/')
+        # worked out now, since c is gone by the time the response is read
+        filename = os.path.join(
+            self.tarball_path,
+            self.tarball_filename(revision, path) + '.zip')
+        chunks = self._impl.tarball_stream(revision, path)
+        if chunks is None:
+            return None
+        dirname = os.path.dirname(filename)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        partname = filename + '.part'
+        while True:
+            if os.path.isfile(filename):
+                chunks.close()
+                return _follow_tarball(open(filename, 'rb'), filename)
+            # whoever holds the lock on the part file is building it
+            fp = open(partname, 'a+b')
+            if not _flock(fp):
+                chunks.close()
+                return _follow_tarball(fp, filename)
+            if not _same_file(fp, partname):
+                # finished or abandoned since we opened it
+                fp.close()
+                continue
+            if os.fstat(fp.fileno()).st_size:
+                # left behind by a build that died
+                os.remove(partname)
+                fp.close()
+                continue
+            break
+        slot = self._tarball_build_slot()
+        if slot is None:
+            chunks.close()
+            os.remove(partname)
+            fp.close()
+            return None
+        return self._build_tarball(chunks, fp, filename, slot)
+
+    def _build_tarball(self, chunks, fp, filename, slot):
+        partname = filename + '.part'
+        max_size = self._tarball_cache_size()
+        try:
+            for chunk in chunks:
+                fp.write(chunk)
+                # so requests following the build see it straight away
+                fp.flush()
+                yield chunk
+            os.rename(partname, filename)
+            prune_tarballs(os.path.dirname(filename), max_size)
+        finally:
+            chunks.close()
+            if _same_file(fp, partname):
+                os.remove(partname)
+            fp.close()
+            slot.close()
+
+    def _tarball_build_slot(self):
+        '''Return a locked file holding one of the
+        scm.repos.tarball.stream.max_builds slots for building archives, or
+        None if they're all taken.  Closing it frees the slot.'''
+        root = tg.config.get('scm.repos.tarball.root', '/')
+        max_builds = asint(tg.config.get('scm.repos.tarball.stream.max_builds', 4))
+        for i in range(max_builds):
+            fp = open(os.path.join(root, '.stream-build-%d.lock' % i), 'a')
+            if _flock(fp):
+                return fp
+            fp.close()
+        return None
+
+    def _tarball_cache_size(self):
+        return asint(tg.config.get('scm.repos.tarball.cache_size', 0))
+
+    def prune_tarballs(self):
+        '''Remove this repo's oldest archives, if they take up more than
+        scm.repos.tarball.cache_size bytes'''
+        prune_tarballs(self.tarball_path, self._tarball_cache_size())
 
     def rev_to_commit_id(self, rev):
         raise NotImplementedError('rev_to_commit_id')
@@ -978,6 +1312,19 @@ def add_meta_post(self, changes):
     Field('commit_ids', [str], index=True),
     Field('commit_times', [datetime]))
 
+# Index of the branches and tags of each repo, updated from the refs that
+# changed at every refresh, so that lists of them can be paged and searched
+# without reading every ref from the repo on disk.
+RepoRefDoc = collection(
+    'repo_ref', main_doc_session,
+    Field('_id', S.ObjectId()),
+    Field('repo_id', S.ObjectId()),
+    Field('kind', str),  # 'branch' or 'tag'
+    Field('name', str),
+    Field('object_id', str),
+    Index('repo_id', 'kind', 'name', unique=True),
+    Index('repo_id', 'object_id'))
+
 
 class RepoObject(object):
 
@@ -1629,6 +1976,118 @@ def by_name(self):
         return {n.name: n.commit_id for n in self.entries}
 
 
+class RepoObjectCache(object):
+
+    '''
+    LRU cache of commit, tree and last commit documents, shared by all
+    requests and threads in a process.  It also holds other data that never
+    changes for a commit, like the list of files it touches.
+
+    Trees are immutable by _id, but refreshes still update some fields of
+    commits (child_ids, repo_ids) and can rebuild last commit data, so
+    entries set with ``expires=True`` are only served for ttl seconds (from
+    scm.object_cache.ttl by default), and refresh :meth:`discard`s the
+    commits it changes in its own process.  Documents are held as BSON,
+    which bounds the cache by size in bytes (max_bytes, from
+    scm.object_cache.max_bytes by default) and means every hit builds fresh
+    objects that callers are free to modify.  A max_bytes of 0 disables the
+    cache.
+    '''
+
+    def __init__(self, max_bytes=None, ttl=None):
+        self._max_bytes = max_bytes
+        self._ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size = 0  # bytes
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    @property
+    def max_bytes(self):
+        if self._max_bytes is None:
+            self._max_bytes = asint(
+                tg.config.get('scm.object_cache.max_bytes', 0))
+        return self._max_bytes
+
+    @property
+    def ttl(self):
+        if self._ttl is None:
+            self._ttl = asint(tg.config.get('scm.object_cache.ttl', 60))
+        return self._ttl
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def get(self, key):
+        '''Return a copy of the document cached under key, or None'''
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is not None:
+                data, expires = entry
+                if expires is not None and expires <= time():
+                    self.size -= len(data)
+                    entry = None
+                else:
+                    self._data[key] = entry
+        if entry is None:
+            self.miss()
+            return None
+        self.hit()
+        return data.decode()
+
+    def set(self, key, doc, expires=False):
+        '''Cache doc under key; if expires, only for ttl seconds'''
+        data = bson.BSON.encode(doc)
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            self._pop(key)
+            self._data[key] = (data, time() + self.ttl if expires else None)
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                key, (old, expires) = self._data.popitem(last=False)
+                self.size -= len(old)
+                self.evictions += 1
+
+    def discard(self, key):
+        with self._lock:
+            self._pop(key)
+
+    def _pop(self, key):
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[0])
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return dict(
+            entries=len(self._data),
+            size=self.size,
+            max_bytes=self.max_bytes,
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            hit_rate=float(self.hits) / lookups if lookups else 0.0)
+
+    # hit() and miss() are instrumented by AlluraTimerMiddleware
+    def hit(self):
+        self.hits += 1
+
+    def miss(self):
+        self.misses += 1
+
+
+repo_object_cache = RepoObjectCache()
+
+
 class ModelCache(object):
 
     '''
@@ -1641,7 +2100,7 @@ class ModelCache(object):
     for a series of several new commits.
     '''
 
-    def __init__(self, max_instances=None, max_queries=None):
+    def __init__(self, max_instances=None, max_queries=None, shared_cache=None):
         '''
         By default, each model type can have 2000 instances and
         8000 queries.  You can override these for specific model
@@ -1652,7 +2111,14 @@ def __init__(self, max_instances=None, max_queries=None):
 
         If you pass in a number instead of a dict, that value will
         be used as the max for all classes.
+
+        Commits, trees and last commit data that aren't in this cache are
+        looked up in shared_cache (the process-wide
+        :data:`repo_object_cache` by default) before querying mongo.
         '''
+        if shared_cache is None:
+            shared_cache = repo_object_cache
+        self._shared_cache = shared_cache
         max_instances_default = 2000
         max_queries_default = 8000
         if isinstance(max_instances, int):
@@ -1691,18 +2157,55 @@ def get(self, cls, query):
         _query = self._normalize_query(query)
         self._touch(cls, _query)
         if _query not in self._query_cache[cls]:
-            val = self._model_query(cls).get(**query)
+            val = self._fetch(cls, query)
             self.set(cls, _query, val)
             return val
         _id = self._query_cache[cls][_query]
         if _id is None:
             return None
         if _id not in self._instance_cache[cls]:
-            val = self._model_query(cls).get(**query)
+            val = self._fetch(cls, query)
             self.set(cls, _query, val)
             return val
         return self._instance_cache[cls][_id]
 
+    def _fetch(self, cls, query):
+        '''
+        Query for a single instance, going through the shared
+        :class:`RepoObjectCache` for the immutable repo object classes.
+        '''
+        doc_cls = SHARED_CACHE_CLASSES.get(cls)
+        if doc_cls is None or not self._shared_cache.enabled:
+            return self._model_query(cls).get(**query)
+        key = shared_cache_key(doc_cls, self._normalize_query(query))
+        doc = self._shared_cache.get(key)
+        if doc is not None:
+            return self._from_doc(cls, doc)
+        val = self._model_query(cls).get(**query)
+        if isinstance(val, cls):
+            if hasattr(cls, 'query'):
+                if state(val).status != state(val).clean:
+                    # modified in this session; don't share the changes
+                    return val
+                doc = state(val).document
+            else:
+                doc = val
+            self._shared_cache.set(
+                key, doc, expires=doc_cls in EXPIRING_CACHE_CLASSES)
+        return val
+
+    def _from_doc(self, cls, doc):
+        if not hasattr(cls, 'query'):
+            return cls.make(doc)
+        # like ming's cursor would, prefer the session's copy
+        sess = session(cls)
+        obj = sess.imap.get(cls, doc['_id'])
+        if obj is None:
+            obj = mapper(cls).create(doc, {})
+            state(obj).status = state(obj).clean
+            sess.save(obj)
+        return obj
+
     def set(self, cls, query, val):
         _query = self._normalize_query(query)
         if val is not None:
@@ -1936,6 +2439,79 @@ def prefix_paths_union(a, b):
     return union
 
 
+def _flock(fp, shared=False):
+    '''Lock fp without waiting, returning False if someone else has it'''
+    try:
+        fcntl.flock(fp, (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | fcntl.LOCK_NB)
+    except IOError as e:
+        if e.errno in (errno.EAGAIN, errno.EACCES):
+            return False
+        raise
+    return True
+
+
+def _same_file(fp, filename):
+    '''True if filename is still the file fp has open'''
+    try:
+        return os.stat(filename).st_ino == os.fstat(fp.fileno()).st_ino
+    except OSError:
+        return False
+
+
+def _follow_tarball(fp, filename):
+    '''
+    Yield the contents of fp, an archive which may still be being built
+    into filename, until the build finishes.  Raises IOError if the build
+    was abandoned (e.g. because its own download was cancelled).
+    '''
+    fd = fp.fileno()
+    os.lseek(fd, 0, os.SEEK_SET)
+    try:
+        while True:
+            chunk = os.read(fd, TARBALL_CHUNK_SIZE)
+            if chunk:
+                yield chunk
+            elif _flock(fp, shared=True):
+                # the build's over, so what's left is all there is
+                for chunk in iter(lambda: os.read(fd, TARBALL_CHUNK_SIZE), ''):
+                    yield chunk
+                if not _same_file(fp, filename):
+                    raise IOError('Build of %s was abandoned' % filename)
+                break
+            else:
+                sleep(TARBALL_POLL_INTERVAL)
+    finally:
+        fp.close()
+
+
+def prune_tarballs(dirname, max_size):
+    '''
+    Remove the oldest zip archives in dirname until the rest fit in max_size
+    bytes.  A max_size of 0 means no limit.
+    '''
+    if not max_size or not os.path.isdir(dirname):
+        return
+    archives = []
+    for name in os.listdir(dirname):
+        if not name.endswith('.zip'):
+            continue
+        filename = os.path.join(dirname, name)
+        try:
+            st = os.stat(filename)
+        except OSError:  # removed by someone else
+            continue
+        archives.append((st.st_mtime, st.st_size, filename))
+    total = sum(size for mtime, size, filename in archives)
+    for mtime, size, filename in sorted(archives):
+        if total <= max_size:
+            break
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+        total -= size
+
+
 def zipdir(source, zipfile, exclude=None):
     """Create zip archive using zip binary."""
     zipbin = tg.config.get('scm.repos.tarball.zip_binary', '/usr/bin/zip')
@@ -1959,3 +2535,35 @@ def zipdir(source, zipfile, exclude=None):
 mapper(Tree, TreeDoc, repository_orm_session)
 mapper(LastCommit, LastCommitDoc, repository_orm_session)
 Mapper.compile_all()
+
+# model classes whose lookups by ModelCache go through repo_object_cache,
+# and the document classes they're stored as
+SHARED_CACHE_CLASSES = {
+    Commit: CommitDoc,
+    Tree: TreeDoc,
+    LastCommit: LastCommitDoc,
+    CommitDoc: CommitDoc,
+    TreeDoc: TreeDoc,
+    LastCommitDoc: LastCommitDoc,
+}
+
+# document classes that refresh updates in place, so are only cached for
+# repo_object_cache.ttl seconds
+EXPIRING_CACHE_CLASSES = (CommitDoc, LastCommitDoc)
+
+
+def shared_cache_key(doc_cls, query):
+    '''Key in repo_object_cache for the doc_cls found by (normalized) query'''
+    return (doc_cls.m.collection_name, query)
+
+
+def discard_shared_commits(commit_ids):
+    '''
+    Drop commits that have just been changed from this process'
+    repo_object_cache, so it doesn't serve them until they expire.  Other
+    processes still can, for up to scm.object_cache.ttl seconds.
+    '''
+    if not repo_object_cache.enabled:
+        return
+    for oid in commit_ids:
+        repo_object_cache.discard(shared_cache_key(CommitDoc, (('_id', oid),)))
@@ -127,6 +127,8 @@ def after_flush(self, obj=None):
                     if _needs_update(o)]
                 for obj in self.objects_added + self.objects_modified:
                     Shortlink.from_artifact(obj)
+                if self.objects_added or self.objects_modified or self.objects_deleted:
+                    Shortlink.clear_request_cache()
                 # Flush shortlinks
                 main_orm_session.flush()
             except Exception:
@@ -17,8 +17,9 @@
 
 import bson
 import logging
+from datetime import datetime
 
-from ming.odm import Mapper
+from ming.odm import Mapper, mapper
 from pylons import tmpl_context as c
 
 from activitystream import ActivityDirector
@@ -56,6 +57,54 @@ def create_activity(self, actor, verb, obj, target=None,
             if isinstance(node, Project):
                 create_timelines.post(node.node_id)
 
+    def create_activities(self, activities):
+        """Create many activities, each given as a dict of create_activity
+        arguments.  Like create_activity, each is stored once for every node
+        involved, but all of them are saved with a single insert, and
+        timelines are aggregated once for each actor and project involved,
+        instead of once per activity.
+
+        """
+        if c.project and c.project.notifications_disabled:
+            return
+
+        from activitystream.storage.base import StoredActivity
+        from allura.model.project import Project
+        published = datetime.utcnow()
+        stored = []
+        node_ids = set()
+        for activity in activities:
+            actor, obj = activity['actor'], activity['obj']
+            target = activity.get('target')
+            nodes = [obj, target] + (activity.get('related_nodes') or [])
+            for node in [actor] + nodes:
+                if getattr(node, 'node_id', None):
+                    stored.append(StoredActivity(
+                        actor=actor, verb=activity['verb'], obj=obj,
+                        target=target, published=published,
+                        node_id=node.node_id, tags=activity.get('tags')))
+            if actor.node_id:
+                node_ids.add(actor.node_id)
+            for node in nodes:
+                if isinstance(node, Project):
+                    node_ids.add(node.node_id)
+        self._save_activities(stored)
+        for node_id in sorted(node_ids):
+            create_timelines.post(node_id)
+
+    def _save_activities(self, activities):
+        storage = self.activity_manager.storage
+        if not activities:
+            return
+        from activitystream.storage import mingstorage
+        if not isinstance(storage, mingstorage.MingStorage):
+            for activity in activities:
+                storage.save_activity(activity)
+            return
+        doc_cls = mapper(mingstorage.Activity).collection
+        doc_cls.m.collection.insert(
+            [doc_cls.make(a.to_dict()) for a in activities])
+
 
 class Aggregator(BaseAggregator):
     pass
@@ -0,0 +1,75 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+"""
+Fill in the SVN log cache for revisions refreshed before it existed, so
+path history and last commit queries on those repos can use it.  Much
+cheaper than refreshrepo.py --all, since it only reads the svn log.
+"""
+
+import argparse
+import logging
+
+from allura import model as M
+from allura.lib import utils
+from allura.scripts import ScriptTask
+
+from forgesvn.model.svn import Repository
+
+log = logging.getLogger(__name__)
+
+
+class BackfillSVNLogCache(ScriptTask):
+
+    @classmethod
+    def execute(cls, options):
+        query = {'tool_name': {'$regex': '^svn$', '$options': 'i'}}
+        if options.project:
+            project = M.Project.query.get(shortname=options.project)
+            if not project:
+                return 'Invalid project shortname.'
+            query['project_id'] = project._id
+        for chunk in utils.chunked_find(M.AppConfig, query):
+            for config in chunk:
+                repo = Repository.query.get(app_config_id=config._id)
+                if repo is None:
+                    continue
+                try:
+                    added = repo._impl.backfill_log_cache(options.page_size)
+                except Exception:
+                    log.exception('Error backfilling the log cache of %r', repo)
+                    continue
+                log.info('Added %d revisions to the log cache of %r', added, repo)
+
+    @classmethod
+    def parser(cls):
+        parser = argparse.ArgumentParser(description='Add revisions missing '
+                                         'from the SVN log cache, for all SVN repos or one project\'s.')
+        parser.add_argument('--project', action='store', default='', dest='project',
+                            help='Restrict to a particular project. To specify a '
+                            'subproject, use a slash: project/subproject.')
+        parser.add_argument('--page-size', action='store', type=int, default=1000,
+                            dest='page_size', help='Revisions to read from svn at a time.')
+        return parser
+
+
+def get_parser():
+    return BackfillSVNLogCache.parser()
+
+
+if __name__ == '__main__':
+    BackfillSVNLogCache.main()
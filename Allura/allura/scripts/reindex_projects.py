@@ -17,6 +17,7 @@
 
 import argparse
 import logging
+import time
 
 from pymongo.errors import InvalidDocument
 from pylons import tmpl_context as c, app_globals as g
@@ -46,6 +47,8 @@ def execute(cls, options):
         elif options.project_regex:
             q_project['shortname'] = {'$regex': options.project_regex}
 
+        start = time.time()
+        indexed = 0
         for chunk in chunked_find(M.Project, q_project):
             project_ids = []
             for p in chunk:
@@ -61,12 +64,17 @@ def execute(cls, options):
                         cls._post_add_projects(chunk)
                     else:
                         add_projects(chunk)
+                        indexed += len(chunk)
             except CompoundError, err:
                 log.exception('Error indexing projects:\n%r', err)
                 log.error('%s', err.format_error())
             M.main_orm_session.flush()
             M.main_orm_session.clear()
         log.info('Reindex %s', 'queued' if options.tasks else 'done')
+        if not options.tasks:
+            elapsed = time.time() - start
+            log.info('Reindexed %d projects in %.1fs (%.1f projects/sec)',
+                     indexed, elapsed, indexed / elapsed if elapsed else 0)
 
     @classmethod
     def _post_add_projects(cls, chunk):
@@ -17,6 +17,7 @@
 
 import argparse
 import logging
+import time
 
 from pymongo.errors import InvalidDocument
 
@@ -34,6 +35,8 @@ class ReindexUsers(ScriptTask):
 
     @classmethod
     def execute(cls, options):
+        start = time.time()
+        indexed = 0
         for chunk in chunked_find(M.User, {}):
             user_ids = []
             for u in chunk:
@@ -47,12 +50,17 @@ def execute(cls, options):
                         cls._post_add_users(chunk)
                     else:
                         add_users(chunk)
+                        indexed += len(chunk)
             except CompoundError, err:
                 log.exception('Error indexing users:\n%r', err)
                 log.error('%s', err.format_error())
             M.main_orm_session.flush()
             M.main_orm_session.clear()
         log.info('Reindex %s', 'queued' if options.tasks else 'done')
+        if not options.tasks:
+            elapsed = time.time() - start
+            log.info('Reindexed %d users in %.1fs (%.1f users/sec)',
+                     indexed, elapsed, indexed / elapsed if elapsed else 0)
 
     @classmethod
     def _post_add_users(cls, chunk):
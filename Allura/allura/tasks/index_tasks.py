@@ -16,6 +16,7 @@
 #       under the License.
 
 import sys
+import math
 import logging
 from contextlib import contextmanager
 
@@ -23,7 +24,7 @@
 
 from allura.lib.decorators import task
 from allura.lib.exceptions import CompoundError
-from allura.lib.solr import make_solr_from_config
+from allura.lib.solr import make_solr_from_config, solr_doc_hash
 
 
 log = logging.getLogger(__name__)
@@ -35,7 +36,8 @@ def __get_solr(solr_hosts=None):
 
 def __add_objects(objects, solr_hosts=None):
     solr_instance = __get_solr(solr_hosts)
-    solr_instance.add([obj.solarize() for obj in objects])
+    stats = solr_instance.bulk_add(obj.solarize() for obj in objects)
+    log.info('Indexed %s', stats)
 
 
 def __del_objects(object_solr_ids):
@@ -68,47 +70,64 @@ def del_users(user_solr_ids):
     __del_objects(user_solr_ids)
 
 
-@task
-def add_artifacts(ref_ids, update_solr=True, update_refs=True, solr_hosts=None):
+@task(coalesce='union')
+def add_artifacts(ref_ids, update_solr=True, update_refs=True, solr_hosts=None, skip_unchanged=True):
     '''
     Add the referenced artifacts to SOLR and shortlinks.
 
+    Returns a dict with the number of documents ``indexed`` and ``skipped``.
+
     :param solr_hosts: a list of solr hosts to use instead of the defaults
     :type solr_hosts: [str]
+    :param skip_unchanged: don't send documents identical to what was last sent
+        to solr.  Never applies with ``solr_hosts``.
     '''
     from allura import model as M
-    from allura.lib.search import find_shortlinks
 
     exceptions = []
     solr_updates = []
+    solr_hashes = []
+    skipped = 0
+    skip_unchanged = skip_unchanged and not solr_hosts
     with _indexing_disabled(M.session.artifact_orm_session._get()):
         for ref in M.ArtifactReference.query.find(dict(_id={'$in': ref_ids})):
             try:
                 artifact = ref.artifact
                 if artifact is None:
                     continue
-                s = artifact.solarize()
+                s, shortlinks = artifact.solarize_with_shortlinks()
                 if s is None:
                     continue
                 if update_solr:
-                    solr_updates.append(s)
+                    doc_hash = solr_doc_hash(s)
+                    if skip_unchanged and ref.solr_hash == doc_hash:
+                        skipped += 1
+                    else:
+                        solr_updates.append(s)
+                        solr_hashes.append((ref, doc_hash))
                 if update_refs:
                     if isinstance(artifact, M.Snapshot):
                         continue
-                    # Find shortlinks in the raw text, not the escaped html
-                    # created by the `solarize()`.
-                    link_text = artifact.index().get('text') or ''
-                    shortlinks = find_shortlinks(link_text)
                     ref.references = [link.ref_id for link in shortlinks]
             except Exception:
                 log.error('Error indexing artifact %s', ref._id)
                 exceptions.append(sys.exc_info())
-        __get_solr(solr_hosts).add(solr_updates)
+        if solr_updates:
+            stats = __get_solr(solr_hosts).bulk_add(solr_updates)
+            log.info('Indexed %s', stats)
+            if not solr_hosts:
+                for ref, doc_hash in solr_hashes:
+                    ref.solr_hash = doc_hash
+                _bump_search_generations(
+                    ref.artifact_reference.app_config_id for ref, _ in solr_hashes)
+        if skipped:
+            log.info('Skipped %d unchanged documents', skipped)
 
     if len(exceptions) == 1:
         raise exceptions[0][0], exceptions[0][1], exceptions[0][2]
     if exceptions:
         raise CompoundError(*exceptions)
+    return dict(indexed=len(solr_updates), skipped=skipped)
 
 
 @task
@@ -116,13 +135,19 @@ def del_artifacts(ref_ids):
     from allura import model as M
     if ref_ids:
         __del_objects(ref_ids)
+        refs = M.ArtifactReference.query.find(dict(_id={'$in': ref_ids}))
+        _bump_search_generations(
+            ref.artifact_reference.app_config_id for ref in refs)
         M.ArtifactReference.query.remove(dict(_id={'$in': ref_ids}))
         M.Shortlink.query.remove(dict(ref_id={'$in': ref_ids}))
 
 
 @task
 def solr_del_project_artifacts(project_id):
+    from allura import model as M
     g.solr.delete(q='project_id_s:%s' % project_id)
+    M.ArtifactReference.clear_solr_hashes(project_id)
+    _bump_search_generations([project_id])
 
 
 @task
@@ -130,9 +155,38 @@ def commit():
     g.solr.commit()
 
 
+# not coalesced: merging into a bump that's due sooner would run it before
+# solr has made the later changes visible
+@task
+def bump_search_generations(scope_ids):
+    from allura import model as M
+    M.SearchGeneration.bump(scope_ids)
+
+
 @task
 def solr_del_tool(project_id, mount_point_s):
+    from allura import model as M
     g.solr.delete(q='project_id_s:"%s" AND mount_point_s:"%s"' % (project_id, mount_point_s))
+    M.ArtifactReference.clear_solr_hashes(project_id)
+    _bump_search_generations([project_id])
+
+
+def _bump_search_generations(scope_ids):
+    '''
+    Invalidate cached searches of scope_ids once solr has made the changes
+    just sent to it searchable.  Bumping any sooner would let searches made
+    in between cache the old results under the new generation.
+    '''
+    from allura import model as M
+    scope_ids = list(set(scope_ids))
+    if not scope_ids:
+        return
+    delay = int(math.ceil(g.solr.visible_after()))
+    if delay:
+        bump_search_generations.post(scope_ids, delay=delay + 1)
+    else:
+        M.SearchGeneration.bump(scope_ids)
+
 
 @contextmanager
 def _indexing_disabled(session):
@@ -159,7 +159,7 @@ def sendmail(fromaddr, destinations, text, reply_to, subject,
                 addrs_multi.append(addr)
     htmlparser = HTMLParser.HTMLParser()
     plain_msg = mail_util.encode_email_part(htmlparser.unescape(text), 'plain')
-    html_text = g.forge_markdown(email=True).convert(text)
+    html_text = g.pooled_markdown(email=True).convert(text)
     if metalink != None:
         html_text = html_text + mail_meta_content(metalink)
 
@@ -219,7 +219,7 @@ def sendsimplemail(
 
     htmlparser = HTMLParser.HTMLParser()
     plain_msg = mail_util.encode_email_part(htmlparser.unescape(text), 'plain')
-    html_text = g.forge_markdown(email=True).convert(text)
+    html_text = g.pooled_markdown(email=True).convert(text)
     html_msg = mail_util.encode_email_part(html_text, 'html')
     multi_msg = mail_util.make_multipart_message(plain_msg, html_msg)
     smtp_client.sendmail(
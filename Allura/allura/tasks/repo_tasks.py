@@ -62,7 +62,7 @@ def reclone(*args, **kwargs):
     clone(*args, **kwargs)
 
 
-@task
+@task(coalesce=True)
 def refresh(**kwargs):
     from allura import model as M
     log = logging.getLogger(__name__)
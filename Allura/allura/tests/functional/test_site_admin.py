@@ -129,6 +129,23 @@ def test_task_list(self):
         r = self.app.get('/nf/admin/task_manager?page_num=1')
         assert 'math.ceil' in r, r
 
+    # mim doesn't support aggregate
+    @patch('ming.session.Session.aggregate')
+    def test_task_stats(self, aggregate):
+        aggregate.side_effect = [
+            [{'_id': 'math.ceil', 'ready': 3, 'busy': 1,
+              'oldest_ready': dt.datetime(2016, 1, 1)}],
+            [{'_id': dict(task_name='math.ceil', window=0, wait=7, run=6),
+              'count': 1, 'errors': 0, 'wait_max': 1000, 'run_max': 500},
+             {'_id': dict(task_name='math.ceil', window=1, wait=8, run=6),
+              'count': 1, 'errors': 1, 'wait_max': 3000, 'run_max': 500}],
+        ]
+        r = self.app.get('/nf/admin/task_manager/stats?minutes=60,10')
+        assert 'math.ceil' in r, r
+        assert 'value="10,60"' in r, r
+        assert '1.00 / 1.00 / 1.00' in r, r
+        assert '1.00 / 3.00 / 3.00' in r, r
+
     def test_task_view(self):
         import math
         task = M.MonQTask.post(math.ceil, (12.5,))
@@ -141,6 +141,26 @@ def test_artifactlink():
     assert q_shortlink.count() == 0
 
 
+@with_setup(setUp, tearDown)
+def test_shortlink_request_cache():
+    pg = WM.Page(title='TestPage3')
+    ThreadLocalORMSession.flush_all()
+    with patch.object(M.Shortlink, '_from_links', wraps=M.Shortlink._from_links) as from_links:
+        M.Shortlink.prefetch(['TestPage3', 'TestPage4'])
+        assert_equal(from_links.call_count, 1)
+        link = M.Shortlink.lookup('TestPage3')
+        assert 'cached_ref' in link.__dict__
+        assert_equal(link.cached_ref.artifact, pg)
+        assert_equal(M.Shortlink.lookup('TestPage4'), None)
+        assert_equal(from_links.call_count, 1)
+
+        # changed artifacts invalidate the cache
+        WM.Page(title='TestPage4')
+        ThreadLocalORMSession.flush_all()
+        assert M.Shortlink.lookup('TestPage4')
+        assert_equal(from_links.call_count, 2)
+
+
 @with_setup(setUp, tearDown)
 def test_gen_messageid():
     assert re.match(r'[0-9a-zA-Z]*.wiki@test.p.localhost',
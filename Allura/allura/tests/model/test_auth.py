@@ -230,6 +230,29 @@ def test_user_by_email_address(log):
     assert_equal(M.User.by_email_address('invalid'), None)
 
 
+@with_setup(setUp)
+def test_user_by_email_addresses():
+    u1 = M.User.register(dict(username='abc1'), make_project=False)
+    u2 = M.User.register(dict(username='abc2'), make_project=False)
+    M.EmailAddress(email='abc1@abc.me', confirmed=True,
+                   claimed_by_user_id=u1._id)
+    M.EmailAddress(email='abc2@abc.me', confirmed=False,
+                   claimed_by_user_id=u2._id)
+    ThreadLocalORMSession.flush_all()
+    users = M.User.by_email_addresses(
+        ['abc1@abc.me', 'abc1@ABC.me', 'abc2@abc.me', 'invalid'])
+    assert_equal(users, {'abc1@abc.me': u1, 'abc1@ABC.me': u1})
+    assert_equal(M.User.by_email_addresses([]), {})
+
+
+@with_setup(setUp)
+def test_user_by_usernames():
+    users = M.User.by_usernames(['test-admin', 'test-user', 'no-such-user', ''])
+    assert_equal(sorted(users), ['', 'test-admin', 'test-user'])
+    assert_equal(users['test-admin'], M.User.by_username('test-admin'))
+    assert_equal(users[''], M.User.anonymous())
+
+
 @with_setup(setUp)
 def test_project_role():
     role = M.ProjectRole(project_id=c.project._id, name='test_role')
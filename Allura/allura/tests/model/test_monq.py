@@ -16,12 +16,17 @@
 #       under the License.
 
 import pprint
-from nose.tools import with_setup
+from datetime import datetime, timedelta
+from nose.tools import with_setup, assert_equal
+from mock import patch, call
+import pymongo
+import tg
 
 from ming.orm import ThreadLocalORMSession
 
 from alluratest.controller import setup_basic_test, setup_global_objects
 from allura import model as M
+from allura.lib import helpers as h
 
 
 def setUp():
@@ -40,3 +45,188 @@ def test_basic_task():
     assert task
     task()
     assert task.result == 'I[5, 6]', task.result
+
+
+@with_setup(setUp)
+@patch.object(M.MonQWakeup, 'notify')
+def test_post_signals_wakeup(notify):
+    M.MonQTask.post(pprint.pformat, ([5, 6],))
+    notify.assert_called_once_with('pprint.pformat')
+    notify.reset_mock()
+    M.MonQTask.post(pprint.pformat, ([5, 6],), delay=60)
+    assert not notify.called
+
+
+@with_setup(setUp)
+@patch('allura.model.monq_model.time')
+def test_wakeup_disabled_sleeps(time):
+    wakeup = M.MonQWakeup()
+    assert not wakeup.wait(5)
+    time.sleep.assert_called_once_with(5)
+
+
+@patch('allura.model.monq_model.task_doc_session')
+def test_wakeup_collection_created_once(task_doc_session):
+    db = task_doc_session.db
+    db.name = 'test_wakeup'
+    db.create_collection.side_effect = [None, pymongo.errors.CollectionInvalid]
+    M.MonQWakeup._created.discard('test_wakeup')
+    with h.push_config(tg.config, **{'monq.wakeup': 'true'}):
+        M.MonQWakeup.notify('pprint.pformat')
+        M.MonQWakeup.notify('pprint.pformat')
+        assert_equal(db.create_collection.call_count, 1)
+        assert not db.collection_names.called
+        # already there (e.g. created by another process)
+        M.MonQWakeup._created.discard('test_wakeup')
+        M.MonQWakeup.notify('pprint.pformat')
+        assert_equal(db.create_collection.call_count, 2)
+    assert_equal(db.__getitem__.return_value.insert.call_args_list, [
+        call(dict(task_name=None)),
+        call(dict(task_name='pprint.pformat'), w=0),
+        call(dict(task_name='pprint.pformat'), w=0),
+        call(dict(task_name='pprint.pformat'), w=0),
+    ])
+    M.MonQWakeup._created.discard('test_wakeup')
+
+
+@with_setup(setUp)
+def test_get_batch():
+    for i in range(3):
+        M.MonQTask.post(pprint.pformat, ([i],))
+    M.MonQTask.post(pprint.pprint, ([5],))
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    tasks = M.MonQTask.get_batch(process='test', batch_size=10)
+    assert len(tasks) == 3, tasks
+    assert set(t.task_name for t in tasks) == set(['pprint.pformat'])
+    assert all(t.state == 'busy' and t.process == 'test' for t in tasks)
+    assert M.MonQTask.get_batch(process='test', batch_size=10)[0].task_name == 'pprint.pprint'
+    assert M.MonQTask.get_batch(process='test', batch_size=10) == []
+
+
+@with_setup(setUp)
+def test_get_exclude():
+    M.MonQTask.post(pprint.pformat, ([1],))
+    M.MonQTask.post(pprint.pprint, ([2],))
+    ThreadLocalORMSession.flush_all()
+    task = M.MonQTask.get(process='test', exclude=['pprint.pformat'])
+    assert_equal(task.task_name, 'pprint.pprint')
+    assert_equal(M.MonQTask.get(process='test', exclude=['pprint.pformat']), None)
+    assert_equal(M.MonQTask.get(process='test').task_name, 'pprint.pformat')
+
+
+@with_setup(setUp)
+def test_post_coalesce():
+    t1 = M.MonQTask.post(pprint.pformat, ([5, 6],), coalesce=True)
+    t2 = M.MonQTask.post(pprint.pformat, ([5, 6],), coalesce=True)
+    t3 = M.MonQTask.post(pprint.pformat, ([7],), coalesce=True)
+    assert t1._id == t2._id
+    assert t1._id != t3._id
+    assert M.MonQTask.query.find().count() == 2
+    ThreadLocalORMSession.close_all()
+    assert M.MonQTask.query.get(_id=t1._id).coalesced == 1
+
+
+@with_setup(setUp)
+def test_post_coalesce_union():
+    t1 = M.MonQTask.post(pprint.pformat, ([1, 2],), coalesce='union')
+    t2 = M.MonQTask.post(pprint.pformat, ([2, 3],), coalesce='union')
+    assert t1._id == t2._id
+    ThreadLocalORMSession.close_all()
+    task = M.MonQTask.query.get(_id=t1._id)
+    assert sorted(task.args[0]) == [1, 2, 3], task.args
+    # busy tasks are never merged into
+    M.MonQTask.get()
+    t3 = M.MonQTask.post(pprint.pformat, ([4],), coalesce='union')
+    assert t3._id != t1._id
+
+
+@with_setup(setUp)
+def test_post_coalesce_priority():
+    t1 = M.MonQTask.post(pprint.pformat, ([1],), coalesce='union')
+    t2 = M.MonQTask.post(pprint.pformat, ([2],), coalesce='union', priority=20)
+    assert t1._id != t2._id
+    t3 = M.MonQTask.post(pprint.pformat, ([3],), coalesce='union', priority=20)
+    assert_equal(t3._id, t2._id)
+
+
+@with_setup(setUp)
+def test_post_coalesce_delay():
+    t1 = M.MonQTask.post(pprint.pformat, ([1],), coalesce='union', delay=60)
+    # not merged into a task that would make it wait longer
+    t2 = M.MonQTask.post(pprint.pformat, ([2],), coalesce='union')
+    assert t1._id != t2._id
+    # but a later one can go with one that's due sooner
+    t3 = M.MonQTask.post(pprint.pformat, ([3],), coalesce='union', delay=30)
+    assert_equal(t3._id, t2._id)
+    ThreadLocalORMSession.close_all()
+    assert_equal(sorted(M.MonQTask.query.get(_id=t2._id).args[0]), [2, 3])
+    assert_equal(M.MonQTask.query.get(_id=t1._id).args[0], [1])
+
+
+# mim doesn't support aggregate
+@patch('ming.session.Session.aggregate')
+def test_stats(aggregate):
+    aggregate.side_effect = [
+        [{'_id': 'a', 'ready': 3, 'busy': 1, 'oldest_ready': datetime(2016, 1, 1)}],
+        [{'_id': dict(task_name='b', window=0, wait=7, run=6),
+          'count': 2, 'errors': 0, 'wait_max': 2000, 'run_max': 500},
+         {'_id': dict(task_name='b', window=1, wait=8, run=6),
+          'count': 1, 'errors': 1, 'wait_max': 4000, 'run_max': 500},
+         {'_id': dict(task_name='b', window=1, wait=8, run=None),
+          'count': 1, 'errors': 0, 'wait_max': 3000, 'run_max': None}],
+    ]
+    stats = M.MonQTask.stats(windows=[timedelta(minutes=2), timedelta(minutes=1)])
+    assert_equal([s['task_name'] for s in stats], ['a', 'b'])
+    assert_equal(stats[0]['ready'], 3)
+    assert_equal([w['count'] for w in stats[0]['windows']], [0, 0])
+    assert_equal(stats[0]['windows'][0]['wait_p50'], None)
+    last_minute, last_two = stats[1]['windows']
+    assert_equal(last_minute['minutes'], 1)
+    assert_equal(last_minute['count'], 2)
+    assert_equal(last_minute['errors'], 0)
+    assert_equal(last_minute['wait_p99'], 2.0)
+    assert_equal(last_two['count'], 4)
+    assert_equal(last_two['throughput'], 2.0)
+    assert_equal(last_two['error_rate'], 0.25)
+    assert_equal(last_two['wait_p50'], 2.0)
+    assert_equal(last_two['wait_p99'], 4.0)
+    assert_equal(last_two['run_p95'], 0.5)
+    # only histogram buckets come back, through cursors
+    for args, kwargs in aggregate.call_args_list:
+        assert_equal(kwargs['cursor'], {})
+        assert '$push' not in repr(args)
+
+
+def _evaluate(expr, doc):
+    '''Evaluate the aggregation expressions MonQTask.stats uses'''
+    if isinstance(expr, dict):
+        (op, args), = expr.items()
+        args = [_evaluate(a, doc) for a in args]
+        if op == '$cond':
+            return args[1] if args[0] else args[2]
+        return {
+            '$lt': lambda a, b: a < b,
+            '$gte': lambda a, b: a >= b,
+            '$eq': lambda a, b: a == b,
+        }[op](*args)
+    if isinstance(expr, basestring) and expr.startswith('$'):
+        return doc.get(expr[1:])
+    return expr
+
+
+def test_stats_buckets():
+    expr = M.MonQTask._stats_bucket_expr('$wait')
+    for wait, bucket in [(None, None), (0, 0), (9, 0), (10, 1), (999, 6),
+                         (1000, 7), (3599999, 14), (3600000, 15), (10 ** 9, 15)]:
+        assert_equal(_evaluate(expr, dict(wait=wait)), bucket)
+
+
+def test_histogram_percentile():
+    percentile = M.monq_model._histogram_percentile
+    assert_equal(percentile({}, 50), None)
+    hist = {0: (90, 8), 7: (9, 2400), 15: (1, 7200000)}
+    assert_equal(percentile(hist, 50), 0.008)
+    assert_equal(percentile(hist, 95), 2.4)
+    assert_equal(percentile(hist, 99), 2.4)
+    assert_equal(percentile(hist, 100), 7200.0)
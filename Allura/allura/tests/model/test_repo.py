@@ -15,6 +15,9 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
+import os
+import shutil
+import tempfile
 from datetime import datetime
 from collections import defaultdict, OrderedDict
 
@@ -22,6 +25,7 @@
 import mock
 from nose.tools import assert_equal
 from pylons import tmpl_context as c
+import bson
 from bson import ObjectId
 from ming.orm import session
 from tg import config
@@ -151,6 +155,7 @@ def setUp(self):
         self.repo.get_changes = lambda _id: self._changes[_id]
         self._last_commits = [(None, set())]
         self.repo._get_last_commit = lambda i, p: self._last_commits.pop()
+        self.repo._iter_path_changes = lambda i, p, timeout=None: None
         lcids = M.repository.RepositoryImplementation.last_commit_ids.__func__
         self.repo.last_commit_ids = lambda *a, **k: lcids(self.repo, *a, **k)
         c.lcid_cache = {}
@@ -398,6 +403,106 @@ def test_loop(self):
         self.assertEqual(lcd.by_name['file2'], commit3._id)
 
 
+class TestCommitGraph(unittest.TestCase):
+
+    def setUp(self):
+        from allura.model.commit_graph import CommitGraph, bloom_filter
+        # c1 -- c2 -- c3 ------ c5
+        #         \            /
+        #          +---- c4 --+
+        self.commits = {
+            'c1': ([], bloom_filter(['a', 'b', 'd', 'd/e'])),
+            'c2': (['c1'], bloom_filter(['a', 'f'])),
+            'c3': (['c2'], bloom_filter(['b'])),
+            'c4': (['c2'], bloom_filter(['d', 'd/e'])),
+            'c5': (['c3', 'c4'], bloom_filter(['d', 'd/e'])),
+            'c6': (['c0'], bloom_filter(['a'])),
+        }
+        self.entries = {
+            ('c1', 'a'): 'a1', ('c1', 'b'): 'b1', ('c1', 'd'): 'd1',
+            ('c2', 'a'): 'a2', ('c2', 'b'): 'b1', ('c2', 'd'): 'd1',
+            ('c3', 'a'): 'a2', ('c3', 'b'): 'b3', ('c3', 'd'): 'd1',
+            ('c2', 'f'): 'f2', ('c3', 'f'): 'f2',
+            ('c4', 'a'): 'a2', ('c4', 'b'): 'b1', ('c4', 'd'): 'd4',
+            ('c5', 'a'): 'a2', ('c5', 'b'): 'b3', ('c5', 'd'): 'd4',
+        }
+        self.tmpdir = tempfile.mkdtemp()
+        CommitGraph.write(self.tmpdir, [CommitGraph.write_layer(self.tmpdir, self.commits)])
+        self.graph = CommitGraph.load(self.tmpdir)
+
+    def tearDown(self):
+        self.graph.close()
+        shutil.rmtree(self.tmpdir)
+
+    def _log(self, commit_id, path, limit):
+        return self.graph.path_log(
+            commit_id, path, limit, lambda cid, p: self.entries.get((cid, p)))
+
+    def test_graph(self):
+        assert_equal(self.graph.num_commits, 6)
+        assert_equal(self.graph.generation('c1'), 1)
+        assert_equal(self.graph.generation('c4'), 3)
+        assert_equal(self.graph.generation('c5'), 4)
+        assert_equal(self.graph.generation('c6'), 1)
+        assert_equal(self.graph.generation('cx'), None)
+        commits = dict((cid, (parents, bloom))
+                       for cid, parents, bloom in self.graph.iter_commits())
+        assert_equal(commits['c5'], self.commits['c5'])
+        assert_equal(commits['c6'], ([None], self.commits['c6'][1]))
+
+    def test_path_log(self):
+        assert_equal(self._log('c3', 'a', 2), ['c2', 'c1'])
+        assert_equal(self._log('c3', 'b', 1), ['c3'])
+        assert_equal(self._log('c3', 'b', 5), ['c3', 'c1'])
+        # merge that didn't touch the path follows the first parent
+        assert_equal(self._log('c5', 'a', 1), ['c2'])
+        # merge that may have touched it needs the SCM
+        assert_equal(self._log('c5', 'd', 1), None)
+        assert_equal(self._log('c4', 'd', 1), ['c4'])
+        assert_equal(self._log('c4', 'd', 3), ['c4', 'c1'])
+        # added in c2, possibly by a rename
+        assert_equal(self._log('c3', 'f', 1), ['c2'])
+        assert_equal(self._log('c3', 'f', 2), None)
+        # unknown commits and parents
+        assert_equal(self._log('cx', 'a', 1), None)
+        assert_equal(self._log('c6', 'a', 2), None)
+
+    def test_layers(self):
+        from allura.model.commit_graph import CommitGraph
+        path = os.path.join(self.tmpdir, 'layers')
+        os.mkdir(path)
+        old = dict((cid, self.commits[cid]) for cid in ('c1', 'c2'))
+        new = dict((cid, self.commits[cid]) for cid in ('c3', 'c4', 'c5', 'c6'))
+        first = CommitGraph.write_layer(path, old)
+        base = CommitGraph([first])
+        second = CommitGraph.write_layer(path, new, base)
+        base.close()
+        CommitGraph.write(path, [first, second])
+        self.graph.close()
+        self.graph = CommitGraph.load(path)
+        assert_equal(sorted(os.listdir(path)), sorted(['chain', os.path.basename(first),
+                                                       os.path.basename(second)]))
+        assert_equal(self.graph.layer_sizes(), [2, 4])
+        assert_equal(self.graph.generation('c2'), 2)
+        assert_equal(self.graph.generation('c5'), 4)
+        commits = dict((cid, (parents, bloom))
+                       for cid, parents, bloom in self.graph.iter_commits())
+        assert_equal(commits['c5'], self.commits['c5'])
+        assert_equal(commits['c3'], self.commits['c3'])
+        assert_equal(self._log('c5', 'a', 1), ['c2'])
+        assert_equal(self._log('c4', 'd', 3), ['c4', 'c1'])
+        assert_equal(self._log('c3', 'b', 5), ['c3', 'c1'])
+
+    def test_bloom_filter(self):
+        from allura.model.commit_graph import bloom_filter, bloom_contains, path_hashes
+        bloom = bloom_filter(['a/b', u'\u00e9'])
+        assert bloom_contains(bloom, path_hashes('a/b'))
+        assert bloom_contains(bloom, path_hashes('/a/b/'))
+        assert bloom_contains(bloom, path_hashes(u'\u00e9'.encode('utf-8')))
+        assert not bloom_contains(bloom_filter([]), path_hashes('a/b'))
+        assert bloom_contains(bloom_filter(str(i) for i in range(1000)), path_hashes('x'))
+
+
 class TestModelCache(unittest.TestCase):
     def setUp(self):
         self.cache = M.repository.ModelCache()
@@ -683,6 +788,115 @@ def test_pruning_instance_flush(self, session):
         session.return_value.flush.assert_called_once_with(tree1)
         session.return_value.expunge.assert_called_once_with(tree1)
 
+    @mock.patch.object(M.repository.CommitDoc.m, 'get')
+    def test_shared_cache(self, ci_get):
+        shared = M.repository.RepoObjectCache(max_bytes=1024)
+        ci_get.return_value = M.repository.CommitDoc.make(
+            dict(_id='foo', tree_id='bar', message='baz'))
+        cache1 = M.repository.ModelCache(shared_cache=shared)
+        cache2 = M.repository.ModelCache(shared_cache=shared)
+        ci1 = cache1.get(M.repository.CommitDoc, {'_id': 'foo'})
+        ci2 = cache2.get(M.repository.CommitDoc, {'_id': 'foo'})
+        ci_get.assert_called_once_with(_id='foo')
+        self.assertEqual(ci1, ci2)
+        self.assertIsNot(ci1, ci2)
+        self.assertIsInstance(ci2, M.repository.CommitDoc)
+        self.assertEqual((shared.hits, shared.misses), (1, 1))
+
+    @mock.patch.object(M.repository.CommitDoc.m, 'get')
+    def test_shared_cache_discard_commits(self, ci_get):
+        shared = M.repository.RepoObjectCache(max_bytes=1024)
+        ci_get.return_value = M.repository.CommitDoc.make(
+            dict(_id='foo', tree_id='bar', child_ids=[]))
+        M.repository.ModelCache(shared_cache=shared).get(
+            M.repository.CommitDoc, {'_id': 'foo'})
+        with mock.patch('allura.model.repository.repo_object_cache', shared):
+            M.repository.discard_shared_commits(['foo'])
+        M.repository.ModelCache(shared_cache=shared).get(
+            M.repository.CommitDoc, {'_id': 'foo'})
+        self.assertEqual(ci_get.call_count, 2)
+
+    @mock.patch.object(M.repository.CommitDoc.m, 'get')
+    def test_shared_cache_disabled(self, ci_get):
+        shared = M.repository.RepoObjectCache(max_bytes=0)
+        ci_get.return_value = M.repository.CommitDoc.make(dict(_id='foo'))
+        M.repository.ModelCache(shared_cache=shared).get(
+            M.repository.CommitDoc, {'_id': 'foo'})
+        M.repository.ModelCache(shared_cache=shared).get(
+            M.repository.CommitDoc, {'_id': 'foo'})
+        self.assertEqual(ci_get.call_count, 2)
+        self.assertEqual(shared.stats()['entries'], 0)
+
+
+class TestRepoObjectCache(unittest.TestCase):
+    def setUp(self):
+        self.doc = dict(_id='a' * 40, tree_id='b' * 40)
+        self.doc_size = len(bson.BSON.encode(self.doc))
+        self.cache = M.repository.RepoObjectCache(
+            max_bytes=self.doc_size * 2, ttl=60)
+
+    def test_get(self):
+        self.assertEqual(self.cache.get('key'), None)
+        self.cache.set('key', self.doc)
+        doc = self.cache.get('key')
+        self.assertEqual(doc, self.doc)
+        doc['tree_id'] = 'c' * 40
+        self.assertEqual(self.cache.get('key'), self.doc)
+        self.assertEqual(self.cache.stats(), dict(
+            entries=1,
+            size=self.doc_size,
+            max_bytes=self.doc_size * 2,
+            hits=2,
+            misses=1,
+            evictions=0,
+            hit_rate=2.0 / 3))
+
+    def test_lru(self):
+        self.cache.set('key1', self.doc)
+        self.cache.set('key2', self.doc)
+        self.cache.get('key1')
+        self.cache.set('key3', self.doc)
+        self.assertEqual(self.cache.get('key2'), None)
+        self.assertEqual(self.cache.get('key1'), self.doc)
+        self.assertEqual(self.cache.get('key3'), self.doc)
+        self.assertEqual(self.cache.size, self.doc_size * 2)
+        self.assertEqual(self.cache.evictions, 1)
+
+    def test_replace(self):
+        self.cache.set('key', self.doc)
+        self.cache.set('key', self.doc)
+        self.assertEqual(self.cache.size, self.doc_size)
+
+    def test_too_big(self):
+        self.cache.set('key', dict(self.doc, message='x' * self.doc_size * 2))
+        self.assertEqual(self.cache.get('key'), None)
+        self.assertEqual(self.cache.size, 0)
+
+    @mock.patch('allura.model.repository.time')
+    def test_expires(self, time):
+        time.return_value = 1000
+        self.cache.set('key1', self.doc, expires=True)
+        self.cache.set('key2', self.doc)
+        time.return_value = 1059
+        self.assertEqual(self.cache.get('key1'), self.doc)
+        time.return_value = 1060
+        self.assertEqual(self.cache.get('key1'), None)
+        self.assertEqual(self.cache.get('key2'), self.doc)
+        self.assertEqual(self.cache.size, self.doc_size)
+
+    def test_discard(self):
+        self.cache.set('key', self.doc)
+        self.cache.discard('key')
+        self.cache.discard('nonexistent')
+        self.assertEqual(self.cache.get('key'), None)
+        self.assertEqual(self.cache.size, 0)
+
+    def test_clear(self):
+        self.cache.set('key', self.doc)
+        self.cache.clear()
+        self.assertEqual(self.cache.get('key'), None)
+        self.assertEqual(self.cache.size, 0)
+
 
 class TestMergeRequest(object):
     def setUp(self):
@@ -26,7 +26,7 @@
 
 from alluratest.controller import setup_basic_test, setup_global_objects
 from allura.command import base, script, set_neighborhood_features, \
-    create_neighborhood, show_models, taskd_cleanup
+    create_neighborhood, show_models, taskd_cleanup, taskd
 from allura import model as M
 from allura.lib.exceptions import InvalidNBFeatureValueError
 from allura.tests import decorators as td
@@ -376,6 +376,109 @@ def test_status_log_retries():
     assert cmd._taskd_status.mock_calls == expected_calls
 
 
+# taskd unit tests
+def test_taskd_parse_pools():
+    cmd = taskd.TaskdCommand('taskd')
+    cmd.options = Mock(only=None)
+    pools = cmd._parse_pools(['repo=2:allura.tasks.repo_tasks.refresh,allura.tasks.repo_tasks.clone',
+                              'default=4'])
+    # the catch-all pool leaves the repo tasks to the repo pool
+    assert_equal(pools, [
+        ('repo', 2, ['allura.tasks.repo_tasks.refresh', 'allura.tasks.repo_tasks.clone'], None),
+        ('default', 4, None, ['allura.tasks.repo_tasks.refresh', 'allura.tasks.repo_tasks.clone']),
+    ])
+    assert_equal(cmd._parse_pools(['default=4']), [('default', 4, None, None)])
+    cmd.options = Mock(only='allura.tasks.mail_tasks.sendmail,allura.tasks.index_tasks.add_artifacts')
+    assert_equal(cmd._parse_pools(['mail=1', 'index=1:allura.tasks.index_tasks.add_artifacts']), [
+        ('mail', 1, ['allura.tasks.mail_tasks.sendmail'], None),
+        ('index', 1, ['allura.tasks.index_tasks.add_artifacts'], None),
+    ])
+    assert_equal(cmd._parse_pools(['mail=1:allura.tasks.mail_tasks.sendmail',
+                                   'index=1:allura.tasks.index_tasks.add_artifacts',
+                                   'default=1']), [
+        ('mail', 1, ['allura.tasks.mail_tasks.sendmail'], None),
+        ('index', 1, ['allura.tasks.index_tasks.add_artifacts'], None),
+    ])
+
+
+def _taskd_command(**options):
+    cmd = taskd.TaskdCommand('taskd')
+    cmd.options = Mock(only=None, max_tasks=0, batch_size=1, nocapture=False, **options)
+    cmd.args = ['test.ini']
+    cmd.keep_running = True
+    cmd.restart_when_done = False
+    cmd.is_child = False
+    cmd.children = {}
+    return cmd
+
+
+@patch('allura.command.taskd.time')
+@patch('allura.command.taskd.loadapp')
+@patch('allura.command.taskd.signal')
+@patch('allura.command.taskd.setproctitle')
+@patch('allura.command.taskd.os')
+def test_taskd_supervisor(os_, setproctitle, signal, loadapp, time):
+    cmd = _taskd_command(pools=['repo=1:allura.tasks.repo_tasks.refresh', 'default=2'])
+    os_.fork.side_effect = [101, 102, 103, 104]
+    waits = iter([(102, 256), (101, 0), (103, 0), (104, 0)])
+
+    def wait():
+        pid, status = next(waits)
+        if pid == 101:
+            cmd.keep_running = False  # e.g. SIGTERM
+        return pid, status
+    os_.wait.side_effect = wait
+    with patch.object(cmd, '_spawn_worker', wraps=cmd._spawn_worker) as spawn:
+        cmd.supervisor()
+    repo = ('repo', ['allura.tasks.repo_tasks.refresh'], None)
+    default = ('default', None, ['allura.tasks.repo_tasks.refresh'])
+    # the crashed worker is replaced, none are once stopping
+    assert_equal(spawn.call_args_list, [
+        call(loadapp.return_value, repo),
+        call(loadapp.return_value, default),
+        call(loadapp.return_value, default),
+        call(loadapp.return_value, default),
+    ])
+    time.sleep.assert_called_once_with(1)
+    assert_equal(cmd.children, {})
+    assert not os_.execv.called
+
+
+@patch('allura.command.taskd.signal')
+@patch('allura.command.taskd.setproctitle')
+@patch('allura.command.taskd.os')
+def test_taskd_spawn_worker_child(os_, setproctitle, signal):
+    cmd = _taskd_command()
+    os_.fork.return_value = 0
+    with patch.object(cmd, 'worker') as worker:
+        cmd._spawn_worker('app', ('default', None, ['a.b']))
+    worker.assert_called_once_with(wsgi_app='app', only=None, exclude=['a.b'])
+    os_._exit.assert_called_once_with(0)
+    assert cmd.is_child
+    os_.fork.return_value = 0
+    with patch.object(cmd, 'worker') as worker:
+        worker.side_effect = ValueError
+        cmd._spawn_worker('app', ('default', None, ['a.b']))
+    os_._exit.assert_called_with(1)
+
+
+@patch('allura.command.taskd.os')
+def test_taskd_worker_max_tasks(os_):
+    cmd = _taskd_command(max_tasks=3)
+    cmd.is_child = True
+    wsgi_app = Mock(return_value=[])
+    task = Mock(task_name='a.b', _id='1')
+    with patch.object(M.MonQTask, 'get_batch', return_value=[task]) as get_batch:
+        cmd.worker(wsgi_app=wsgi_app, exclude=['c.d'])
+    assert_equal(wsgi_app.call_count, 3)
+    assert_equal(get_batch.call_count, 3)
+    assert_equal(get_batch.call_args[1]['exclude'], ['c.d'])
+    assert not cmd.keep_running
+    assert cmd.restart_when_done
+    # the supervisor respawns it
+    assert not os_.execv.called
+
+
 class TestBackgroundCommand(object):
 
     cmd = 'allura.command.show_models.ReindexCommand'
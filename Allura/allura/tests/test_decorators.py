@@ -43,10 +43,11 @@ def test_post(self, c, MonQTask):
         def func(s, foo=None, **kw):
             pass
 
-        def mock_post(f, args, kw, delay=None):
+        def mock_post(f, args, kw, delay=None, coalesce=None):
             self.assertTrue(c.project.notifications_disabled)
             self.assertFalse('delay' in kw)
             self.assertEqual(delay, 1)
+            self.assertEqual(coalesce, None)
             self.assertEqual(kw, dict(foo=2))
             self.assertEqual(args, ('test',))
             self.assertEqual(f, func)
@@ -54,3 +55,13 @@ def mock_post(f, args, kw, delay=None):
         c.project.notifications_disabled = False
         MonQTask.post.side_effect = mock_post
         func.post('test', foo=2, delay=1)
+
+    @patch('allura.model.MonQTask')
+    def test_post_coalesce(self, MonQTask):
+        @task(coalesce='union')
+        def func(ids):
+            pass
+
+        func.post(['a'])
+        MonQTask.post.assert_called_once_with(
+            func, (['a'],), {}, delay=0, coalesce='union')
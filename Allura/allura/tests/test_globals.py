@@ -20,6 +20,7 @@
 
 import re
 import os
+import time
 import allura
 import unittest
 import hashlib
@@ -42,7 +43,7 @@
 
 from allura import model as M
 from allura.lib import helpers as h
-from allura.lib.app_globals import ForgeMarkdown, NeighborhoodCache
+from allura.lib.app_globals import ForgeMarkdown, MarkdownPool, NeighborhoodCache, RenderCache
 from allura.tests import decorators as td
 
 from forgewiki import model as WM
@@ -344,6 +345,20 @@ def test_macro_embed(oembed_fetch):
               r.replace('\n', ''))
 
 
+@patch('oembed.OEmbedEndpoint.fetch')
+def test_macro_embed_cached(oembed_fetch):
+    oembed_fetch.return_value = {
+        "html": '<iframe width="480" height="270" src="http://www.youtube.com/embed/kOLpSPEA72U?feature=oembed" '
+                'frameborder="0" allowfullscreen></iframe>)',
+    }
+    with patch.object(g, 'macro_cache', RenderCache(size=10)):
+        r1 = g.markdown_wiki.convert('[[embed url=http://www.youtube.com/watch?v=kOLpSPEA72U]]')
+        r2 = g.markdown_wiki.convert('See [[embed url=http://www.youtube.com/watch?v=kOLpSPEA72U]]')
+    assert_equal(oembed_fetch.call_count, 1)
+    assert_in('<div class="grid-20"><iframe', r1)
+    assert_in('<div class="grid-20"><iframe', r2)
+
+
 def test_macro_embed_notsupported():
     r = g.markdown_wiki.convert('[[embed url=http://vimeo.com/46163090]]')
     assert_equal(
@@ -378,6 +393,22 @@ def test_wiki_artifact_links():
         assert '<a class="alink" href="/p/test/wiki/Home/">[test:wiki:Home]</a>' in text, text
 
 
+@td.with_wiki
+def test_markdown_prefetches_links():
+    M.Shortlink.clear_request_cache()
+    with h.push_context('test', 'wiki', neighborhood='Projects'), \
+            patch.object(M.Shortlink, '_from_links', wraps=M.Shortlink._from_links) as from_links:
+        text = g.markdown.convert(
+            'See [Home], [test:wiki:Home], [here](Home) and [NoSuchPage]')
+        assert_equal(from_links.call_count, 1)
+        assert_in('<a class="alink" href="/p/test/wiki/Home/">[Home]</a>', text)
+        assert_in('<a class="" href="/p/test/wiki/Home/">here</a>', text)
+        assert_in('<span>[NoSuchPage]</span>', text)
+        # later renders in the same request use the cached shortlinks
+        g.markdown.convert('Back to [Home]')
+        assert_equal(from_links.call_count, 1)
+
+
 def test_markdown_links():
     with patch.dict(tg.config, {'nofollow_exempt_domains': 'foobar.net'}):
         text = g.markdown.convert('Read [here](http://foobar.net/) about our project')
@@ -751,6 +782,72 @@ def test_all_expected_keys_exist_in_cache(self):
         self.assertEqual(required_keys, keys)
 
 
+class TestRenderCache(unittest.TestCase):
+
+    def test_lru(self):
+        self.assertFalse(RenderCache().enabled)
+        cache = RenderCache(size=2)
+        cache.set('a', 'A')
+        cache.set('b', 'B')
+        self.assertEqual(cache.get('a'), 'A')
+        cache.set('c', 'C')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 'A')
+        self.assertEqual(cache.get('c'), 'C')
+        self.assertEqual((cache.hits, cache.misses), (3, 1))
+
+    def test_ttl(self):
+        cache = RenderCache(size=2, ttl=60)
+        cache.set('a', 'A')
+        with patch('allura.lib.app_globals.time.time', return_value=time.time() + 61):
+            self.assertIsNone(cache.get('a'))
+
+    @patch('allura.lib.app_globals.g')
+    def test_forge_markdown(self, g):
+        g.markdown_render_cache = RenderCache(size=10)
+        md = ForgeMarkdown(cache_variant=('test',))
+        html = md.convert('**bold**')
+        self.assertEqual(html, u'<p><strong>bold</strong></p>')
+        with patch('markdown.Markdown.convert') as convert:
+            self.assertEqual(md.convert('**bold**'), html)
+            self.assertFalse(convert.called)
+            # other renderers, macros and instances without a variant
+            # aren't served from the same entry
+            ForgeMarkdown(cache_variant=('other',)).convert('**bold**')
+            md.convert('**bold** [[quote foo]]')
+            ForgeMarkdown().convert('**bold**')
+            self.assertEqual(convert.call_count, 3)
+
+
+class TestMarkdownPool(unittest.TestCase):
+
+    def test_reuse(self):
+        pool = MarkdownPool()
+        factory = Mock(side_effect=ForgeMarkdown)
+        md = pool.get('a', factory)
+        self.assertIs(pool.get('a', factory), md)
+        self.assertIsNot(pool.get('b', factory), md)
+        self.assertEqual(factory.call_count, 2)
+
+    def test_in_use(self):
+        pool = MarkdownPool()
+        md = pool.get('a', ForgeMarkdown)
+        md.converting = 1
+        self.assertIsNot(pool.get('a', ForgeMarkdown), md)
+        md.converting = 0
+        self.assertIs(pool.get('a', ForgeMarkdown), md)
+
+    @td.with_wiki
+    def test_reset(self):
+        with h.push_context('test', 'wiki', neighborhood='Projects'):
+            md = g.markdown
+            md.convert('See [Home]')
+            self.assertEqual(len(md.treeprocessors['links'].alinks), 1)
+            self.assertIs(g.markdown, md)
+            self.assertEqual(md.treeprocessors['links'].alinks, [])
+            self.assertIsNot(g.forge_markdown(), md)
+
+
 class TestHandlePaging(unittest.TestCase):
 
     def setUp(self):
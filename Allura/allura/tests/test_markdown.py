@@ -41,7 +41,7 @@ def test_word_boundaries(self):
     @mock.patch('allura.lib.markdown_extensions.M.Shortlink.lookup')
     def test_legit_refs(self, lookup):
         shortlink = mock.Mock(url='/p/project/tool/artifact')
-        shortlink.ref.artifact.deleted = False
+        shortlink.cached_ref.artifact.deleted = False
         lookup.return_value = shortlink
         self.assertEqual(mde.TracRef1().sub('#100'),
                          '[#100](/p/project/tool/artifact)')
@@ -63,7 +63,7 @@ def test_word_boundaries(self):
     @mock.patch('allura.lib.markdown_extensions.M.Shortlink.lookup')
     def test_legit_refs(self, lookup):
         shortlink = mock.Mock(url='/p/project/tool/artifact/')
-        shortlink.ref.artifact.deleted = False
+        shortlink.cached_ref.artifact.deleted = False
         lookup.return_value = shortlink
         pattern = mde.TracRef2()
         pattern.get_comment_slug = lambda *args: 'abc'
@@ -101,7 +101,7 @@ class TestPatternReplacingProcessor(unittest.TestCase):
     @mock.patch('allura.lib.markdown_extensions.M.Shortlink.lookup')
     def test_run(self, lookup):
         shortlink = mock.Mock(url='/p/project/tool/artifact')
-        shortlink.ref.artifact.deleted = False
+        shortlink.cached_ref.artifact.deleted = False
         lookup.return_value = shortlink
         p = mde.PatternReplacingProcessor(mde.TracRef1(), mde.TracRef2())
         res = p.run(['#100', 'ticket:100'])
@@ -112,13 +112,14 @@ def test_run(self, lookup):
 
 class TestCommitMessageExtension(unittest.TestCase):
 
+    @mock.patch('allura.lib.markdown_extensions.M.Shortlink.prefetch')
     @mock.patch('allura.lib.markdown_extensions.TracRef2.get_comment_slug')
     @mock.patch('allura.lib.markdown_extensions.M.Shortlink.lookup')
-    def test_convert(self, lookup, get_comment_slug):
+    def test_convert(self, lookup, get_comment_slug, prefetch):
         from allura.lib.app_globals import ForgeMarkdown
 
         shortlink = mock.Mock(url='/p/project/tool/artifact/')
-        shortlink.ref.artifact.deleted = False
+        shortlink.cached_ref.artifact.deleted = False
         lookup.return_value = shortlink
         get_comment_slug.return_value = 'abc'
         app = mock.Mock(url='/p/project/tool/')
@@ -146,3 +147,4 @@ def test_convert(self, lookup, get_comment_slug):
             extensions=[mde.CommitMessageExtension(app), 'nl2br'],
             output_format='html4')
         self.assertEqual(md.convert(text), expected_html)
+        prefetch.assert_called_once_with(set(['#100', 'r2', '#2']))
@@ -21,6 +21,7 @@
 import shutil
 import sys
 import unittest
+from datetime import datetime, timedelta
 from base64 import b64encode
 import logging
 
@@ -143,9 +144,9 @@ def test_del_projects(self):
 
     @td.with_wiki
     def test_add_artifacts(self):
-        from allura.lib.search import find_shortlinks
-        with mock.patch('allura.lib.search.find_shortlinks') as find_slinks:
-            find_slinks.side_effect = lambda s: find_shortlinks(s)
+        from allura.lib.search import index_render
+        with mock.patch('allura.lib.search.index_render') as render:
+            render.side_effect = lambda s: index_render(s)
 
             old_shortlinks = M.Shortlink.query.find().count()
             old_solr_size = len(g.solr.db)
@@ -167,9 +168,61 @@ def test_add_artifacts(self):
             M.main_orm_session.clear()
             t3 = _TestArtifact.query.get(_shorthand_id='t3')
             assert len(t3.backrefs) == 5, t3.backrefs
-            assert_equal(find_slinks.call_args_list,
+            # the text is rendered just once for both solr and shortlinks
+            assert_equal(render.call_args_list,
                          [mock.call(a.index().get('text')) for a in artifacts])
 
+    @td.with_wiki
+    @mock.patch('allura.tasks.index_tasks.g.solr')
+    def test_add_artifacts_skip_unchanged(self, solr):
+        artifacts = [_TestArtifact(_shorthand_id='tu_%s' % x) for x in range(3)]
+        M.artifact_orm_session.flush()
+        ref_ids = [M.ArtifactReference.from_artifact(a)._id for a in artifacts]
+        M.artifact_orm_session.flush()
+        assert_equal(index_tasks.add_artifacts(ref_ids), dict(indexed=3, skipped=0))
+        M.main_orm_session.flush()
+        M.main_orm_session.clear()
+        assert_equal(index_tasks.add_artifacts(ref_ids), dict(indexed=0, skipped=3))
+        assert_equal(solr.bulk_add.call_count, 1)
+        assert_equal(index_tasks.add_artifacts(ref_ids, skip_unchanged=False),
+                     dict(indexed=3, skipped=0))
+        M.main_orm_session.flush()
+        M.main_orm_session.clear()
+        M.ArtifactReference.clear_solr_hashes(c.project._id)
+        assert_equal(index_tasks.add_artifacts(ref_ids), dict(indexed=3, skipped=0))
+
+    @td.with_wiki
+    @mock.patch('allura.tasks.index_tasks.g.solr')
+    def test_add_artifacts_bumps_search_generation(self, solr):
+        solr.visible_after.return_value = 10
+        artifacts = [_TestArtifact(_shorthand_id='tg_%s' % x) for x in range(3)]
+        M.artifact_orm_session.flush()
+        ref_ids = [M.ArtifactReference.from_artifact(a)._id for a in artifacts]
+        M.artifact_orm_session.flush()
+        with mock.patch.object(M.SearchGeneration, 'bump') as bump:
+            index_tasks.add_artifacts(ref_ids)
+            # not until solr has made the documents visible
+            assert not bump.called
+            task = M.MonQTask.query.get(
+                task_name='allura.tasks.index_tasks.bump_search_generations')
+            assert_equal(task.args, [[c.app.config._id]])
+            assert task.time_queue > datetime.utcnow() + timedelta(seconds=10)
+            task()
+            bump.assert_called_once_with([c.app.config._id])
+
+    @mock.patch('allura.tasks.index_tasks.g.solr')
+    def test_bump_search_generations_not_early(self, solr):
+        solr.visible_after.side_effect = [1, 10]
+        with mock.patch.object(M.SearchGeneration, 'bump') as bump:
+            index_tasks._bump_search_generations(['a'])
+            index_tasks._bump_search_generations(['b'])
+            assert not bump.called
+        tasks = M.MonQTask.query.find(dict(
+            task_name='allura.tasks.index_tasks.bump_search_generations')).sort('time_queue').all()
+        # the second bump waits for its own delay, not the first one's
+        assert_equal([t.args for t in tasks], [[['a']], [['b']]])
+        assert tasks[1].time_queue > datetime.utcnow() + timedelta(seconds=10)
+
     @td.with_wiki
     @mock.patch('allura.tasks.index_tasks.g.solr')
     def test_del_artifacts(self, solr):
@@ -185,10 +238,10 @@ def test_del_artifacts(self, solr):
         M.main_orm_session.clear()
         new_shortlinks = M.Shortlink.query.find().count()
         assert old_shortlinks + 5 == new_shortlinks, 'Shortlinks not created'
-        assert solr.add.call_count == 1
+        assert solr.bulk_add.call_count == 1
         sort_key = operator.itemgetter('id')
         assert_equal(
-            sorted(solr.add.call_args[0][0], key=sort_key),
+            sorted(solr.bulk_add.call_args[0][0], key=sort_key),
             sorted([ref.artifact.solarize() for ref in arefs],
                    key=sort_key))
         index_tasks.del_artifacts(ref_ids)
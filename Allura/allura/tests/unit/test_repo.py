@@ -15,7 +15,10 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
+import os
+import shutil
 import datetime
+import tempfile
 import unittest
 from mock import patch, Mock, MagicMock, call
 from nose.tools import assert_equal
@@ -25,7 +28,7 @@
 
 from allura import model as M
 from allura.controllers.repository import topo_sort
-from allura.model.repository import zipdir, prefix_paths_union
+from allura.model.repository import zipdir, prefix_paths_union, prune_tarballs
 from allura.model.repo_refresh import (
     CommitRunDoc,
     CommitRunBuilder,
@@ -333,6 +336,32 @@ def test_exception_logged(self, tg, popen):
         self.assertTrue("STDERR: 2" in emsg)
 
 
+class TestPruneTarballs(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        for i, name in enumerate(['old.zip', 'new.zip', 'newest.zip', 'other.tmp']):
+            fn = os.path.join(self.dirname, name)
+            with open(fn, 'wb') as fp:
+                fp.write('x' * 10)
+            os.utime(fn, (1000 + i, 1000 + i))
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def test_prune(self):
+        prune_tarballs(self.dirname, 25)
+        self.assertEqual(sorted(os.listdir(self.dirname)),
+                         ['new.zip', 'newest.zip', 'other.tmp'])
+        prune_tarballs(self.dirname, 10)
+        self.assertEqual(sorted(os.listdir(self.dirname)),
+                         ['newest.zip', 'other.tmp'])
+
+    def test_no_limit(self):
+        prune_tarballs(self.dirname, 0)
+        self.assertEqual(len(os.listdir(self.dirname)), 4)
+
+
 class TestPrefixPathsUnion(unittest.TestCase):
 
     def test_disjoint(self):
@@ -25,7 +25,7 @@
 from allura.tests import decorators as td
 from alluratest.controller import setup_basic_test
 from allura.lib.solr import Solr, escape_solr_arg
-from allura.lib.search import search_app, SearchIndexable
+from allura.lib.search import search_app, SearchIndexable, SearchCache, cached_search
 
 
 class TestSolr(unittest.TestCase):
@@ -81,6 +81,37 @@ def test_commit(self, pysolr):
         calls = [mock.call('arg', kw='kw')] * 2
         pysolr.Solr().commit.assert_has_calls(calls)
 
+    @mock.patch('allura.lib.solr.pysolr')
+    def test_bulk_add(self, pysolr):
+        servers = ['server1', 'server2']
+        solr = Solr(servers, commit=False, commitWithin=None, bulk_chunk_bytes=100)
+        docs = [{'id': str(i), 'text': 'x' * 40} for i in range(5)]
+        stats = solr.bulk_add(iter(docs))
+        assert_equal(stats.docs, 5)
+        # fast pushes double the chunk size
+        assert_equal(stats.chunks, 2)
+        calls = [mock.call(docs[0:2], commit=False, commitWithin=10000)] * 2 + \
+                [mock.call(docs[2:5], commit=False, commitWithin=10000)] * 2
+        pysolr.Solr().add.assert_has_calls(calls, any_order=True)
+        assert_equal(pysolr.Solr().add.call_count, 4)
+
+    @mock.patch('allura.lib.solr.time')
+    @mock.patch('allura.lib.solr.pysolr')
+    def test_bulk_add_retry(self, pysolr, time):
+        time.time.return_value = 0
+        pysolr.SolrError = Exception
+        solr = Solr(['server1'], commit=False, bulk_retries=2)
+        pysolr.Solr().add.side_effect = [Exception('slow'), None]
+        stats = solr.bulk_add([{'id': '1'}])
+        assert_equal(stats.retries, 1)
+        assert_equal(pysolr.Solr().add.call_count, 2)
+
+        pysolr.Solr().add.reset_mock()
+        pysolr.Solr().add.side_effect = Exception('down')
+        with self.assertRaises(Exception):
+            solr.bulk_add([{'id': '1'}])
+        assert_equal(pysolr.Solr().add.call_count, 3)
+
     @mock.patch('allura.lib.solr.pysolr')
     def test_search(self, pysolr):
         servers = ['server1', 'server2']
@@ -117,6 +148,56 @@ def test_site_admin_search(self, search):
             'username_s:admin1 || username_s:root', fq=fq, ignore_errors=False)
 
 
+class TestSearchCache(unittest.TestCase):
+
+    def test_lru(self):
+        cache = SearchCache(size=2, ttl=60)
+        cache.set('a', [1])
+        cache.set('b', [2])
+        assert_equal(cache.get('a'), [1])
+        cache.set('c', [3])
+        assert_equal(cache.get('b'), None)
+        assert_equal(cache.get('a'), [1])
+        assert_equal(cache.get('c'), [3])
+        assert_equal((cache.hits, cache.misses), (3, 1))
+
+    def test_copies(self):
+        cache = SearchCache(size=2, ttl=60)
+        results = [{'url_s': '/a'}]
+        cache.set('a', results)
+        results[0]['url_s'] += '?version=1'
+        cache.get('a')[0]['url_s'] += '?version=1'
+        assert_equal(cache.get('a'), [{'url_s': '/a'}])
+
+    @mock.patch('allura.lib.search.time')
+    def test_ttl(self, time):
+        cache = SearchCache(size=2, ttl=60)
+        time.time.return_value = 100
+        cache.set('a', [1])
+        time.time.return_value = 159
+        assert_equal(cache.get('a'), [1])
+        time.time.return_value = 160
+        assert_equal(cache.get('a'), None)
+
+    @mock.patch('allura.lib.search.search')
+    @mock.patch('allura.lib.search.g')
+    def test_cached_search(self, g, search):
+        g.search_cache = SearchCache(size=0)
+        cached_search(('p', 'a'), 'foo', rows=0)
+        cached_search(('p', 'a'), 'foo', rows=0)
+        assert_equal(search.call_count, 2)
+
+        search.reset_mock()
+        g.search_cache = SearchCache(size=10)
+        g.search_cache.key = lambda scope_ids, q, kw: repr((scope_ids, q, kw))
+        search.return_value = ['result']
+        assert_equal(cached_search(('p', 'a'), 'foo', rows=0), ['result'])
+        assert_equal(cached_search(('p', 'a'), 'foo', rows=0), ['result'])
+        search.assert_called_once_with('foo', rows=0)
+        cached_search(('p', 'b'), 'foo', rows=0)
+        assert_equal(search.call_count, 2)
+
+
 class TestSearchIndexable(unittest.TestCase):
 
     def setUp(self):
@@ -140,6 +221,17 @@ def test_solarize_html_in_text(self):
         self.obj.index = lambda: dict(text='&lt;script&gt;a(1)&lt;/script&gt;')
         assert_equal(self.obj.solarize(), dict(text='<script>a(1)</script>'))
 
+    def test_solarize_code_block(self):
+        self.obj.index = lambda: dict(text='~~~~\nx = <b>1</b>\n~~~~')
+        assert_equal(self.obj.solarize(), dict(text='x = <b>1</b>'))
+
+    def test_solarize_with_shortlinks(self):
+        self.obj.index = lambda: None
+        assert_equal(self.obj.solarize_with_shortlinks(), (None, []))
+        self.obj.index = lambda: dict(text='# Header')
+        assert_equal(self.obj.solarize_with_shortlinks(),
+                     (dict(text='Header'), []))
+
 
 class TestSearch_app(unittest.TestCase):
 
@@ -16,20 +16,29 @@
 #       under the License.
 
 import os
+import re
+import sys
 import shutil
 import string
 import logging
+import atexit
+import binascii
+import fcntl
 import tempfile
+import subprocess
 from datetime import datetime
 from contextlib import contextmanager
-from time import time
+from time import time, sleep
+from cStringIO import StringIO
+from Queue import Queue, Empty
+from threading import Thread, Lock, Timer
 
 import tg
 import git
 import gitdb
 from pylons import tmpl_context as c
 from pymongo.errors import DuplicateKeyError
-from paste.deploy.converters import asbool
+from paste.deploy.converters import asbool, asint
 
 from ming.base import Object
 from ming.orm import Mapper, session
@@ -37,6 +46,7 @@
 
 from allura.lib import helpers as h
 from allura.model.repository import topological_sort, prefix_paths_union
+from allura.model.repository import repo_object_cache
 from allura import model as M
 
 log = logging.getLogger(__name__)
@@ -44,6 +54,256 @@
 gitdb.util.mman = gitdb.util.mman.__class__(
     max_open_handles=128)
 
+# "Name <email> 1234567890 +0000" from author/committer lines
+SIGNATURE_RE = re.compile(r'^(.*) <(.*)> (\d+) [+-]\d{4}$')
+
+# bytes read at a time from git commands whose output is streamed
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class GitObjectReader(object):
+    '''Reads raw objects from a single ``git cat-file --batch`` process,
+    and object info from a ``--batch-check`` one, started when needed'''
+
+    def __init__(self, git_dir):
+        self.git_dir = git_dir
+        self.proc = self._start('--batch')
+        self._check_proc = None
+        self.lock = Lock()
+        self.last_used = time()
+
+    def _start(self, mode):
+        return subprocess.Popen(
+            ['git', 'cat-file', mode],
+            cwd=self.git_dir,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE)
+
+    def read(self, oid):
+        '''Return (type, data) for the object with the given hex id'''
+        self.proc.stdin.write(oid + '\n')
+        self.proc.stdin.flush()
+        header = self.proc.stdout.readline().split()
+        if len(header) != 3:
+            raise KeyError(oid)
+        data = self.proc.stdout.read(int(header[2]))
+        self.proc.stdout.read(1)  # trailing newline
+        return header[1], data
+
+    def info(self, name):
+        '''
+        Return (hex id, type, size) for the object with the given name, which
+        can be anything git rev-parse accepts (e.g. "master^0" or
+        "<commit>:<path>"), or None if there is no such object.
+        '''
+        if '\n' in name:
+            return None
+        if self._check_proc is None:
+            self._check_proc = self._start('--batch-check')
+        self._check_proc.stdin.write(name + '\n')
+        self._check_proc.stdin.flush()
+        header = self._check_proc.stdout.readline().rstrip('\n')
+        # the reply for an unknown name echoes the name back, and that can
+        # contain spaces, e.g. "HEAD:some dir/nope missing"
+        if header.rsplit(' ', 1)[-1] in ('missing', 'ambiguous'):
+            return None
+        header = header.split()
+        if len(header) != 3:
+            return None
+        return header[0], header[1], int(header[2])
+
+    @property
+    def alive(self):
+        return all(p.poll() is None
+                   for p in (self.proc, self._check_proc) if p is not None)
+
+    def close(self):
+        for proc in (self.proc, self._check_proc):
+            if proc is not None:
+                proc.stdin.close()
+                proc.wait()
+
+
+class GitObjectReaderPool(object):
+    '''
+    Long-lived :class:`GitObjectReader`s, one per repo, shared by all the
+    threads in a process, so web requests don't start git processes to
+    look up objects.  Readers that haven't been used for idle_timeout
+    seconds are closed.
+    '''
+
+    def __init__(self, idle_timeout=None):
+        self._idle_timeout = idle_timeout
+        self._readers = {}
+        self._lock = Lock()
+        self._reaper = None
+
+    @property
+    def idle_timeout(self):
+        if self._idle_timeout is None:
+            self._idle_timeout = asint(
+                tg.config.get('scm.git.object_reader.idle_timeout', 300))
+        return self._idle_timeout
+
+    @contextmanager
+    def reader(self, git_dir):
+        '''Use the reader for git_dir, while no other thread can'''
+        with self._lock:
+            self._close_idle()
+            reader = self._readers.get(git_dir)
+            if reader is None or not reader.alive:
+                reader = self._readers[git_dir] = GitObjectReader(git_dir)
+            if self._reaper is None:
+                # so a quiet process doesn't keep idle readers forever
+                self._reaper = Thread(target=self._reap)
+                self._reaper.daemon = True
+                self._reaper.start()
+        with reader.lock:
+            reader.last_used = time()
+            try:
+                yield reader
+            except (IOError, ValueError):
+                # the process went away mid request; start a new one next time
+                self._discard(git_dir, reader)
+                raise
+
+    def _discard(self, git_dir, reader):
+        with self._lock:
+            if self._readers.get(git_dir) is reader:
+                del self._readers[git_dir]
+        try:
+            reader.close()
+        except (IOError, OSError):
+            pass
+
+    def _reap(self):
+        while True:
+            sleep(max(self.idle_timeout / 2.0, 1))
+            with self._lock:
+                self._close_idle()
+
+    def _close_idle(self):
+        now = time()
+        for git_dir, reader in self._readers.items():
+            if now - reader.last_used < self.idle_timeout:
+                continue
+            # skip it if it's in use right now
+            if reader.lock.acquire(False):
+                try:
+                    del self._readers[git_dir]
+                    reader.close()
+                finally:
+                    reader.lock.release()
+
+    def close(self):
+        with self._lock:
+            for reader in self._readers.values():
+                reader.close()
+            self._readers.clear()
+
+
+object_readers = GitObjectReaderPool()
+atexit.register(object_readers.close)
+
+
+class MergeScratchPool(object):
+    '''
+    Scratch bare repos for merge requests, one per upstream and downstream
+    repo pair, reused by every mergeability check and merge request view.
+    Instead of fetching or cloning, they borrow objects from the two repos
+    through alternates, written once when the scratch repo is created, so
+    nothing is ever written to the real repos and object lookups only look
+    at those two repos' packs.
+
+    Merge bases and mergeability only depend on the two commits involved,
+    so they are kept in :data:`~allura.model.repository.repo_object_cache`
+    by (upstream commit, downstream commit).
+    '''
+
+    def __init__(self, root=None):
+        self._root = root
+        self._lock = Lock()
+
+    @property
+    def root(self):
+        if self._root is None:
+            self._root = tg.config.get('scm.merge.git.scratch_root') or \
+                os.path.join(tempfile.gettempdir(), 'allura-merge-scratch')
+        return self._root
+
+    def path(self, upstream, downstream):
+        return os.path.join(self.root, '%s-%s.git' % (upstream._id, downstream._id))
+
+    def repo(self, upstream, downstream):
+        '''Return a GitImplementation for the scratch repo of upstream and
+        downstream, which can see all the objects in both'''
+        path = self.path(upstream, downstream)
+        if not os.path.isdir(os.path.join(path, 'objects')):
+            self._create(path, (upstream, downstream))
+        return GitImplementation(Object(full_fs_path=path))
+
+    def _create(self, path, repos):
+        try:
+            os.makedirs(self.root)
+        except OSError:
+            if not os.path.isdir(self.root):
+                raise
+        # other threads and processes may be creating it too
+        with self._lock, open(os.path.join(self.root, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if os.path.isdir(os.path.join(path, 'objects')):
+                    return
+                tmp_path = tempfile.mkdtemp(dir=self.root, prefix='.tmp-')
+                git.Repo.init(tmp_path, bare=True)
+                alternates = []
+                for r in repos:
+                    objects = h.really_unicode(
+                        os.path.join(r.full_fs_path, 'objects')).encode('utf-8')
+                    if objects not in alternates:
+                        alternates.append(objects)
+                fn = os.path.join(tmp_path, 'objects', 'info', 'alternates')
+                with open(fn, 'w') as fp:
+                    fp.write(''.join(d + '\n' for d in alternates))
+                if os.path.exists(path):
+                    shutil.rmtree(path)  # left half made
+                os.rename(tmp_path, path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _cached(self, key, compute):
+        if repo_object_cache.enabled:
+            doc = repo_object_cache.get(key)
+            if doc is not None:
+                return doc['result']
+        result = compute()
+        if repo_object_cache.enabled:
+            repo_object_cache.set(key, dict(result=result))
+        return result
+
+    def merge_base(self, upstream, downstream, source, target):
+        '''The merge base of commit source, in the downstream repo, and
+        commit target, in the upstream repo'''
+        def compute():
+            scratch = self.repo(upstream, downstream)
+            return scratch._git.git.merge_base(source, target)
+        return self._cached(('git:merge_base', source, target), compute)
+
+    def can_merge(self, upstream, downstream, source, target):
+        '''True if merging commit source, in the downstream repo, into
+        commit target, in the upstream repo, would have no conflicts'''
+        def compute():
+            merge_base = self.merge_base(upstream, downstream, source, target)
+            scratch = self.repo(upstream, downstream)
+            # print out merge result without a checkout, or touching
+            # anything; see http://stackoverflow.com/a/6283843
+            merge_tree = scratch._git.git.merge_tree(merge_base, target, source)
+            return '+<<<<<<<' not in merge_tree
+        return self._cached(('git:can_merge', source, target), compute)
+
+
+merge_scratch = MergeScratchPool()
+
 
 class GitLibCmdWrapper(object):
 
@@ -61,6 +321,7 @@ class Repository(M.Repository):
     tool_name = 'Git'
     repo_id = 'git'
     type_s = 'Git Repository'
+    _commit_graph = True
 
     class __mongometa__:
         name = 'git-repository'
@@ -102,16 +363,9 @@ def can_merge(self, mr):
         """
         Given merge request `mr` determine if it can be merged w/o conflicts.
         """
-        g = self._impl._git.git
-        # http://stackoverflow.com/a/6283843
-        # fetch source branch
-        g.fetch(mr.downstream_repo.full_fs_path, mr.source_branch)
-        # find merge base
-        merge_base = g.merge_base(mr.downstream.commit_id, mr.target_branch)
-        # print out merge result, but don't actually touch anything
-        merge_tree = g.merge_tree(
-            merge_base, mr.target_branch, mr.downstream.commit_id)
-        return '+<<<<<<<' not in merge_tree
+        return merge_scratch.can_merge(
+            self, mr.downstream_repo, mr.downstream.commit_id,
+            self.rev_to_commit_id(mr.target_branch))
 
     def merge(self, mr):
         g = self._impl._git.git
@@ -224,8 +478,8 @@ def commit(self, rev):
         if result is None:
             # find the id by branch/tag name
             try:
-                impl = self._git.rev_parse(str(rev) + '^0')
-                result = cache.get(M.repository.Commit, dict(_id=impl.hexsha))
+                hexsha = self._resolve_commit(rev)
+                result = cache.get(M.repository.Commit, dict(_id=hexsha))
             except Exception:
                 url = ''
                 try:
@@ -239,6 +493,32 @@ def commit(self, rev):
             result.set_context(self._repo)
         return result
 
+    def _resolve_commit(self, rev):
+        if self._use_object_readers:
+            info = self._object_info(str(rev) + '^0')
+            if info is None:
+                raise KeyError(rev)
+            return info[0]
+        return self._git.rev_parse(str(rev) + '^0').hexsha
+
+    @LazyProperty
+    def _use_object_readers(self):
+        '''
+        Whether to look up objects through the long-lived cat-file processes
+        in :data:`object_readers` (scm.git.object_backend = cat-file), rather
+        than with GitPython, which starts new git processes for each request.
+        '''
+        return tg.config.get('scm.git.object_backend', 'gitpython') == 'cat-file'
+
+    @LazyProperty
+    def _max_reader_blob_size(self):
+        return asint(tg.config.get(
+            'scm.git.object_reader.max_blob_size', 1024 * 1024))
+
+    def _object_info(self, name):
+        with object_readers.reader(self._repo.full_fs_path) as reader:
+            return reader.info(name)
+
     def all_commit_ids(self):
         """Yield commit ids, starting with the head(s) of the commit tree and
         ending with the root (first commit).
@@ -252,6 +532,48 @@ def all_commit_ids(self):
             seen.add(ci.binsha)
             yield ci.hexsha
 
+    def ref_heads(self):
+        if self.is_empty():
+            return []
+        # %(*objectname) is the commit an annotated tag points at
+        out = self._git.git.for_each_ref(
+            '--format=%(refname) %(objectname) %(*objectname)',
+            'refs/heads', 'refs/tags')
+        result = []
+        for line in out.splitlines():
+            parts = line.split()
+            result.append(dict(name=parts[0], object_id=parts[-1]))
+        return result
+
+    def ref_kind(self, refname):
+        for prefix, kind in (('refs/heads/', 'branch'), ('refs/tags/', 'tag')):
+            if refname.startswith(prefix):
+                return kind, refname[len(prefix):]
+        return None
+
+    def commit_ids_since(self, old_heads, new_heads):
+        old_ids = set(hd['object_id'] for hd in old_heads)
+        new_ids = set(hd['object_id'] for hd in new_heads)
+        if not old_ids:
+            return None
+        try:
+            # commits that were reachable before and aren't anymore mean a
+            # force push or a deleted branch; let the full scan sort it out
+            lost = self._git.git.rev_list(
+                '--count', *(list(old_ids) + ['--not'] + list(new_ids)))
+            if int(lost):
+                return None
+            if not new_ids - old_ids:
+                return []
+            out = self._git.git.rev_list(
+                '--topo-order', *(list(new_ids - old_ids) + ['--not'] + list(old_ids)))
+        except git.GitCommandError:
+            # an old head has been garbage collected
+            log.info('Unable to list new commits for %s incrementally',
+                     self._repo, exc_info=True)
+            return None
+        return out.split()
+
     def new_commits(self, all_commits=False):
         graph = {}
 
@@ -301,6 +623,203 @@ def refresh_commit_info(self, oid, seen, lazy=True):
         self.refresh_tree_info(ci.tree, seen, lazy)
         return True
 
+    def refresh_commit_info_batch(self, oids, seen, lazy=True):
+        """
+        Refresh commit and tree info for many commits at once.
+
+        The commits are split into batches of ``scm.refresh.git.batch_size``
+        which are handled by ``scm.refresh.git.workers`` threads, each parsing
+        raw objects from its own ``git cat-file --batch`` process and saving
+        each batch with multi-document inserts.  Commits that can't be parsed
+        that way are refreshed with GitPython afterwards, in this thread,
+        since its repo object isn't safe to share between threads.
+        """
+        num_workers = asint(tg.config.get('scm.refresh.git.workers', 2))
+        batch_size = asint(tg.config.get('scm.refresh.git.batch_size', 100))
+        batches = Queue()
+        for s in range(0, len(oids), batch_size):
+            batches.put(oids[s:s + batch_size])
+        errors = []
+        unparsed = []
+        seen_lock = Lock()
+
+        def work():
+            reader = GitObjectReader(self._repo.full_fs_path)
+            try:
+                while not errors:
+                    try:
+                        batch = batches.get_nowait()
+                    except Empty:
+                        break
+                    unparsed.extend(self._refresh_commit_batch(
+                        reader, batch, seen, lazy, seen_lock))
+                    log.info('Refresh commit info batch of %d: %s',
+                             len(batch), batch[-1])
+            except Exception:
+                log.exception('Error refreshing commit info for %s', self._repo)
+                errors.append(sys.exc_info())
+            finally:
+                reader.close()
+        num_workers = min(num_workers, batches.qsize())
+        if num_workers <= 1:
+            work()
+        else:
+            threads = [Thread(target=work) for i in range(num_workers)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+        for oid in unparsed:
+            # something GitPython knows how to make sense of, hopefully
+            self.refresh_commit_info(oid, seen, lazy)
+
+    def _refresh_commit_batch(self, reader, oids, seen, lazy, seen_lock):
+        """
+        Refresh the commits in oids, and return the ids of any that couldn't
+        be parsed.  Trees are only added to seen once they're stored, so
+        other threads never skip a tree that isn't in mongo yet.
+        """
+        from allura.model.repository import CommitDoc, TreeDoc
+        existing = set(ci._id for ci in CommitDoc.m.find(
+            dict(_id={'$in': oids}), validate=False))
+        if lazy:
+            oids = [oid for oid in oids if oid not in existing]
+        ci_docs = []
+        unparsed = []
+        for oid in oids:
+            ci_doc = self._parse_commit(oid, reader.read(oid)[1])
+            if ci_doc is None:
+                unparsed.append(oid)
+            else:
+                ci_docs.append(ci_doc)
+
+        # Read trees breadth first, skipping any already stored, then save the
+        # deepest ones first so a stored tree always has its subtrees stored
+        tree_levels = []
+        batch_seen = set()
+        tree_ids = [ci_doc.tree_id for ci_doc in ci_docs]
+        while tree_ids:
+            unseen = []
+            for tree_id in tree_ids:
+                binsha = binascii.unhexlify(tree_id)
+                if binsha not in seen and binsha not in batch_seen:
+                    batch_seen.add(binsha)
+                    unseen.append(tree_id)
+            if lazy and unseen:
+                stored = set(t._id for t in TreeDoc.m.find(
+                    dict(_id={'$in': unseen}), validate=False))
+                unseen = [tree_id for tree_id in unseen if tree_id not in stored]
+            tree_docs = [self._parse_tree(tree_id, reader.read(tree_id)[1])
+                         for tree_id in unseen]
+            tree_levels.append(tree_docs)
+            tree_ids = [t.id for tree_doc in tree_docs for t in tree_doc.tree_ids]
+        for tree_docs in reversed(tree_levels):
+            self._save_docs(TreeDoc, tree_docs, lazy)
+        with seen_lock:
+            seen.update(batch_seen)
+
+        self._save_docs(CommitDoc, [
+            ci_doc for ci_doc in ci_docs if ci_doc._id not in existing], True)
+        for ci_doc in ci_docs:
+            if ci_doc._id in existing:
+                fields = dict((k, v) for k, v in ci_doc.iteritems()
+                              if k not in ('_id', 'repo_ids'))
+                CommitDoc.m.collection.update(dict(_id=ci_doc._id), {'$set': fields})
+
+    def _save_docs(self, doc_cls, docs, lazy):
+        if not docs:
+            return
+        data = [doc.m.schema.validate(doc) for doc in docs]
+        if not lazy:
+            for d in data:
+                doc_cls.m.collection.save(d)
+            return
+        try:
+            doc_cls.m.collection.insert(data, continue_on_error=True)
+        except DuplicateKeyError:
+            # another refresh got there first
+            pass
+
+    def _parse_commit(self, oid, data):
+        from allura.model.repository import CommitDoc
+        header, _, message = data.partition('\n\n')
+        args = dict(_id=oid, parent_ids=[], child_ids=[], repo_ids=[])
+        for line in header.split('\n'):
+            if line.startswith(' '):
+                continue  # continuation of a gpgsig or mergetag header
+            key, _, value = line.partition(' ')
+            if key == 'tree':
+                args['tree_id'] = value
+            elif key == 'parent':
+                args['parent_ids'].append(value)
+            elif key in ('author', 'committer'):
+                match = SIGNATURE_RE.match(value)
+                if match is None:
+                    return None
+                name, email, timestamp = match.groups()
+                args['authored' if key == 'author' else 'committed'] = Object(
+                    name=h.really_unicode(name),
+                    email=h.really_unicode(email),
+                    date=datetime.utcfromtimestamp(int(timestamp)))
+        if 'authored' not in args or 'committed' not in args:
+            return None
+        args['message'] = h.really_unicode(message)
+        return CommitDoc(args)
+
+    def _parse_tree(self, oid, data):
+        from allura.model.repository import TreeDoc
+        doc = TreeDoc(dict(
+            _id=oid,
+            tree_ids=[],
+            blob_ids=[],
+            other_ids=[]))
+        pos = 0
+        while pos < len(data):
+            space = data.index(' ', pos)
+            nul = data.index('\0', space)
+            mode = data[pos:space]
+            name = data[space + 1:nul]
+            obj_id = binascii.hexlify(data[nul + 1:nul + 21])
+            pos = nul + 21
+            if mode == '160000':
+                continue  # submodule
+            obj = Object(name=h.really_unicode(name), id=obj_id)
+            if mode.lstrip('0') == '40000':
+                doc.tree_ids.append(obj)
+            else:
+                doc.blob_ids.append(obj)
+        return doc
+
+    def iter_changed_paths(self, commits):
+        # diff-tree compares a commit with whatever "parents" follow it on
+        # its input line, so merges are diffed against the first parent only
+        for chunk in [commits[s:s + 1000] for s in range(0, len(commits), 1000)]:
+            lines = ['%s %s\n' % (cid, parent) if parent else '%s\n' % cid
+                     for cid, parent in chunk]
+            proc = subprocess.Popen(
+                ['git', 'diff-tree', '--stdin', '-r', '-t', '--root',
+                 '--name-only', '--always', '-z'],
+                cwd=self._repo.full_fs_path,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE)
+            out, _ = proc.communicate(''.join(lines))
+            if proc.returncode:
+                raise git.GitCommandError(['git', 'diff-tree'], proc.returncode)
+            pending = set(str(cid) for cid, parent in chunk)
+            ci_id, paths = None, []
+            for token in out.split('\0'):
+                if token in pending:
+                    if ci_id is not None:
+                        yield ci_id, paths
+                    pending.discard(token)
+                    ci_id, paths = token, []
+                elif token and ci_id is not None:
+                    paths.append(token)
+            if ci_id is not None:
+                yield ci_id, paths
+
     def refresh_tree_info(self, tree, seen, lazy=True):
         from allura.model.repository import TreeDoc
         if lazy and tree.binsha in seen:
@@ -472,10 +991,23 @@ def _iter_commits_with_refs(self, *args, **kwargs):
                 commit_lines.append(line)
 
     def open_blob(self, blob):
+        if self._use_object_readers:
+            # big blobs are streamed from GitPython instead, so they aren't
+            # held in memory, nor the repo's reader locked while they're read
+            info = self._object_info(blob._id)
+            if info is not None and info[2] <= self._max_reader_blob_size:
+                with object_readers.reader(self._repo.full_fs_path) as reader:
+                    type_, data = reader.read(blob._id)
+                return _OpenedGitBlob(StringIO(data))
         return _OpenedGitBlob(
             self._object(blob._id).data_stream)
 
     def blob_size(self, blob):
+        if self._use_object_readers:
+            info = self._object_info(blob._id)
+            if info is None:
+                raise KeyError(blob._id)
+            return info[2]
         return self._object(blob._id).data_stream.size
 
     def _setup_hooks(self, source_path=None):
@@ -500,6 +1032,9 @@ def rev_parse(self, rev):
         return self._git.rev_parse(rev)
 
     def symbolics_for_commit(self, commit):
+        refs = self._repo.refs_for_commit(commit._id)
+        if refs is not None:
+            return refs
         try:
             branches = [
                 b.name for b in self.branches if b.object_id == commit._id]
@@ -530,11 +1065,40 @@ def tarball(self, commit, path=None):
             if os.path.exists(tmpfilename):
                 os.remove(tmpfilename)
 
+    def tarball_stream(self, commit, path=None):
+        archive_name = self._repo.tarball_filename(commit)
+        return self._archive_chunks([
+            'git', 'archive', '--format=zip',
+            '--prefix=%s/' % archive_name, str(commit)])
+
+    def _archive_chunks(self, cmd):
+        # git archive writes the zip as it goes, so pass it on as it comes
+        proc = subprocess.Popen(
+            cmd,
+            cwd=self._repo.full_fs_path,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+        try:
+            for chunk in iter(lambda: proc.stdout.read(READ_CHUNK_SIZE), ''):
+                yield chunk
+            if proc.wait() != 0:
+                raise git.GitCommandError(cmd, proc.returncode, proc.stderr.read())
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+            proc.stdout.close()
+            proc.stderr.close()
+            proc.wait()
+
     def is_empty(self):
         return not self.head
 
     def is_file(self, path, rev=None):
         path = path.strip('/')
+        if self._use_object_readers:
+            info = self._object_info(h.really_unicode(
+                u'%s:%s' % (rev or 'HEAD', h.really_unicode(path))).encode('utf-8'))
+            return info is not None and info[1] == 'blob'
         ci = self._git.rev_parse(rev)
         try:
             node = ci.tree / path
@@ -549,6 +1113,10 @@ def _get_refs(self, field_name):
         :rtype: list
         """
 
+        if self._repo.refs_indexed:
+            kind = 'tag' if field_name == 'tags' else 'branch'
+            return self._repo.find_refs(kind)[0]
+
         cache_name = 'cached_' + field_name
         cache = getattr(self._repo, cache_name, None)
 
@@ -618,6 +1186,55 @@ def set_default_branch(self, name):
         self._repo.default_branch_name = name
         session(self._repo).flush(self._repo)
 
+    def _iter_path_changes(self, commit_id, paths, timeout=None):
+        # one `git log --name-only` for all the paths, read incrementally so
+        # the caller can stop it as soon as it has what it needs.  Merge
+        # commits list no files, so they are skipped just like in
+        # _get_last_commit
+        proc = subprocess.Popen(
+            ['git', '-c', 'core.quotepath=off', 'log', str(commit_id),
+             '--name-only', '--pretty=format:%x00%H', '--'] +
+            [h.really_unicode(p).encode('utf-8') for p in paths],
+            cwd=self._repo.full_fs_path,
+            stdout=subprocess.PIPE)
+        # git can go a long time without output while it walks history that
+        # doesn't touch the paths, so kill it on time rather than waiting
+        # for the next line to check
+        killer = None
+        if timeout is not None:
+            killer = Timer(max(timeout, 0), self._kill_path_changes,
+                           (proc, commit_id, paths))
+            killer.daemon = True
+            killer.start()
+        try:
+            ci_id, files = None, set()
+            for line in iter(proc.stdout.readline, ''):
+                line = line.rstrip('\n')
+                if line.startswith('\0'):
+                    if files:
+                        yield ci_id, files
+                    ci_id, files = line[1:], set()
+                elif line:
+                    files.add(h.really_unicode(line))
+            if files:
+                yield ci_id, files
+        finally:
+            if killer is not None:
+                killer.cancel()
+            if proc.poll() is None:
+                proc.kill()
+            proc.stdout.close()
+            proc.wait()
+
+    def _kill_path_changes(self, proc, commit_id, paths):
+        if proc.poll() is None:
+            log.error('last_commit_ids timeout for %s on %s',
+                      commit_id, ', '.join(paths))
+            try:
+                proc.kill()
+            except OSError:
+                pass  # it just exited
+
     def _get_last_commit(self, commit_id, paths):
         # git apparently considers merge commits to have "touched" a path
         # if the path is changed in either branch being merged, even though
@@ -655,51 +1272,7 @@ def get_changes(self, commit_id):
 
     def paged_diffs(self, commit_id, start=0, end=None, onlyChangedFiles=False):
         result = {'added': [], 'removed': [], 'changed': [], 'copied': [], 'renamed': []}
-        cmd_args = ['--no-commit-id',
-                    '--name-status',
-                    '--no-abbrev',
-                    '--root',
-                    # show tree entry itself as well as subtrees (Commit.added_paths relies on this)
-                    '-t',
-                    '-z'  # don't escape filenames and use \x00 as fields delimiter
-                    ]
-        if onlyChangedFiles:
-            cmd_args[4] = '-r'
-        if asbool(tg.config.get('scm.commit.git.detect_copies', True)):
-            cmd_args += ['-M', '-C']
-
-        cmd_output = self._git.git.diff_tree(commit_id, *cmd_args).split('\x00')[:-1]  # don't escape filenames and use \x00 as fields delimiter
-
-        ''' cmd_output will be like:
-        [
-        'A',
-        'filename',
-        'D',
-        'another filename',
-        'M',
-        'po',
-        'R100',  # <-- These next three lines would only show up with 'detect_copies' enabled
-        'po/sr.po',
-        'po/sr_Latn.po',
-        ]
-        '''
-
-        x = 0
-        files = []
-        while x < len(cmd_output):
-            status = cmd_output[x][0]
-            if status in ('R', 'C'):
-                ratio = float(cmd_output[x][1:4]) / 100.0
-                files.append((status, {
-                    'new': h.really_unicode(cmd_output[x + 2]),
-                    'old': h.really_unicode(cmd_output[x + 1]),
-                    'ratio': ratio,
-                }))
-                x += 3
-            else:
-                files.append((status, h.really_unicode(cmd_output[x + 1])))
-                x += 2
-
+        files = self.changed_files(commit_id, onlyChangedFiles)
         for status, name in files[start:end]:
             change_list_types = {
                 'R': result['renamed'],
@@ -720,22 +1293,73 @@ def paged_diffs(self, commit_id, start=0, end=None, onlyChangedFiles=False):
 
         return result
 
-    @contextmanager
-    def _shared_clone(self, from_path):
-        tmp_path = tempfile.mkdtemp()
-        start_time = time()
-        self._git.git.clone('--bare', '--shared', from_path, tmp_path)
-        tmp_repo = GitImplementation(Object(full_fs_path=tmp_path))
-        log.info('Merge request view - shared clone timing: %s for %s', time()-start_time, from_path)
+    def _diff_tree_args(self, onlyChangedFiles):
+        cmd_args = ['--no-commit-id',
+                    '--name-status',
+                    '--no-abbrev',
+                    '--root',
+                    # show tree entry itself as well as subtrees (Commit.added_paths relies on this)
+                    '-t',
+                    '-z'  # don't escape filenames and use \x00 as fields delimiter
+                    ]
+        if onlyChangedFiles:
+            cmd_args[4] = '-r'
+        if asbool(tg.config.get('scm.commit.git.detect_copies', True)):
+            cmd_args += ['-M', '-C']
+        return cmd_args
+
+    def _changed_files_key(self, commit_id, onlyChangedFiles):
+        # copy detection changes the list, so it's part of the key
+        return ('diff-tree', commit_id) + tuple(self._diff_tree_args(onlyChangedFiles))
+
+    def _changed_files(self, commit_id, onlyChangedFiles):
+        '''
+        Parse the output of `git diff-tree -z` as it is read.  Fields are
+        NUL terminated, like:
+
+            A, filename, D, another filename, M, po,
+            R100, po/sr.po, po/sr_Latn.po  (only with copy detection)
+        '''
+        cmd = ['git', 'diff-tree'] + self._diff_tree_args(onlyChangedFiles) + [str(commit_id)]
+        proc = subprocess.Popen(
+            cmd,
+            cwd=self._repo.full_fs_path,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
         try:
-            yield tmp_repo
+            fields = self._nul_fields(proc.stdout)
+            for status in fields:
+                if status[0] in ('R', 'C'):
+                    old, new = next(fields), next(fields)
+                    yield status[0], {
+                        'new': h.really_unicode(new),
+                        'old': h.really_unicode(old),
+                        'ratio': float(status[1:4]) / 100.0,
+                    }
+                else:
+                    yield status[0], h.really_unicode(next(fields))
+            if proc.wait() != 0:
+                raise git.GitCommandError(cmd, proc.returncode, proc.stderr.read())
         finally:
-            shutil.rmtree(tmp_path, ignore_errors=True)
+            if proc.poll() is None:
+                proc.kill()
+            proc.stdout.close()
+            proc.stderr.close()
+            proc.wait()
+
+    def _nul_fields(self, fp):
+        rest = ''
+        for chunk in iter(lambda: fp.read(READ_CHUNK_SIZE), ''):
+            fields = (rest + chunk).split('\x00')
+            rest = fields.pop()
+            for field in fields:
+                yield field
 
     def merge_base(self, mr):
-        g = self._git.git
-        g.fetch(mr.app.repo.full_fs_path, mr.target_branch)
-        return g.merge_base(mr.downstream.commit_id, 'FETCH_HEAD')
+        upstream = mr.app.repo
+        return merge_scratch.merge_base(
+            upstream, self._repo, mr.downstream.commit_id,
+            upstream.rev_to_commit_id(mr.target_branch))
 
     def merge_request_commits(self, mr):
         """
@@ -743,20 +1367,13 @@ def merge_request_commits(self, mr):
 
         Must be called within mr.push_downstream_context()
         """
-        use_tmp_dir = tg.config.get('scm.merge_list.git.use_tmp_dir', False)
-        use_tmp_dir = asbool(use_tmp_dir)
-
-        if use_tmp_dir:
-            ctx_mgr = self._shared_clone(self._repo.full_fs_path)
-        else:
-            ctx_mgr = h.null_contextmanager(returning=self)
-
-        with ctx_mgr as repo:
-            base = repo.merge_base(mr)
-            return list(repo.log(
-                [mr.downstream.commit_id],
-                exclude=[base],
-                id_only=False))
+        base = self.merge_base(mr)
+        # everything between the base and the downstream commit is in this
+        # repo, so the log (with this repo's refs) can be read from it
+        return list(self.log(
+            [mr.downstream.commit_id],
+            exclude=[base],
+            id_only=False))
 
 
 class _OpenedGitBlob(object):
@@ -192,6 +192,14 @@ def test_diff_ui(self):
     def test_tags(self):
         self.app.get('/src-git/ref/master~/tags/')
 
+    def test_branches_paged(self):
+        r = self.app.get('/src-git/ref/master~/branches/?limit=1&page=1')
+        assert_in('/p/test/src-git/ci/zz/tree/', r)
+        assert_not_in('/p/test/src-git/ci/master/tree/', r)
+        r = self.app.get('/src-git/ref/master~/branches/?prefix=ma')
+        assert_in('/p/test/src-git/ci/master/tree/', r)
+        assert_not_in('/p/test/src-git/ci/zz/tree/', r)
+
     def _get_ci(self, repo='/p/test/src-git/'):
         r = self.app.get(repo + 'ref/master/')
         resp = r.follow()
@@ -416,6 +424,31 @@ def test_tarball(self):
         r = self.app.get('/p/test/src-git/ci/master/tarball')
         assert 'Your download will begin shortly' in r
 
+    def test_tarball_stream(self):
+        with h.push_config(tg.config, **{'scm.repos.tarball.stream': 'true'}):
+            r = self.app.get('/p/test/src-git/ci/master/tree/')
+            assert_in('/p/test/src-git/ci/master/tarball_download',
+                      r.html.find('form', 'tarball')['action'])
+            # not for crawlers
+            self.app.get('/p/test/src-git/ci/master/tarball_download', status=405)
+            r = self.app.post('/p/test/src-git/ci/master/tarball_download')
+            assert_equal(r.content_type, 'application/zip')
+            assert_in('src-git-master.zip', r.headers['Content-Disposition'])
+            assert_equal(M.MonQTask.query.find(
+                dict(task_name='allura.tasks.repo_tasks.tarball')).count(), 0)
+            # the streamed archive was saved, so it's served as a file now
+            r = self.app.get('/p/test/src-git/ci/master/tarball')
+            assert 'Your download will begin shortly' in r
+        self.app.post('/p/test/src-git/ci/master/tarball_download', status=404)
+
+    def test_tarball_stream_busy(self):
+        with h.push_config(tg.config, **{'scm.repos.tarball.stream': 'true',
+                                         'scm.repos.tarball.stream.max_builds': '0'}):
+            r = self.app.post('/p/test/src-git/ci/master/tarball_download')
+            assert r.location.endswith('/p/test/src-git/ci/master/tarball'), r.location
+            assert_equal(M.MonQTask.query.find(
+                dict(task_name='allura.tasks.repo_tasks.tarball')).count(), 1)
+
     def test_tarball_link_in_subdirs(self):
         '''Go to repo subdir and check 'Download Snapshot' link'''
         self.setup_testgit_index_repo()
@@ -473,6 +506,17 @@ def test_index(self):
     def test_commits(self):
         self.app.get('/rest/p/test/src-git/commits', status=200)
 
+    def test_branches(self):
+        r = self.app.get('/rest/p/test/src-git/branches?limit=1', status=200)
+        assert_equal(r.json['count'], 2)
+        assert_equal([b['name'] for b in r.json['branches']], ['master'])
+        r = self.app.get('/rest/p/test/src-git/tags?prefix=f', status=200)
+        assert_equal(r.json['tags'], [{
+            'name': 'foo',
+            'object_id': '1e146e67985dcd71c74de79613719bef7bddca4a',
+            'url': '/p/test/src-git/ci/foo/',
+        }])
+
 
 class TestHasAccessAPI(TestRestApiBase):
     def setUp(self):
@@ -23,13 +23,19 @@
 import unittest
 import pkg_resources
 import datetime
+import zipfile
+import subprocess
+import binascii
+import threading
+from time import time
+from cStringIO import StringIO
 
 import mock
 from pylons import tmpl_context as c, app_globals as g
 import tg
 from ming.base import Object
 from ming.orm import ThreadLocalORMSession, session
-from nose.tools import assert_equal, assert_in
+from nose.tools import assert_equal, assert_in, assert_raises
 from testfixtures import TempDirectory
 from datadiff.tools import assert_equals
 
@@ -399,6 +405,131 @@ def test_tarball(self):
         assert os.path.isfile(
             os.path.join(tmpdir, "git/t/te/test/testgit.git/test-src-git-HEAD.zip"))
 
+    def test_tarball_stream(self):
+        fn = os.path.join(self.repo.tarball_path, 'test-src-git-HEAD.zip')
+        if os.path.isfile(fn):
+            os.remove(fn)
+        chunks = self.repo.tarball_stream('HEAD')
+        assert not os.path.isfile(fn)
+        data = ''.join(chunks)
+        assert_in('test-src-git-HEAD/README',
+                  zipfile.ZipFile(StringIO(data)).namelist())
+        assert_equal(self.repo.get_tarball_status('HEAD'), 'complete')
+        assert_equal(open(fn, 'rb').read(), data)
+
+    def test_tarball_stream_closed(self):
+        fn = os.path.join(self.repo.tarball_path, 'test-src-git-HEAD.zip')
+        if os.path.isfile(fn):
+            os.remove(fn)
+        chunks = self.repo.tarball_stream('HEAD')
+        next(chunks)
+        chunks.close()
+        # an incomplete archive isn't kept
+        assert_equal(self.repo.get_tarball_status('HEAD'), None)
+        assert_equal([f for f in os.listdir(self.repo.tarball_path)
+                      if f.endswith('.part')], [])
+
+    def test_tarball_stream_shared(self):
+        fn = os.path.join(self.repo.tarball_path, 'test-src-git-HEAD.zip')
+        if os.path.isfile(fn):
+            os.remove(fn)
+        with mock.patch('forgegit.model.git_repo.subprocess.Popen',
+                        wraps=subprocess.Popen) as popen:
+            chunks = self.repo.tarball_stream('HEAD')
+            data = next(chunks)
+            # reads the archive being built, instead of building another
+            follower = self.repo.tarball_stream('HEAD')
+            data += ''.join(chunks)
+            assert_equal(''.join(follower), data)
+        assert_equal(len([args for args, kwargs in popen.call_args_list
+                          if 'archive' in args[0]]), 1)
+        assert_equal(open(fn, 'rb').read(), data)
+
+    def test_tarball_stream_shared_abandoned(self):
+        fn = os.path.join(self.repo.tarball_path, 'test-src-git-HEAD.zip')
+        if os.path.isfile(fn):
+            os.remove(fn)
+        chunks = self.repo.tarball_stream('HEAD')
+        next(chunks)
+        follower = self.repo.tarball_stream('HEAD')
+        chunks.close()
+        with assert_raises(IOError):
+            ''.join(follower)
+
+    def test_tarball_stream_max_builds(self):
+        fn = os.path.join(self.repo.tarball_path, 'test-src-git-HEAD.zip')
+        if os.path.isfile(fn):
+            os.remove(fn)
+        with h.push_config(tg.config, **{'scm.repos.tarball.stream.max_builds': '1'}):
+            chunks = self.repo.tarball_stream('HEAD')
+            next(chunks)
+            # the only slot is taken
+            ci_id = '1e146e67985dcd71c74de79613719bef7bddca4a'
+            assert_equal(self.repo.tarball_stream(ci_id), None)
+            assert_equal(self.repo.get_tarball_status(ci_id), None)
+            chunks.close()
+            data = ''.join(self.repo.tarball_stream(ci_id))
+        assert_in('test-src-git-%s/README' % ci_id,
+                  zipfile.ZipFile(StringIO(data)).namelist())
+
+    def test_paged_diffs_cached(self):
+        cache = M.repository.RepoObjectCache(max_bytes=1024 * 1024)
+        ci = '1e146e67985dcd71c74de79613719bef7bddca4a'
+        with mock.patch('allura.model.repository.repo_object_cache', cache):
+            diffs = self.repo.paged_diffs(ci, start=0, end=1)
+            with mock.patch.object(self.repo._impl, '_changed_files') as changed_files:
+                assert_equal(self.repo.paged_diffs(ci, start=0, end=1), diffs)
+            assert not changed_files.called
+        assert_equal(diffs['changed'], [u'README'])
+        assert_equal(diffs['total'], 1)
+
+    def test_object_readers(self):
+        with h.push_config(tg.config, **{'scm.git.object_backend': 'cat-file'}):
+            impl = GM.git_repo.GitImplementation(self.repo)
+            assert impl._use_object_readers
+            ci = impl.commit('master')
+            assert_equal(ci._id, '1e146e67985dcd71c74de79613719bef7bddca4a')
+            assert impl.is_file('README', ci._id)
+            assert not impl.is_file('nonexistent', ci._id)
+            assert not impl.is_file('some dir/nonexistent', ci._id)
+            blob = ci.tree['README']
+            assert_equal(impl.open_blob(blob).read(), 'This is readme\nAnother Line\n')
+            assert_equal(impl.blob_size(blob), 28)
+        # the same process serves later lookups in this repo
+        with GM.git_repo.object_readers.reader(self.repo.full_fs_path) as reader:
+            pid = reader.proc.pid
+        assert impl.is_file('README', ci._id)
+        with GM.git_repo.object_readers.reader(self.repo.full_fs_path) as reader:
+            assert_equal(reader.proc.pid, pid)
+
+    def test_object_readers_missing_name_with_spaces(self):
+        pool = GM.git_repo.GitObjectReaderPool(idle_timeout=60)
+        with pool.reader(self.repo.full_fs_path) as reader:
+            assert_equal(reader.info('HEAD:some dir/nope'), None)
+            # and the reader can still be used
+            assert_equal(reader.info('HEAD:README')[1:], ('blob', 28))
+        pool.close()
+
+    def test_object_readers_big_blob(self):
+        with h.push_config(tg.config, **{'scm.git.object_backend': 'cat-file',
+                                         'scm.git.object_reader.max_blob_size': '10'}):
+            impl = GM.git_repo.GitImplementation(self.repo)
+            blob = impl.commit('master').tree['README']
+            with mock.patch.object(GM.git_repo.GitObjectReader, 'read') as read:
+                assert_equal(impl.open_blob(blob).read(),
+                             'This is readme\nAnother Line\n')
+            assert not read.called
+
+    def test_object_readers_idle(self):
+        pool = GM.git_repo.GitObjectReaderPool(idle_timeout=60)
+        with pool.reader(self.repo.full_fs_path) as reader:
+            assert_equal(reader.info('HEAD:README')[1:], ('blob', 28))
+        reader.last_used -= 120
+        with pool.reader(self.repo.full_fs_path) as new_reader:
+            assert new_reader is not reader
+        assert not reader.alive
+        pool.close()
+
     def test_all_commit_ids(self):
         cids = list(self.repo.all_commit_ids())
         heads = [
@@ -411,6 +542,144 @@ def test_all_commit_ids(self):
         # repo root comes last
         self.assertEqual(cids[-1], '9a7df788cf800241e3bb5a849c8870f2f8259d98')
 
+    def test_ref_heads(self):
+        heads = dict((hd['name'], hd['object_id'])
+                     for hd in self.repo.ref_heads())
+        assert_equal(heads['refs/heads/master'],
+                     '1e146e67985dcd71c74de79613719bef7bddca4a')
+        assert_equal(heads['refs/heads/zz'],
+                     '5c47243c8e424136fd5cdd18cd94d34c66d1955c')
+        assert_equal(heads['refs/tags/foo'],
+                     '1e146e67985dcd71c74de79613719bef7bddca4a')
+        assert_equal(sorted(hd.object_id for hd in self.repo.refreshed_heads),
+                     sorted(heads.values()))
+
+    def test_commit_ids_since(self):
+        heads = self.repo.ref_heads()
+        assert_equal(self.repo.commit_ids_since(heads, heads), [])
+        assert_equal(self.repo.commit_ids_since([], heads), None)
+        cids = list(self.repo.log('master', id_only=True))
+        old = [dict(name='refs/heads/master', object_id=cids[2])]
+        new = [dict(name='refs/heads/master', object_id=cids[0])]
+        assert_equal(self.repo.commit_ids_since(old, new), cids[:2])
+        # history rewritten
+        assert_equal(self.repo.commit_ids_since(new, old), None)
+        # unknown object
+        missing = [dict(name='refs/heads/master', object_id='f' * 40)]
+        assert_equal(self.repo.commit_ids_since(missing, new), None)
+
+    def test_refresh_commit_info_batch(self):
+        cids = list(self.repo.all_commit_ids())
+        M.repository.CommitDoc.m.remove({})
+        M.repository.TreeDoc.m.remove({})
+        with h.push_config(tg.config, **{'scm.refresh.git.workers': '2',
+                                         'scm.refresh.git.batch_size': '2'}):
+            self.repo.refresh_commit_info_batch(cids, set())
+        for cid in cids:
+            doc = M.repository.CommitDoc.m.get(_id=cid)
+            ci = self.repo._impl._git.rev_parse(cid)
+            assert_equal(doc.tree_id, ci.tree.hexsha)
+            assert_equal(doc.parent_ids, [p.hexsha for p in ci.parents])
+            assert_equal(doc.message, ci.message)
+            assert_equal(doc.authored.name, ci.author.name)
+            assert_equal(doc.authored.email, ci.author.email)
+            assert_equal(doc.committed.date,
+                         datetime.datetime.utcfromtimestamp(ci.committed_date))
+            tree = M.repository.TreeDoc.m.get(_id=ci.tree.hexsha)
+            assert_equal(sorted(b.name for b in tree.blob_ids),
+                         sorted(b.name for b in ci.tree.blobs))
+            assert_equal(sorted(t.id for t in tree.tree_ids),
+                         sorted(t.hexsha for t in ci.tree.trees))
+
+    def test_refresh_commit_info_batch_unparsed(self):
+        cids = list(self.repo.all_commit_ids())
+        M.repository.CommitDoc.m.remove({})
+        M.repository.TreeDoc.m.remove({})
+        impl = self.repo._impl
+        refresh_commit_info = impl.refresh_commit_info
+        threads = []
+
+        def refresh(oid, seen, lazy=True):
+            threads.append(threading.current_thread())
+            return refresh_commit_info(oid, seen, lazy)
+        with h.push_config(tg.config, **{'scm.refresh.git.workers': '2',
+                                         'scm.refresh.git.batch_size': '1'}), \
+                mock.patch.object(impl, '_parse_commit', return_value=None), \
+                mock.patch.object(impl, 'refresh_commit_info', side_effect=refresh):
+            self.repo.refresh_commit_info_batch(cids, set())
+        # GitPython is only used from the refreshing thread
+        assert_equal(threads, [threading.current_thread()] * len(cids))
+        assert_equal(M.repository.CommitDoc.m.find().count(), len(cids))
+
+    def test_refresh_commit_info_batch_seen(self):
+        cids = list(self.repo.all_commit_ids())
+        M.repository.CommitDoc.m.remove({})
+        M.repository.TreeDoc.m.remove({})
+        impl = self.repo._impl
+        save_docs = impl._save_docs
+        seen = set()
+
+        def save(doc_cls, docs, lazy):
+            if doc_cls is M.repository.TreeDoc:
+                # not seen by other batches until it's stored
+                for doc in docs:
+                    assert binascii.unhexlify(doc._id) not in seen
+            return save_docs(doc_cls, docs, lazy)
+        with mock.patch.object(impl, '_save_docs', side_effect=save):
+            self.repo.refresh_commit_info_batch(cids, seen)
+        head = self.repo._impl._git.rev_parse(cids[0])
+        assert binascii.unhexlify(head.tree.hexsha) in seen
+
+    def test_iter_changed_paths(self):
+        changes = dict(self.repo._impl.iter_changed_paths([
+            ('1e146e67985dcd71c74de79613719bef7bddca4a', 'df30427c488aeab84b2352bdf88a3b19223f9d7a'),
+            ('f' * 40, None),
+            ('9a7df788cf800241e3bb5a849c8870f2f8259d98', None),
+        ]))
+        assert_equal(changes, {
+            '1e146e67985dcd71c74de79613719bef7bddca4a': ['README'],
+            '9a7df788cf800241e3bb5a849c8870f2f8259d98': ['a', 'a/b', 'a/b/c', 'a/b/c/hello.txt'],
+        })
+
+    def test_commit_graph_log(self):
+        from allura.model.commit_graph import update_commit_graph, tree_entry_id, CommitGraph
+        with TempDirectory() as d:
+            graph_dir = os.path.join(d.path, 'graph')
+            with mock.patch('allura.model.commit_graph.graph_path', return_value=graph_dir):
+                update_commit_graph(self.repo, [])
+            graph = CommitGraph.load(graph_dir)
+            assert_equal(graph.num_commits, len(list(self.repo.all_commit_ids())))
+            for ci_id in ('1e146e67985dcd71c74de79613719bef7bddca4a',
+                          '5c47243c8e424136fd5cdd18cd94d34c66d1955c'):
+                for path in ('README', 'a', 'a/b/c/hello.txt', 'nonexistent'):
+                    expected = list(self.repo._impl.log([ci_id], path, id_only=True, limit=2))[:2]
+                    assert_equal(graph.path_log(ci_id, path, 2, tree_entry_id), expected)
+            graph.close()
+
+    def test_commit_graph_incremental(self):
+        from allura.model.commit_graph import update_commit_graph, tree_entry_id, CommitGraph
+        commit_ids = list(self.repo.all_commit_ids())
+        with TempDirectory() as d:
+            graph_dir = os.path.join(d.path, 'graph')
+            with mock.patch('allura.model.commit_graph.graph_path', return_value=graph_dir):
+                with mock.patch.object(type(self.repo), 'all_commit_ids',
+                                       return_value=commit_ids[1:]):
+                    update_commit_graph(self.repo, [])
+                graph = CommitGraph.load(graph_dir)
+                assert_equal(graph.num_commits, len(commit_ids) - 1)
+                graph.close()
+                update_commit_graph(self.repo, commit_ids[:1])
+                # nothing new, so nothing written
+                update_commit_graph(self.repo, commit_ids[:1])
+            graph = CommitGraph.load(graph_dir)
+            assert_equal(graph.num_commits, len(commit_ids))
+            assert_equal(sum(graph.layer_sizes()), len(commit_ids))
+            ci_id = '1e146e67985dcd71c74de79613719bef7bddca4a'
+            for path in ('README', 'a', 'a/b/c/hello.txt'):
+                expected = list(self.repo._impl.log([ci_id], path, id_only=True, limit=2))[:2]
+                assert_equal(graph.path_log(ci_id, path, 2, tree_entry_id), expected)
+            graph.close()
+
     def test_ls(self):
         c.lcid_cache = {}  # else it'll be a mock
         lcd_map = self.repo.commit('HEAD').tree.ls()
@@ -596,22 +865,57 @@ def test_webhook_payload(self):
         assert_equals(payload, expected_payload)
 
     def test_can_merge(self):
-        mr = mock.Mock(downstream_repo=Object(full_fs_path='downstream-url'),
-                       source_branch='source-branch',
-                       target_branch='target-branch',
-                       downstream=mock.Mock(commit_id='cid'))
-        git = mock.Mock()
-        git.merge_tree.return_value = 'clean merge'
-        self.repo._impl._git.git = git
-        assert_equal(self.repo.can_merge(mr), True)
-        git.fetch.assert_called_once_with('downstream-url', 'source-branch')
-        git.merge_base.assert_called_once_with('cid', 'target-branch')
-        git.merge_tree.assert_called_once_with(
-            git.merge_base.return_value,
-            'target-branch',
-            'cid')
-        git.merge_tree.return_value = '+<<<<<<<'
-        assert_equal(self.repo.can_merge(mr), False)
+        mr = mock.Mock(downstream_repo=self.repo,
+                       source_branch='zz',
+                       target_branch='master',
+                       downstream=mock.Mock(commit_id='5c47243c8e424136fd5cdd18cd94d34c66d1955c'))
+        with TempDirectory() as tmp:
+            with h.push_config(tg.config, **{'scm.merge.git.scratch_root': tmp.path}):
+                pool = GM.git_repo.MergeScratchPool()
+                with mock.patch('forgegit.model.git_repo.merge_scratch', pool):
+                    assert_equal(self.repo.can_merge(mr), True)
+                    with mock.patch('git.cmd.Git.merge_tree', create=True,
+                                    return_value='+<<<<<<<') as merge_tree:
+                        assert_equal(self.repo.can_merge(mr), False)
+                    merge_tree.assert_called_once_with(
+                        '1e146e67985dcd71c74de79613719bef7bddca4a',
+                        '1e146e67985dcd71c74de79613719bef7bddca4a',
+                        '5c47243c8e424136fd5cdd18cd94d34c66d1955c')
+            # one scratch repo is reused, borrowing the repo's objects
+            assert_equal(sorted(os.listdir(tmp.path)),
+                         ['%s-%s.git' % (self.repo._id, self.repo._id), '.lock'])
+            alternates = open(os.path.join(
+                pool.path(self.repo, self.repo), 'objects', 'info', 'alternates')).read()
+            assert_equal(alternates, os.path.join(self.repo.full_fs_path, 'objects') + '\n')
+
+    def test_merge_scratch_per_downstream(self):
+        downstreams = [mock.Mock(_id=i, full_fs_path='/srv/git/fork%d.git' % i)
+                       for i in range(3)]
+        with TempDirectory() as tmp:
+            pool = GM.git_repo.MergeScratchPool(root=tmp.path)
+            for downstream in downstreams:
+                pool.repo(self.repo, downstream)
+            pool.repo(self.repo, downstreams[0])
+            # each pair only borrows from its own two repos
+            for downstream in downstreams:
+                alternates = open(os.path.join(
+                    pool.path(self.repo, downstream), 'objects', 'info', 'alternates')).read()
+                assert_equal(alternates.splitlines(), [
+                    os.path.join(self.repo.full_fs_path, 'objects'),
+                    os.path.join(downstream.full_fs_path, 'objects'),
+                ])
+            assert_equal(len(os.listdir(tmp.path)), 4)  # 3 repos and the lock
+
+    def test_can_merge_cached(self):
+        mr = mock.Mock(downstream_repo=self.repo,
+                       target_branch='master',
+                       downstream=mock.Mock(commit_id='5c47243c8e424136fd5cdd18cd94d34c66d1955c'))
+        cache = M.repository.RepoObjectCache(max_bytes=10000)
+        with mock.patch('forgegit.model.git_repo.repo_object_cache', cache):
+            assert_equal(self.repo.can_merge(mr), True)
+            with mock.patch('git.cmd.Git.merge_tree', create=True) as merge_tree:
+                assert_equal(self.repo.can_merge(mr), True)
+            assert not merge_tree.called
 
     @mock.patch('forgegit.model.git_repo.tempfile', autospec=True)
     @mock.patch('forgegit.model.git_repo.git', autospec=True)
@@ -826,30 +1130,47 @@ def test_merge_request_commits(self):
              'size': None}]
         assert_equals(res, expected)
 
-    def test_merge_request_commits_tmp_dir(self):
-        """
-        repo.merge_request_commits should return the same result with and
-        without scm.merge_list.git.use_tmp_dir option enabled
-        """
-        mr = self.merge_request
-        res_without_tmp = self.repo.merge_request_commits(mr)
-        opt = {'scm.merge_list.git.use_tmp_dir': True}
-        with h.push_config(tg.config, **opt):
-            res_with_tmp = self.repo.merge_request_commits(mr)
-        assert_equals(res_without_tmp, res_with_tmp)
-
     def test_cached_branches(self):
         with mock.patch.dict('allura.lib.app_globals.config', {'repo_refs_cache_threshold': '0'}):
             rev = GM.Repository.query.get(_id=self.repo['_id'])
+            rev.refs_indexed = False
             branches = rev._impl._get_refs('branches')
             assert_equal(rev.cached_branches, branches)
 
     def test_cached_tags(self):
         with mock.patch.dict('allura.lib.app_globals.config', {'repo_refs_cache_threshold': '0'}):
             rev = GM.Repository.query.get(_id=self.repo['_id'])
+            rev.refs_indexed = False
             tags = rev._impl._get_refs('tags')
             assert_equal(rev.cached_tags, tags)
 
+    def test_ref_index(self):
+        assert self.repo.refs_indexed
+        master = Object(name='master', object_id='1e146e67985dcd71c74de79613719bef7bddca4a')
+        zz = Object(name='zz', object_id='5c47243c8e424136fd5cdd18cd94d34c66d1955c')
+        foo = Object(name='foo', object_id='1e146e67985dcd71c74de79613719bef7bddca4a')
+        assert_equal(self.repo.find_refs('branch'), ([master, zz], 2))
+        assert_equal(self.repo.find_refs('tag'), ([foo], 1))
+        assert_equal(self.repo.find_refs('branch', prefix='z'), ([zz], 1))
+        assert_equal(self.repo.find_refs('branch', page=1, limit=1), ([zz], 2))
+        assert_equal(self.repo.get_branches(), [master, zz])
+        assert_equal(self.repo.refs_for_commit(master.object_id), (['master'], ['foo']))
+        # only changed refs are written, so the unchanged tag keeps its
+        # (doctored) value
+        M.repository.RepoRefDoc.m.update_partial(
+            dict(repo_id=self.repo._id, name='foo'),
+            {'$set': dict(object_id='stale')})
+        heads = [dict(name='refs/heads/master', object_id=zz.object_id),
+                 dict(name='refs/heads/new', object_id=master.object_id),
+                 dict(name='refs/tags/foo', object_id=foo.object_id)]
+        self.repo.refreshed_heads = self.repo.ref_heads()
+        self.repo.update_ref_index(heads)
+        assert_equal(self.repo.find_refs('branch'), ([
+            Object(name='master', object_id=zz.object_id),
+            Object(name='new', object_id=master.object_id)], 2))
+        assert_equal(self.repo.find_refs('tag'),
+                     ([Object(name='foo', object_id='stale')], 1))
+
 class TestGitImplementation(unittest.TestCase):
 
     def test_branches(self):
@@ -857,6 +1178,7 @@ def test_branches(self):
             'forgegit', 'tests/data/testgit.git')
         repo = mock.Mock(full_fs_path=repo_dir)
         repo.__ming__ = mock.Mock()
+        repo.refs_indexed = False
         repo.cached_branches = []
         impl = GM.git_repo.GitImplementation(repo)
         self.assertEqual(impl.branches, [
@@ -871,6 +1193,7 @@ def test_tags(self):
             'forgegit', 'tests/data/testgit.git')
         repo = mock.Mock(full_fs_path=repo_dir)
         repo.__ming__ = mock.Mock()
+        repo.refs_indexed = False
         repo.cached_tags = []
         impl = GM.git_repo.GitImplementation(repo)
         self.assertEqual(impl.tags, [
@@ -893,12 +1216,43 @@ def test_last_commit_ids(self):
         })
 
     def test_last_commit_ids_threaded(self):
-        with h.push_config(tg.config, lcd_thread_chunk_size=1):
+        with h.push_config(tg.config, lcd_thread_chunk_size=1, lcd_single_pass='false'):
             self.test_last_commit_ids()
 
+    def test_last_commit_ids_single_pass(self):
+        repo_dir = pkg_resources.resource_filename(
+            'forgegit', 'tests/data/testrename.git')
+        impl = GM.git_repo.GitImplementation(mock.Mock(full_fs_path=repo_dir))
+        changes = list(impl._iter_path_changes(
+            '13951944969cf45a701bf90f83647b309815e6d5', ['f2.txt', 'f3.txt']))
+        assert_equal(changes, [
+            ('653667b582ef2950c1954a0c7e1e8797b19d778a', set(['f3.txt'])),
+            ('259c77dd6ee0e6091d11e429b56c44ccbf1e64a3', set(['f2.txt'])),
+            ('b120505a61225e6c14bee3e5b5862db81628c35c', set(['f2.txt'])),
+        ])
+        with mock.patch.object(impl, '_get_last_commit') as _get_last_commit:
+            self.assertEqual(impl.last_commit_ids(
+                mock.Mock(_id='13951944969cf45a701bf90f83647b309815e6d5'), ['f2.txt', 'f3.txt']), {
+                'f2.txt': '259c77dd6ee0e6091d11e429b56c44ccbf1e64a3',
+                'f3.txt': '653667b582ef2950c1954a0c7e1e8797b19d778a',
+            })
+        assert not _get_last_commit.called
+
+    def test_last_commit_ids_single_pass_timeout(self):
+        impl = GM.git_repo.GitImplementation(mock.Mock(full_fs_path='/tmp'))
+        popen = subprocess.Popen
+        # a history walk that goes quiet
+        with mock.patch.object(GM.git_repo.subprocess, 'Popen') as Popen:
+            Popen.side_effect = lambda *a, **kw: popen(
+                ['sleep', '30'], stdout=subprocess.PIPE)
+            start = time()
+            changes = list(impl._iter_path_changes('HEAD', ['f2.txt'], timeout=0.5))
+        assert_equal(changes, [])
+        assert time() - start < 10
+
     @mock.patch('forgegit.model.git_repo.GitImplementation._git', new_callable=mock.PropertyMock)
     def test_last_commit_ids_threaded_error(self, _git):
-        with h.push_config(tg.config, lcd_thread_chunk_size=1, lcd_timeout=2):
+        with h.push_config(tg.config, lcd_thread_chunk_size=1, lcd_timeout=2, lcd_single_pass='false'):
             repo_dir = pkg_resources.resource_filename(
                 'forgegit', 'tests/data/testrename.git')
             repo = mock.Mock(full_fs_path=repo_dir)
@@ -17,6 +17,7 @@
 
 import re
 import os
+import posixpath
 import shutil
 import string
 import logging
@@ -28,6 +29,7 @@
 from cStringIO import StringIO
 from datetime import datetime
 import tempfile
+import zipfile
 from shutil import rmtree
 
 import tg
@@ -36,6 +38,8 @@
 from pymongo.errors import DuplicateKeyError
 from pylons import tmpl_context as c, app_globals as g
 
+from ming import schema as S
+from ming import Field, collection, Index
 from ming.base import Object
 from ming.orm import Mapper, FieldProperty
 from ming.utils import LazyProperty
@@ -45,9 +49,30 @@
 from allura.model.auth import User
 from allura.model.repository import zipdir
 from allura.model import repository as RM
+from allura.model.session import main_doc_session
 
 log = logging.getLogger(__name__)
 
+# Revision metadata and changed paths of each revision in an SVN repo, one
+# per revision, filled in during refresh.  Path history and last commit
+# queries are answered from here instead of asking pysvn each time.
+# SVNLogDoc._id = CommitDoc._id
+SVNLogDoc = collection(
+    'svn_log', main_doc_session,
+    Field('_id', str),
+    Field('repo_id', S.ObjectId()),
+    Field('revno', int),
+    Field('author', str),
+    Field('message', str),
+    Field('date', float),
+    Field('changed_paths', [dict(
+        path=str,
+        action=str,
+        copyfrom_path=str,
+        copyfrom_revno=int)]),
+    Index('repo_id', 'revno'),
+    Index('repo_id', 'changed_paths.path'))
+
 
 class Repository(M.Repository):
     tool_name = 'SVN'
@@ -150,6 +175,31 @@ def __getattr__(self, name):
         return getattr(self.client, name)
 
 
+class _ZipStream(object):
+
+    '''Write-only file for :class:`zipfile.ZipFile` which hands back what
+    has been written so far, so an archive can be sent while it's built'''
+
+    def __init__(self):
+        self._chunks = []
+        self._pos = 0
+
+    def write(self, data):
+        self._chunks.append(data)
+        self._pos += len(data)
+
+    def tell(self):
+        return self._pos
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = ''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
 class SVNImplementation(M.RepositoryImplementation):
     post_receive_template = string.Template(
         '#!/bin/bash\n'
@@ -340,6 +390,22 @@ def all_commit_ids(self):
         head_revno = self.head
         return map(self._oid, range(head_revno, 0, -1))
 
+    def ref_heads(self):
+        head_revno = self.head
+        if not head_revno:
+            return []
+        return [dict(name=None, object_id=self._oid(head_revno))]
+
+    def commit_ids_since(self, old_heads, new_heads):
+        if not old_heads or not new_heads:
+            return None
+        old_revno = self._revno(old_heads[0]['object_id'])
+        new_revno = self._revno(new_heads[0]['object_id'])
+        if new_revno < old_revno:
+            # repo was replaced by an older dump
+            return None
+        return map(self._oid, range(new_revno, old_revno, -1))
+
     def new_commits(self, all_commits=False):
         head_revno = self.head
         oids = [self._oid(revno) for revno in range(1, head_revno + 1)]
@@ -379,6 +445,8 @@ def refresh_commit_info(self, oid, seen_object_ids, lazy=True):
             log.info('ClientError processing %r %r, treating as empty',
                      oid, self._repo, exc_info=True)
             log_entry = Object(date='', message='', changed_paths=[])
+        else:
+            self._cache_log_entry(oid, revno, log_entry)
         log_date = None
         if hasattr(log_entry, 'date'):
             log_date = datetime.utcfromtimestamp(log_entry.date)
@@ -501,7 +569,8 @@ def log(self, revs=None, path=None, exclude=None, id_only=True, limit=25, **kw):
 
         Since pysvn doesn't have a generator version of log, this tries to
         balance pulling too much data from SVN with calling SVN too many
-        times by pulling in pages of page_size at a time.
+        times by pulling in pages of page_size at a time.  Pages are read
+        from the log cache instead when it has all of the revisions.
         """
         if revs is None:
             revno = self.head
@@ -515,7 +584,20 @@ def log(self, revs=None, path=None, exclude=None, id_only=True, limit=25, **kw):
             url = self._url
         else:
             url = '/'.join([self._url, path.strip('/')])
+        cached = self._log_cache_covers(exclude, revno)
         while revno > exclude:
+            page = self._cached_log(path, revno, exclude, limit) if cached else None
+            if page is not None:
+                entries, done = page
+                for entry in entries:
+                    if id_only:
+                        yield entry.revno
+                    else:
+                        yield self._map_log(self._log_entry(entry), url, path)
+                if done:
+                    return
+                revno = entries[-1].revno - 1
+                continue
             rev = pysvn.Revision(pysvn.opt_revision_kind.number, revno)
             try:
                 logs = self._svn.log(
@@ -538,6 +620,145 @@ def log(self, revs=None, path=None, exclude=None, id_only=True, limit=25, **kw):
                 return
             revno = ci.revision.number - 1
 
+    def _cache_log_entry(self, oid, revno, log_entry):
+        '''Save a pysvn log entry to the log cache'''
+        changed_paths = []
+        for cp in log_entry.get('changed_paths', []):
+            copyfrom_path = copyfrom_revno = None
+            if cp.get('copyfrom_path'):
+                copyfrom_path = h.really_unicode(cp.copyfrom_path)
+                copyfrom_revno = cp.copyfrom_revision.number
+            changed_paths.append(dict(
+                path=h.really_unicode(cp.path),
+                action=cp.action,
+                copyfrom_path=copyfrom_path,
+                copyfrom_revno=copyfrom_revno))
+        doc = dict(
+            repo_id=self._repo._id,
+            revno=revno,
+            date=log_entry.get('date'),
+            changed_paths=changed_paths)
+        for key in ('author', 'message'):
+            if log_entry.get(key) is not None:
+                doc[key] = h.really_unicode(log_entry[key])
+        SVNLogDoc.m.update_partial({'_id': oid}, {'$set': doc}, upsert=True)
+
+    def backfill_log_cache(self, page_size=1000):
+        '''
+        Add the revisions that aren't in the log cache yet, such as those
+        refreshed before it existed, asking svn for page_size revisions at a
+        time.  Returns how many were added.
+        '''
+        cached = set(doc['revno'] for doc in SVNLogDoc.m.find(
+            dict(repo_id=self._repo._id), fields=['revno'], validate=False))
+        added = 0
+        for start in xrange(1, self.head + 1, page_size):
+            end = min(start + page_size - 1, self.head)
+            if all(revno in cached for revno in xrange(start, end + 1)):
+                continue
+            logs = self._svn.log(
+                self._url,
+                revision_start=pysvn.Revision(pysvn.opt_revision_kind.number, start),
+                revision_end=pysvn.Revision(pysvn.opt_revision_kind.number, end),
+                discover_changed_paths=True)
+            for log_entry in logs:
+                revno = log_entry.revision.number
+                if revno not in cached:
+                    self._cache_log_entry(self._oid(revno), revno, log_entry)
+                    added += 1
+        return added
+
+    def _log_entry(self, doc):
+        '''Make a log cache doc look like a pysvn log entry'''
+        entry = Object(
+            revision=Object(number=doc.revno),
+            date=doc.date,
+            changed_paths=[Object(
+                path=cp.path,
+                action=cp.action,
+                copyfrom_path=cp.copyfrom_path,
+                copyfrom_revision=Object(number=cp.copyfrom_revno)
+                if cp.copyfrom_path else None)
+                for cp in doc.changed_paths])
+        # pysvn leaves these out when they're missing
+        for key in ('author', 'message'):
+            if doc.get(key) is not None:
+                entry[key] = doc[key]
+        return entry
+
+    def _log_cache_covers(self, start, end):
+        '''True if the log cache has every revision in (start, end]'''
+        if end <= start or not asbool(tg.config.get('scm.svn.log_cache', True)):
+            return False
+        count = SVNLogDoc.m.find(dict(
+            repo_id=self._repo._id,
+            revno={'$gt': start, '$lte': end})).count()
+        return count == end - start
+
+    def _log_cache_spec(self, path):
+        '''
+        Query for the cached revisions that changed path or anything under
+        it, or that added, replaced or deleted path or one of its parents.
+        '''
+        if path == '/':
+            return {}
+        parents = []
+        parent = posixpath.dirname(path)
+        while parent != '/':
+            parents.append(parent)
+            parent = posixpath.dirname(parent)
+        return {'$or': [
+            {'changed_paths.path': path},
+            {'changed_paths.path': re.compile('^' + re.escape(path + '/'))},
+            {'changed_paths': {'$elemMatch': {
+                'path': {'$in': parents},
+                'action': {'$in': ['A', 'R', 'D']}}}},
+        ]}
+
+    def _node_change(self, doc, path):
+        '''
+        The change in a cached revision that added, replaced or deleted
+        path (or the closest of its parents), or None if there wasn't one.
+        '''
+        change = None
+        for cp in doc.changed_paths:
+            if cp.action not in ('A', 'R', 'D'):
+                continue
+            if path == cp.path or path.startswith(cp.path.rstrip('/') + '/'):
+                if change is None or len(cp.path) > len(change.path):
+                    change = cp
+        return change
+
+    def _cached_log(self, path, revno, exclude, limit):
+        '''
+        Return a page of up to limit log cache docs for revisions that
+        changed path, newest first, starting at revno, and whether that's
+        the end of the path's history.  Returns None if the cache can't
+        answer exactly, which is when the path was copied from elsewhere,
+        since svn log follows copies.
+        '''
+        path = '/' + h.really_unicode(path or '').strip('/')
+        spec = self._log_cache_spec(path)
+        spec.update(
+            repo_id=self._repo._id,
+            revno={'$gt': exclude, '$lte': revno})
+        docs = SVNLogDoc.m.find(spec).sort('revno', -1).limit(limit)
+        entries = []
+        for doc in docs:
+            change = self._node_change(doc, path)
+            if change is not None and not change.copyfrom_path and (
+                    change.action == 'D' or change.path != path):
+                if entries:
+                    return None
+                # the path doesn't exist at revno
+                return [], True
+            entries.append(doc)
+            if change is not None:
+                if change.copyfrom_path:
+                    return None
+                return entries, True
+        return entries, len(entries) < limit
+
     def _check_changed_path(self, changed_path, path):
         if (changed_path['copyfrom_path'] and
                 changed_path['path'] and
@@ -652,6 +873,8 @@ def last_commit_ids(self, commit, paths):
         NB: This assumes that all paths are direct children of a
         single common parent path (i.e., you are only asking for
         a subset of the nodes of a single tree, one level deep).
+
+        The log cache is used instead when it has all of the revisions.
         '''
         if len(paths) == 1:
             tree_path = '/' + os.path.dirname(paths[0].strip('/'))
@@ -659,6 +882,11 @@ def last_commit_ids(self, commit, paths):
             # always leading slash, never trailing
             tree_path = '/' + os.path.commonprefix(paths).strip('/')
         paths = [path.strip('/') for path in paths]
+        revno = self._revno(commit._id)
+        if self._log_cache_covers(0, revno):
+            entries = self._cached_last_commit_ids(revno, tree_path, paths)
+            if entries is not None:
+                return entries
         rev = self._revision(commit._id)
         try:
             infos = self._svn.info2(
@@ -676,6 +904,68 @@ def last_commit_ids(self, commit, paths):
                 entries[path] = self._oid(info.last_changed_rev.number)
         return entries
 
+    def _cached_last_commit_ids(self, revno, tree_path, paths):
+        '''
+        Find the last commit to change each of paths, children of
+        tree_path, in the log cache.  Copies are followed back to where
+        they came from, since that's where the nodes were last changed.
+        Returns None if the cache can't answer, or if that takes more than
+        scm.svn.log_cache.lcd_limit revisions or lcd_timeout seconds.
+        '''
+        tree_path = h.really_unicode(tree_path)
+        prefix = tree_path.strip('/') + '/' if tree_path != '/' else ''
+        if not all(h.really_unicode(p).startswith(prefix) for p in paths):
+            return None
+        budget = asint(tg.config.get('scm.svn.log_cache.lcd_limit', 2000))
+        deadline = time.time() + float(tg.config.get('lcd_timeout', 60))
+        # path -> where it is in the revisions being looked at
+        remaining = dict((p, '/' + h.really_unicode(p)) for p in paths)
+        entries = {}
+        while remaining:
+            spec = self._log_cache_spec(tree_path)
+            spec.update(repo_id=self._repo._id, revno={'$lte': revno})
+            copied = None
+            docs = SVNLogDoc.m.find(
+                spec, fields=['revno', 'changed_paths']).sort('revno', -1)
+            scanned = 0
+            for doc in docs.limit(budget + 1):
+                scanned += 1
+                if scanned > budget or time.time() > deadline:
+                    log.info('Giving up on the log cache for last commits in %s at r%s',
+                             tree_path, revno)
+                    return None
+                commit_id = self._oid(doc.revno)
+                for path, node in remaining.items():
+                    for cp in doc.changed_paths:
+                        if cp.path != node and not cp.path.startswith(node + '/'):
+                            continue
+                        if not (cp.path == node and cp.action == 'D'):
+                            entries[path] = commit_id
+                        del remaining[path]
+                        break
+                change = self._node_change(doc, tree_path)
+                if change is not None and change.copyfrom_path:
+                    copied = change
+                    break
+                if change is not None:
+                    if change.action == 'D' or change.path != tree_path:
+                        # the tree doesn't exist at this revision
+                        return None
+                    # anything left wasn't added along with the tree, so
+                    # it doesn't exist
+                    remaining = {}
+                if not remaining:
+                    break
+            if copied is None:
+                break
+            budget -= scanned
+            old, new = copied.path.rstrip('/'), copied.copyfrom_path.rstrip('/')
+            tree_path = new + tree_path[len(old):]
+            for path, node in remaining.items():
+                remaining[path] = new + node[len(old):]
+            revno = copied.copyfrom_revno
+        return entries
+
     def get_changes(self, oid):
         rev = self._revision(oid)
         try:
@@ -740,6 +1030,41 @@ def tarball(self, commit, path=None):
             if os.path.exists(tmpfilename):
                 os.remove(tmpfilename)
 
+    def tarball_stream(self, commit, path=None):
+        path = self._path_to_root(path, commit)
+        archive_name = h.really_unicode(
+            self._repo.tarball_filename(commit, path))
+        rev = pysvn.Revision(pysvn.opt_revision_kind.number, commit)
+        return self._export_chunks(
+            os.path.join(self._url, path), rev, archive_name)
+
+    def _export_chunks(self, url, rev, archive_name):
+        # like `svn export` piped through zip, one file at a time
+        out = _ZipStream()
+        archive = zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+        entries = self._svn.list(
+            url, revision=rev, peg_revision=rev, recurse=True,
+            dirent_fields=pysvn.SVN_DIRENT_KIND | pysvn.SVN_DIRENT_TIME)
+        # the listed path itself comes first
+        root = h.really_unicode(entries[0][0].repos_path)
+        for entry, lock in entries:
+            name = h.really_unicode(entry.repos_path)[len(root):].strip('/')
+            info = zipfile.ZipInfo(
+                '/'.join(filter(None, [archive_name, name])),
+                time.localtime(entry.time)[:6])
+            if entry.kind == pysvn.node_kind.dir:
+                info.filename += '/'
+                info.external_attr = (040755 << 16) | 0x10
+                archive.writestr(info, '')
+            else:
+                info.compress_type = zipfile.ZIP_DEFLATED
+                info.external_attr = 0644 << 16
+                archive.writestr(info, self._svn.cat(
+                    entry.path, revision=rev, peg_revision=rev))
+            yield out.pop()
+        archive.close()
+        yield out.pop()
+
     def is_empty(self):
         return self.head == 0
 
@@ -782,6 +1107,28 @@ def tags(self):
 
     def paged_diffs(self, commit_id, start=0, end=None, onlyChangedFiles=False):
         result = {'added': [], 'removed': [], 'changed': [], 'copied': [], 'renamed': [], 'total': 0}
+        files = self.changed_files(commit_id, onlyChangedFiles)
+        result['total'] = len(files)
+        change_lists = {
+            'C': result['copied'],
+            'A': result['added'],
+            'D': result['removed'],
+            'M': result['changed'],
+        }
+        for status, path in files[start:end]:
+            change_lists[status].append(path)
+
+        for r in result['copied'][:]:
+            if r['old'] in result['removed']:
+                result['removed'].remove(r['old'])
+                result['copied'].remove(r)
+                result['renamed'].append(r)
+            if r['new'] in result['added']:
+                result['added'].remove(r['new'])
+
+        return result
+
+    def _changed_files(self, commit_id, onlyChangedFiles):
         rev = self._revision(commit_id)
         try:
             log_info = self._svn.log(
@@ -792,38 +1139,26 @@ def paged_diffs(self, commit_id, start=0, end=None, onlyChangedFiles=False):
         except pysvn.ClientError:
             log.info('Error getting paged_diffs log of %s on %s',
                      commit_id, self._url, exc_info=True)
-            return result
+            return None
         if len(log_info) == 0:
-            return result
-        paths = sorted(log_info[0].changed_paths, key=op.itemgetter('path'))
-        result['total'] = len(paths)
-        for p in paths[start:end]:
+            return None
+        files = []
+        for p in sorted(log_info[0].changed_paths, key=op.itemgetter('path')):
             if p['copyfrom_path'] is not None:
-                result['copied'].append({
+                files.append(('C', {
                     'new': h.really_unicode(p.path),
                     'old': h.really_unicode(p.copyfrom_path),
                     'ratio': 1,
-                })
-            elif p['action'] == 'A':
-                result['added'].append(h.really_unicode(p.path))
-            elif p['action'] == 'D':
-                result['removed'].append(h.really_unicode(p.path))
+                }))
+            elif p['action'] in ['A', 'D']:
+                files.append((p['action'], h.really_unicode(p.path)))
             elif p['action'] in ['M', 'R']:
                 # 'R' means 'Replaced', i.e.
                 # svn rm aaa.txt
                 # echo "Completely new aaa!" > aaa.txt
                 # svn add aaa.txt
                 # svn commit -m "Replace aaa.txt"
-                result['changed'].append(h.really_unicode(p.path))
-
-        for r in result['copied'][:]:
-            if r['old'] in result['removed']:
-                result['removed'].remove(r['old'])
-                result['copied'].remove(r)
-                result['renamed'].append(r)
-            if r['new'] in result['added']:
-                result['added'].remove(r['new'])
-
-        return result
+                files.append(('M', h.really_unicode(p.path)))
+        return files
 
 Mapper.compile_all()
@@ -23,6 +23,7 @@
 from itertools import count, product
 from datetime import datetime
 from zipfile import ZipFile
+from cStringIO import StringIO
 
 from collections import defaultdict
 from pylons import tmpl_context as c, app_globals as g
@@ -321,6 +322,58 @@ def test_log(self):
                  'email': ''},
              'size': None}])
 
+    def test_log_cache(self):
+        assert_equal(SM.svn.SVNLogDoc.m.find(
+            dict(repo_id=self.repo._id)).count(), 6)
+        for path in [None, '/README', '/a', '/a/b/c/hello.txt', '/missing']:
+            cached = list(self.repo.log(path=path, id_only=False, limit=2))
+            with h.push_config(tg.config, **{'scm.svn.log_cache': 'false'}):
+                uncached = list(self.repo.log(path=path, id_only=False, limit=2))
+            assert_equal(cached, uncached)
+        with mock.patch.object(self.repo._impl, '_svn') as svn:
+            entries = list(self.repo._impl.log(['6'], path='/README', limit=25))
+        assert_equal(entries, [3, 1])
+        assert not svn.log.called
+
+    def test_log_cache_lcd_limit(self):
+        commit = self.repo.commit('6')
+        paths = ['README', 'a']
+        with h.push_config(tg.config, **{'scm.svn.log_cache': 'false'}):
+            uncached = self.repo._impl.last_commit_ids(commit, paths)
+        assert self.repo._impl._cached_last_commit_ids(6, '/', paths) is not None
+        with h.push_config(tg.config, **{'scm.svn.log_cache.lcd_limit': '1'}):
+            assert_equal(self.repo._impl._cached_last_commit_ids(6, '/', paths), None)
+            assert_equal(self.repo._impl.last_commit_ids(commit, paths), uncached)
+        with h.push_config(tg.config, lcd_timeout=-1):
+            assert_equal(self.repo._impl._cached_last_commit_ids(6, '/', paths), None)
+
+    def test_backfill_log_cache(self):
+        SM.svn.SVNLogDoc.m.remove(dict(repo_id=self.repo._id, revno={'$in': [2, 5]}))
+        assert not self.repo._impl._log_cache_covers(0, 6)
+        assert_equal(self.repo._impl.backfill_log_cache(page_size=2), 2)
+        assert self.repo._impl._log_cache_covers(0, 6)
+        with mock.patch.object(self.repo._impl, '_svn') as svn:
+            assert_equal(self.repo._impl.backfill_log_cache(), 0)
+        assert not svn.log.called
+        self.test_log_cache()
+
+    def test_log_cache_copies(self):
+        h.set_context('test', 'svn-tags', neighborhood='Projects')
+        impl = self.svn_tags._impl
+        commit = self.svn_tags.commit('19')
+        for paths in [['branches', 'tags', 'trunk'],
+                      ['branches/aaa/README', 'branches/aaa/aaa.txt'],
+                      ['tags/tag-1.0/README']]:
+            cached = impl.last_commit_ids(commit, paths)
+            with h.push_config(tg.config, **{'scm.svn.log_cache': 'false'}):
+                uncached = impl.last_commit_ids(commit, paths)
+            assert_equal(cached, uncached)
+        for path in ['/branches/aaa', '/branches/aaa/README', '/trunk']:
+            cached = list(self.svn_tags.log(path=path, limit=25))
+            with h.push_config(tg.config, **{'scm.svn.log_cache': 'false'}):
+                uncached = list(self.svn_tags.log(path=path, limit=25))
+            assert_equal(cached, uncached)
+
     def test_log_file(self):
         entries = list(self.repo.log(path='/README', id_only=False, limit=25))
         assert_equal(entries, [
@@ -442,6 +495,29 @@ def test_tarball(self):
         shutil.rmtree(self.repo.tarball_path.encode('utf-8'),
                       ignore_errors=True)
 
+    def test_tarball_stream(self):
+        tmpdir = tg.config['scm.repos.tarball.root']
+        fn = os.path.join(tmpdir, 'svn/t/te/test/testsvn/test-src-1.zip')
+        data = ''.join(self.repo.tarball_stream('1'))
+        assert_equal(ZipFile(StringIO(data)).namelist(),
+                     ['test-src-1/', 'test-src-1/README'])
+        # kept for later downloads
+        assert_equal(self.repo.get_tarball_status('1'), 'complete')
+        assert_equal(open(fn, 'rb').read(), data)
+        shutil.rmtree(self.repo.tarball_path.encode('utf-8'),
+                      ignore_errors=True)
+
+    def test_tarball_stream_aware_of_branches(self):
+        h.set_context('test', 'svn-tags', neighborhood='Projects')
+        data = ''.join(self.svn_tags.tarball_stream('19', '/branches/aaa/some/path/'))
+        assert_equal(sorted(ZipFile(StringIO(data)).namelist()),
+                     sorted(['test-svn-tags-19-branches-aaa/',
+                             'test-svn-tags-19-branches-aaa/aaa.txt',
+                             'test-svn-tags-19-branches-aaa/svn-commit.tmp',
+                             'test-svn-tags-19-branches-aaa/README']))
+        shutil.rmtree(self.svn_tags.tarball_path.encode('utf-8'),
+                      ignore_errors=True)
+
     @onlyif(os.path.exists(tg.config.get('scm.repos.tarball.zip_binary', '/usr/bin/zip')), 'zip binary is missing')
     def test_tarball_aware_of_tags(self):
         rev = '19'
@@ -570,6 +646,15 @@ def test_is_empty(self):
             ThreadLocalORMSession.flush_all()
             assert repo2.is_empty()
 
+    def test_commit_ids_since(self):
+        heads = self.repo.ref_heads()
+        assert_equal(heads, [dict(name=None, object_id=self.repo._impl._oid(6))])
+        old = [dict(name=None, object_id=self.repo._impl._oid(4))]
+        assert_equal(self.repo.commit_ids_since(old, heads),
+                     [self.repo._impl._oid(6), self.repo._impl._oid(5)])
+        assert_equal(self.repo.commit_ids_since(heads, heads), [])
+        assert_equal(self.repo.commit_ids_since(heads, old), None)
+
     def test_webhook_payload(self):
         sender = RepoPushWebhookSender()
         cids = list(self.repo.all_commit_ids())[:2]
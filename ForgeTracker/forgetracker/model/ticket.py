@@ -194,7 +194,10 @@ def update_bin_counts(self):
                 # skip queries with $USER variable, hits will be inconsistent
                 # for them
                 continue
-            r = search_artifact(Ticket, b.terms, rows=0, short_timeout=False)
+            # the counts are kept for an hour, so don't take them from a
+            # cached search made before the latest changes were indexed
+            r = search_artifact(Ticket, b.terms, rows=0, short_timeout=False,
+                                use_cache=False)
             hits = r is not None and r.hits or 0
             self._bin_counts_data.append(dict(summary=b.summary, hits=hits))
         self._bin_counts_expire = \
@@ -74,6 +74,15 @@ def newCommit(self, newcommit, project, user):
 
         stats.addCommit(newcommit, datetime.utcnow(), project)
 
+    def newCommits(self, newcommits, project, user):
+        stats = user.stats
+        if not stats:
+            stats = UserStats.create(user)
+
+        now = datetime.utcnow()
+        for newcommit in newcommits:
+            stats.addCommit(newcommit, now, project)
+
     def addUserLogin(self, user):
         stats = user.stats
         if not stats:
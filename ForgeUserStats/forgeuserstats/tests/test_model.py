@@ -19,9 +19,10 @@
 import unittest
 from datetime import datetime, timedelta
 
-from pylons import tmpl_context as c
+from pylons import tmpl_context as c, app_globals as g
 from tg import config
 import mock
+from nose.tools import assert_equal
 
 from alluratest.controller import setup_basic_test, setup_global_objects, setup_trove_categories
 from allura.tests import decorators as td
@@ -360,6 +361,38 @@ def test_ticket_stats(self):
         assert lm_by_cat[topic]['solved'] == 1
         assert lm_by_cat[topic]['averagesolvingtime'] == solving_time
 
+    @with_git
+    def test_refresh_commit_activities(self):
+        from activitystream.storage.mingstorage import Activity
+        with mock.patch('allura.lib.plugin.session'):
+            self.user.set_password('testpassword')
+        self.user.claim_address('rcopeland@geek.net')
+        addr = M.EmailAddress.get(email='rcopeland@geek.net')
+        addr.confirmed = True
+
+        c.app.repo.fs_path = pkg_resources.resource_filename(
+            'forgeuserstats', 'tests/data')
+        c.app.repo.name = 'testgit.git'
+
+        def activities(node):
+            return Activity.query.find(dict(
+                verb='committed', node_id=node.node_id)).count()
+        before = dict((node.node_id, activities(node)) for node in (self.user, c.project))
+        storage = g.director.activity_manager.storage
+        with mock.patch.object(storage, 'save_activity') as save_activity, \
+                mock.patch('allura.model.timeline.create_timelines') as create_timelines:
+            c.app.repo.refresh()
+        # all four commits are by the same committer
+        assert_equal(self.user.stats.getCommits()['number'], 4)
+        # one copy of each activity for the user and for the project,
+        # inserted at once
+        assert not save_activity.called
+        for node in (self.user, c.project):
+            assert_equal(activities(node), before[node.node_id] + 4)
+        # and one timeline aggregation for each of them
+        assert_equal(sorted(call[0][0] for call in create_timelines.post.call_args_list),
+                     sorted([self.user.node_id, c.project.node_id]))
+
     @with_git
     @td.with_user_project('test-user-2')
     def test_commit_stats(self):
@@ -60,6 +60,24 @@ def main(opts):
         path = opts.path.strip('/')
         names = []
         impl = impl_svn_tree if opts.full_tree else impl_svn_node
+    elif opts.type == 'svn-allura':
+        # must be run with `paster script`, against a repo that has been
+        # refreshed into allura
+        import tg
+        from forgesvn.model import Repository
+        tg.config['scm.svn.log_cache'] = not opts.no_log_cache
+        repo_path = opts.repo_path.rstrip('/')
+        repo = [r for r in Repository.query.find(dict(name=os.path.basename(repo_path)))
+                if r.full_fs_path.rstrip('/') == repo_path][0]
+        cid = repo.commit(opts.cid)
+        path = opts.path.strip('/')
+        infos = pysvn.Client().info2(
+            'file://%s/%s' % (repo_path, path),
+            revision=pysvn.Revision(
+                pysvn.opt_revision_kind.number, repo._impl._revno(cid._id)),
+            depth=pysvn.depth.immediates)
+        names = [name for name, info in infos[1:]]
+        impl = impl_svn_allura_tree if opts.full_tree else impl_svn_allura_node
 
     sys.stdout.write('Timing %s' % ('full tree' if opts.full_tree else 'node'))
     sys.stdout.flush()
@@ -125,6 +143,15 @@ def impl_svn_node(repo, cid, path, names, repo_path, *args):
     return logs[0].revision.number
 
 
+def impl_svn_allura_tree(repo, cid, path, names, *args):
+    paths = [os.path.join(path, name) for name in names]
+    return repo._impl.last_commit_ids(cid, paths)
+
+
+def impl_svn_allura_node(repo, cid, path, *args):
+    return list(repo.log([cid._id], path=path, limit=1))
+
+
 class HgUI(ui.ui):
 
     '''Hg UI subclass that suppresses reporting of untrusted hgrc files.'''
@@ -138,7 +165,9 @@ def parse_opts():
     parser = argparse.ArgumentParser(
         description='Benchmark getting LCD from repo tool')
     parser.add_argument('--type', default='git', dest='type',
-                        help='Type of repository being tested.')
+                        help='Type of repository being tested: git, hg, svn, or '
+                        'svn-allura to time the svn log cache (or pysvn, with '
+                        '--no-log-cache) through allura')
     parser.add_argument('--repo-path', dest='repo_path', required=True,
                         help='Path to the repository to test against')
     parser.add_argument('--commit', default='HEAD', dest='cid',
@@ -150,6 +179,9 @@ def parse_opts():
     parser.add_argument(
         '--full-tree', action='store_true', default=False, dest='full_tree',
         help='Time full tree listing instead of just the single node')
+    parser.add_argument(
+        '--no-log-cache', action='store_true', default=False, dest='no_log_cache',
+        help='With --type=svn-allura, ask pysvn instead of the svn log cache')
     return parser.parse_args()
 
 if __name__ == '__main__':
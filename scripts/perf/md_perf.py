@@ -16,7 +16,26 @@
 #       under the License.
 
 """
-A script for timing/profiling the Markdown conversion of an artifact discussion thread.
+Markdown rendering benchmarks.
+
+With --suite, renders a generated corpus (wiki pages, tickets full of
+shortlinks, big code blocks, tables and macros) with each of Allura's
+renderers and reports timings per renderer and kind of document, how much
+memory each benchmark added, and time spent in each markdown extension.  Results
+can be saved as JSON and compared with an earlier run, failing if anything
+got slower than allowed:
+
+    paster script development.ini ../scripts/perf/md_perf.py -- --suite \\
+        --json before.json
+    # ... change markdown_extensions.py ...
+    paster script development.ini ../scripts/perf/md_perf.py -- --suite \\
+        --json after.json --baseline before.json --max-slowdown 0.1
+
+Links are resolved in --project's wiki, so use --populate once to create the
+wiki pages the corpus links to and includes.
+
+Without --suite, times/profiles the Markdown conversion of an artifact
+discussion thread.
 
 Example usage:
 
@@ -47,7 +66,14 @@
 
 import argparse
 import cProfile
+import gc
+import json
+import random
+import resource
+import sys
 import time
+from collections import defaultdict
+from datetime import datetime
 
 try:
     import re2
@@ -61,6 +87,13 @@
 MAX_OUTPUT = 99999
 DUMMYTEXT = None
 
+WORDS = (
+    'allura forge project ticket wiki commit branch merge release build test '
+    'page user admin tool search index render markdown link code review fix '
+    'bug feature request milestone discussion thread post attachment import '
+    'export repository tree blob diff patch status open closed pending').split()
+PAGE_PREFIX = 'BenchPage'
+
 
 def get_artifact():
     from forgeblog import model as BM
@@ -106,8 +139,324 @@ def render(artifact, md, opts):
     return output
 
 
+def sentence(rand, words=12):
+    return ' '.join(rand.choice(WORDS) for i in xrange(words)).capitalize() + '.'
+
+
+def paragraph(rand, sentences=5):
+    return ' '.join(sentence(rand, rand.randint(6, 18)) for i in xrange(sentences))
+
+
+def wiki_page(rand, num_pages):
+    lines = ['# %s' % sentence(rand, 4), '', paragraph(rand), '']
+    for section in xrange(4):
+        lines += ['## %s' % sentence(rand, 3), '']
+        lines.append('%s **%s** _%s_ `%s` [%s%d] [%s](http://example.com/%s) %s' % (
+            sentence(rand), rand.choice(WORDS), rand.choice(WORDS), rand.choice(WORDS),
+            PAGE_PREFIX, rand.randrange(num_pages), rand.choice(WORDS),
+            rand.choice(WORDS), paragraph(rand, 2)))
+        lines.append('')
+        lines += ['* %s [%s%d]' % (sentence(rand, 6), PAGE_PREFIX, rand.randrange(num_pages))
+                  for i in xrange(5)]
+        lines.append('')
+    return '\n'.join(lines)
+
+
+def ticket(rand, num_pages):
+    refs = ['[#%d]' % rand.randint(1, 500),
+            '#%d' % rand.randint(1, 500),
+            '[%s%d]' % (PAGE_PREFIX, rand.randrange(num_pages)),
+            '[wiki:%s%d]' % (PAGE_PREFIX, rand.randrange(num_pages)),
+            '[r%d]' % rand.randint(1, 5000)]
+    lines = [paragraph(rand, 2), '']
+    for i in xrange(40):
+        lines.append('%s %s' % (sentence(rand, 8), rand.choice(refs)))
+    return '\n'.join(lines)
+
+
+def code_block(rand, lines=300):
+    code = ['~~~~', ':::python']
+    for i in xrange(lines):
+        code.append('%sdef %s_%d(%s):  # %s' % (
+            '    ' * (i % 3), rand.choice(WORDS), i, rand.choice(WORDS), sentence(rand, 5)))
+    code.append('~~~~')
+    return '%s\n\n%s\n\n%s' % (paragraph(rand, 1), '\n'.join(code), paragraph(rand, 1))
+
+
+def table(rand, rows=60, cols=6):
+    lines = [' | '.join(rand.choice(WORDS).title() for i in xrange(cols)),
+             ' | '.join('---' for i in xrange(cols))]
+    for row in xrange(rows):
+        lines.append(' | '.join('%s %d' % (rand.choice(WORDS), rand.randint(0, 999))
+                                for i in xrange(cols)))
+    return '\n'.join(lines)
+
+
+def macro_page(rand, num_pages):
+    # [[projects]] only runs in neighborhood wikis, and is left as is elsewhere
+    return '\n\n'.join([
+        paragraph(rand, 2),
+        '[[include ref=%s%d]]' % (PAGE_PREFIX, rand.randrange(num_pages)),
+        '[[project_admins]]',
+        '[[members limit=10]]',
+        '[[projects]]',
+        paragraph(rand, 2)])
+
+
+def commit_message(rand):
+    return '%s\n\n%s\n\nFixes #%d, see r%d and ticket:%d\nsource:%s.py@%d#L%d' % (
+        sentence(rand, 6), paragraph(rand, 2), rand.randint(1, 500),
+        rand.randint(1, 5000), rand.randint(1, 500), rand.choice(WORDS),
+        rand.randint(1, 5000), rand.randint(1, 300))
+
+
+def make_corpus(size, seed):
+    '''Return {kind: [text, ...]}, the same for the same size and seed'''
+    rand = random.Random(seed)
+    corpus = defaultdict(list)
+    for i in xrange(size):
+        corpus['wiki'].append(wiki_page(rand, size))
+        corpus['ticket'].append(ticket(rand, size))
+        corpus['code'].append(code_block(rand))
+        corpus['table'].append(table(rand))
+        corpus['macro'].append(macro_page(rand, size))
+        corpus['commit'].append(commit_message(rand))
+    return corpus
+
+
+def populate(size, seed):
+    '''Create the wiki pages that the corpus links to and includes'''
+    from ming.orm import ThreadLocalORMSession
+    from forgewiki import model as WM
+    rand = random.Random(seed)
+    for i in xrange(size):
+        page = WM.Page.upsert('%s%d' % (PAGE_PREFIX, i))
+        page.text = wiki_page(rand, size)
+        page.commit()
+    ThreadLocalORMSession.flush_all()
+
+
+def summarize(times):
+    times = sorted(times)
+    return dict(
+        count=len(times),
+        total=sum(times),
+        mean=sum(times) / len(times),
+        p50=times[len(times) // 2],
+        p95=times[int(len(times) * .95)],
+        max=times[-1])
+
+
+def peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def rss_kb():
+    '''The process's current resident set size, or None if it can't be read
+    (it comes from /proc)'''
+    try:
+        with open('/proc/self/statm') as fp:
+            return int(fp.read().split()[1]) * resource.getpagesize() // 1024
+    except (IOError, ValueError, IndexError):
+        return None
+
+
+def time_renders(render, texts, repeat):
+    times = []
+    for text in texts:
+        for i in xrange(repeat):
+            start = time.time()
+            render(text)
+            times.append(time.time() - start)
+    return times
+
+
+def instrument(md, timings):
+    '''Add the time spent in each of md's processors and inline patterns to
+    timings.  treeprocessors.inline includes the inline patterns.'''
+    def timed(name, func):
+        def wrapper(*args, **kw):
+            start = time.time()
+            try:
+                return func(*args, **kw)
+            finally:
+                timings[name] += time.time() - start
+        return wrapper
+    for group in ('preprocessors', 'treeprocessors', 'postprocessors'):
+        for name, proc in getattr(md, group).items():
+            proc.run = timed('%s.%s' % (group, name), proc.run)
+    for name, pattern in md.inlinePatterns.items():
+        pattern.handleMatch = timed('inlinePatterns.' + name, pattern.handleMatch)
+    md.parser.parseDocument = timed('parser', md.parser.parseDocument)
+
+
+def run_suite(opts):
+    import markdown
+    from ming.orm import session
+    from tg import config
+    from allura import model as M
+    from allura.lib import helpers as h
+    from allura.lib.app_globals import RenderCache
+
+    h.set_context(opts.project, 'wiki', neighborhood=opts.neighborhood)
+    if opts.populate:
+        populate(opts.size, opts.seed)
+    corpus = make_corpus(opts.size, opts.seed)
+    text_kinds = [k for k in sorted(corpus) if k != 'commit']
+    renderers = [
+        ('markdown', lambda: g.markdown, text_kinds),
+        ('markdown_wiki', lambda: g.markdown_wiki, text_kinds),
+        ('markdown_commit', lambda: g.markdown_commit, ['commit']),
+    ]
+    results = {}
+    memory = {}
+
+    def record(name, run):
+        '''
+        Summarize the timings run() returns, and how much memory it added.
+        The process's peak RSS is a high-water mark for everything run so
+        far, so only how much a benchmark raised it can be put down to that
+        benchmark (and that's 0 if it stayed under an earlier peak).  The
+        growth of the current RSS shows what it left behind, e.g. in caches.
+        '''
+        gc.collect()
+        peak_before, rss_before = peak_rss_kb(), rss_kb()
+        results[name] = summarize(run())
+        gc.collect()
+        rss_after = rss_kb()
+        memory[name] = dict(
+            peak_increase=peak_rss_kb() - peak_before,
+            rss_growth=rss_after - rss_before if rss_before is not None else None)
+        print '%-30s %10.6f %10.6f %10.6f %8d %8s' % (
+            name, results[name]['mean'], results[name]['p95'],
+            results[name]['total'], memory[name]['peak_increase'],
+            memory[name]['rss_growth'])
+
+    saved_caches = g.markdown_render_cache, g.macro_cache
+    saved_threshold = config.get('markdown_cache_threshold')
+    print '%-30s %10s %10s %10s %8s %8s' % (
+        '', 'mean (s)', 'p95 (s)', 'total (s)', 'peak +kb', 'rss +kb')
+    try:
+        # time the renderers themselves, not the shared caches
+        g.markdown_render_cache, g.macro_cache = RenderCache(), RenderCache()
+        for name, get_md, kinds in renderers:
+            for kind in kinds:
+                record('%s.%s' % (name, kind), lambda: time_renders(
+                    lambda text: get_md().convert(text), corpus[kind], opts.repeat))
+
+        # per-artifact cache: cold renders and stores, warm is served from it
+        config['markdown_cache_threshold'] = '0'
+        for kind in text_kinds:
+            posts = []
+            for text in corpus[kind]:
+                post = M.Post(text=text)
+                session(post).expunge(post)
+                posts.append(post)
+            md = g.markdown
+            for phase in ('cold', 'warm'):
+                record('cached_convert.%s.%s' % (phase, kind), lambda: time_renders(
+                    lambda post: md.cached_convert(post, 'text'), posts, 1))
+
+        # shared render cache, see markdown_render_cache.size
+        g.markdown_render_cache = RenderCache(
+            size=sum(len(texts) for texts in corpus.values()), ttl=3600)
+        for kind in text_kinds:
+            for phase in ('cold', 'warm'):
+                record('render_cache.%s.%s' % (phase, kind), lambda: time_renders(
+                    lambda text: g.markdown.convert(text), corpus[kind], 1))
+
+        g.markdown_render_cache = RenderCache()
+        breakdown = defaultdict(float)
+        # a private instance, so the pooled ones aren't left instrumented
+        md = g.forge_markdown(wiki=True)
+        instrument(md, breakdown)
+        for kind in text_kinds:
+            for text in corpus[kind]:
+                md.reset()
+                md.convert(text)
+    finally:
+        g.markdown_render_cache, g.macro_cache = saved_caches
+        if saved_threshold is None:
+            config.pop('markdown_cache_threshold', None)
+        else:
+            config['markdown_cache_threshold'] = saved_threshold
+
+    print
+    print 'Time per extension (markdown_wiki, all kinds but commit):'
+    for name, secs in sorted(breakdown.items(), key=lambda (n, s): -s):
+        print '%-50s %10.6f' % (name, secs)
+
+    report = dict(
+        meta=dict(
+            date=datetime.utcnow().isoformat(),
+            size=opts.size,
+            repeat=opts.repeat,
+            seed=opts.seed,
+            project=opts.project,
+            python=sys.version.split()[0],
+            markdown=markdown.version),
+        results=results,
+        # per benchmark: how much it raised the process's peak RSS, and how
+        # much the current RSS grew, in kb
+        memory_kb=memory,
+        process_peak_rss_kb=peak_rss_kb(),
+        breakdown=breakdown)
+    if opts.json:
+        with open(opts.json, 'w') as fp:
+            json.dump(report, fp, indent=2, sort_keys=True)
+    if opts.baseline:
+        with open(opts.baseline) as fp:
+            baseline = json.load(fp)
+        regressions = compare(results, baseline['results'], opts.max_slowdown)
+        if regressions:
+            print '%d benchmark(s) more than %d%% slower than %s' % (
+                len(regressions), opts.max_slowdown * 100, opts.baseline)
+            sys.exit(1)
+    return report
+
+
+def compare(results, baseline, max_slowdown):
+    '''Print the change in mean time from baseline for each benchmark, and
+    return the names of those that slowed down by more than max_slowdown
+    (a fraction)'''
+    regressions = []
+    print
+    print '%-30s %10s %10s %8s' % ('', 'before', 'after', 'change')
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        before, after = baseline[name]['mean'], results[name]['mean']
+        change = (after - before) / before if before else 0.0
+        flag = ''
+        if change > max_slowdown:
+            regressions.append(name)
+            flag = '  SLOWER'
+        print '%-30s %10.6f %10.6f %+7.1f%%%s' % (name, before, after, change * 100, flag)
+    return regressions
+
+
 def parse_options():
     parser = argparse.ArgumentParser()
+    parser.add_argument('--suite', action='store_true',
+                        help='Run the benchmark suite on a generated corpus')
+    parser.add_argument('--size', type=int, default=20,
+                        help='Documents of each kind in the corpus. Default is 20.')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Times to render each document. Default is 3.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed for generating the corpus. Default is 0.')
+    parser.add_argument('--project', default='test',
+                        help='Project whose wiki links are resolved in. Default is test.')
+    parser.add_argument('--neighborhood', default='Projects',
+                        help='Neighborhood of --project. Default is Projects.')
+    parser.add_argument('--populate', action='store_true',
+                        help='Create the wiki pages the corpus refers to')
+    parser.add_argument('--json', help='Write suite results to this file')
+    parser.add_argument('--baseline',
+                        help='Compare suite results to this earlier --json output')
+    parser.add_argument('--max-slowdown', type=float, default=0.1,
+                        help='Exit with an error if any benchmark is slower '
+                        'than --baseline by more than this fraction. Default is 0.1.')
     parser.add_argument('--converter', default='markdown')
     parser.add_argument('--profile', action='store_true',
                         help='Run profiler and output timings')
@@ -124,6 +473,9 @@ def parse_options():
 
 if __name__ == '__main__':
     opts = parse_options()
+    if opts.suite:
+        run_suite(opts)
+        sys.exit(0)
     out1 = main(opts)
     if opts.compare:
         opts.re2 = not opts.re2
@@ -0,0 +1,69 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+"""
+Measure post-to-start latency of taskd: how long a freshly posted task waits
+in the queue before an idle worker picks it up.
+
+Start one or more idle taskd workers, then run this once with
+``monq.wakeup = false`` and once with ``monq.wakeup = true`` (restart the
+workers in between) and compare the output.
+
+Example usage:
+
+    paster script development.ini ../scripts/perf/monq_latency.py -- -n 50
+"""
+
+import argparse
+import pprint
+import random
+import time
+
+from ming.orm import ThreadLocalORMSession
+
+from allura import model as M
+
+
+def main(opts):
+    latencies = []
+    for i in xrange(opts.num):
+        # idle gaps, so workers are waiting (sleeping or tailing) on each post
+        time.sleep(random.uniform(0, opts.gap))
+        task = M.MonQTask.post(pprint.pformat, ([i],))
+        ThreadLocalORMSession.flush_all()
+        task.join(poll_interval=0.05)
+        latency = (task.time_start - task.time_queue).total_seconds()
+        latencies.append(latency)
+        print '%4d %.3f' % (i + 1, latency)
+    latencies.sort()
+    print 'wakeup enabled: %s' % M.MonQWakeup.enabled()
+    print 'mean: %.3fs' % (sum(latencies) / len(latencies))
+    print 'p50:  %.3fs' % latencies[len(latencies) // 2]
+    print 'p95:  %.3fs' % latencies[int(len(latencies) * .95)]
+    print 'max:  %.3fs' % latencies[-1]
+
+
+def parse_options():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--num', type=int, default=20,
+                        help='Number of tasks to post. Default is 20.')
+    parser.add_argument('--gap', type=float, default=3,
+                        help='Max seconds to sleep before each post. Default is 3.')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    main(parse_options())
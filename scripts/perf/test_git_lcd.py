@@ -19,12 +19,13 @@
 
 import sys
 import os
-from glob import glob
 from time import time
 from contextlib import contextmanager
 from pprint import pprint
 
+import tg
 from mock import Mock
+from allura.lib import helpers as h
 from forgegit.model.git_repo import GitImplementation
 
 
@@ -37,16 +38,32 @@ def benchmark():
 
 
 def main(repo_dir, sub_dir='', commit=None):
+    """
+    Time last_commit_ids for every entry of a directory, once with the
+    threaded per-chunk `git log` engine and once with the single-pass
+    history walk.
+    """
     repo_dir = repo_dir.rstrip('/')
     git = GitImplementation(Mock(full_fs_path=repo_dir))
     commit = Mock(_id=commit or git.head)
-    paths = glob(os.path.join(repo_dir, sub_dir, '*'))
-    paths = [path.replace(repo_dir + '/', '', 1) for path in paths]
-    print "Timing LCDs for %s at %s" % (paths, commit._id)
-    with benchmark() as timer:
-        result = git.last_commit_ids(commit, paths)
-    pprint(result)
-    print "Took %f seconds" % timer['result']
+    tree = commit._id + ':' + sub_dir.strip('/') if sub_dir else commit._id
+    paths = git._git.git.ls_tree(tree, name_only=True).splitlines()
+    paths = [os.path.join(sub_dir.strip('/'), path) for path in paths]
+    print "Timing LCDs for %d paths at %s" % (len(paths), commit._id)
+    results = {}
+    for engine, single_pass in (('threaded', 'false'), ('single-pass', 'true')):
+        with h.push_config(tg.config, lcd_single_pass=single_pass):
+            with benchmark() as timer:
+                results[engine] = git.last_commit_ids(commit, paths)
+        print "%s: took %f seconds, resolved %d paths" % (
+            engine, timer['result'], len(results[engine]))
+    pprint(results['single-pass'])
+    if results['threaded'] != results['single-pass']:
+        print "Results differ:"
+        for path in sorted(set(results['threaded']) | set(results['single-pass'])):
+            if results['threaded'].get(path) != results['single-pass'].get(path):
+                print "  %s: %s != %s" % (path, results['threaded'].get(path),
+                                          results['single-pass'].get(path))
 
 if __name__ == '__main__':
     main(*sys.argv[1:])